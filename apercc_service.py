@@ -0,0 +1,80 @@
+# aperCC: resident analysis service and its client
+
+"""
+Start the aperCC analysis service or query it
+
+The service keeps casacore, the beam directories and the solutions of
+the tasks it was asked about in memory, so repeated queries take
+milliseconds instead of a new Python process each. The client commands
+only use the standard library.
+
+Usage:
+python apercc_service.py serve [-b <base_dir>] &
+python apercc_service.py bandpass_metrics <task_id> <source> [--beam 5]
+python apercc_service.py gain_metrics <task_id> <source> [--align hourangle]
+python apercc_service.py beams <task_id> <source>
+python apercc_service.py ping|cache_info|invalidate|shutdown
+"""
+
+import json
+import argparse
+import logging
+
+from modules.service import AnalysisService, ServiceClient, ServiceError, DEFAULT_SOCKET
+
+parser = argparse.ArgumentParser(
+         description='Resident aperCC analysis service and client')
+parser.add_argument('cmd',
+                    choices=['serve', 'bandpass_metrics', 'gain_metrics', 'beams',
+                             'ping', 'cache_info', 'invalidate', 'shutdown'],
+                    help='Start the service or send it a request')
+parser.add_argument('task_id',nargs='?',type=int,help='Task id of the calibrator scan')
+parser.add_argument('source',nargs='?',help='Name of the calibrator')
+parser.add_argument('-s','--socket',default=DEFAULT_SOCKET,
+                    help='Unix socket of the service')
+parser.add_argument('-b','--base_dir',default=None,
+                    help='Data directory of the tasks')
+parser.add_argument('--search_all_nodes',action='store_true',
+                    help='Search the data directories of all nodes')
+parser.add_argument('--beam',default=None,type=int,
+                    help='Only this beam, default all beams')
+parser.add_argument('--ref_beam',default=0,type=int,
+                    help='Reference beam of the metrics')
+parser.add_argument('--align',default='start',choices=['start','hourangle','lst'],
+                    help='Alignment of the gain solutions')
+parser.add_argument('--json',action='store_true',
+                    help='Print the raw JSON result')
+args = parser.parse_args()
+
+if args.cmd == 'serve':
+    logging.basicConfig(level=logging.INFO)
+    AnalysisService(args.socket, base_dir=args.base_dir,
+                    search_all_nodes=args.search_all_nodes).serve_forever()
+    raise SystemExit(0)
+
+kwargs = dict()
+if args.cmd in ['bandpass_metrics', 'gain_metrics', 'beams']:
+    if args.task_id is None or args.source is None:
+        parser.error('{} needs a task id and a source'.format(args.cmd))
+    kwargs = dict(task_id=args.task_id, source=args.source)
+    if args.base_dir is not None:
+        kwargs['base_dir'] = args.base_dir
+    if args.search_all_nodes:
+        kwargs['search_all_nodes'] = True
+if args.cmd in ['bandpass_metrics', 'gain_metrics']:
+    kwargs.update(beam=args.beam, ref_beam=args.ref_beam)
+if args.cmd == 'gain_metrics':
+    kwargs['align'] = args.align
+
+try:
+    with ServiceClient(args.socket) as client:
+        result = client.request(args.cmd, **kwargs)
+except ServiceError as e:
+    raise SystemExit('Error: {}'.format(e))
+
+if args.json or args.cmd not in ['bandpass_metrics', 'gain_metrics']:
+    print(json.dumps(result, indent=1, sort_keys=True))
+else:
+    for beam in sorted(result):
+        for metric, ant, corr, value in result[beam]:
+            print("{0} {1:<20s} {2} {3} {4:.6g}".format(beam, metric, ant, corr, value))
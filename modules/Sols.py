@@ -6,25 +6,26 @@ Created on Tue Jun 11 13:07:00 2019
 @author: kutkin
 """
 
-import os
 import numpy as np
-from scipy.interpolate import interp1d
-import casacore.tables as pt
 
-import matplotlib.pyplot as plt
+from .soltable import SolTable, read_tables
+from .stats import wrap_phase
 
 import logging
 logger = logging.getLogger(__name__)
 
 #TODO: plotting selected or all ants
 
-import pyrap.measures as pm
-import pyrap.quanta as qa
-import ephem
+# casacore, matplotlib and the measures are imported in the functions
+# that need them, so importing this module stays fast
 
 
 
 def get_time(t):
+    import pyrap.measures as pm
+    import pyrap.quanta as qa
+    import ephem
+
     time_start = qa.quantity(t, 's')
     me = pm.measures()
     dict_time_start_MDJ = me.epoch('utc', time_start)
@@ -42,41 +43,43 @@ class BPSols():
 
 
     def read_data(self):
-
-        if os.path.isdir(self.bptable):
-            taql_command = ("SELECT TIME,abs(CPARAM) AS amp, arg(CPARAM) AS phase, "
-                            "FLAG FROM {0}").format(self.bptable)
-            t=pt.taql(taql_command)
-            times = t.getcol('TIME')
-            amp_sols=t.getcol('amp')
-            phase_sols = t.getcol('phase')
-            flags = t.getcol('FLAG')
-            taql_antnames = "SELECT NAME FROM {0}::ANTENNA".format(self.bptable)
-            t= pt.taql(taql_antnames)
-            ant_names=t.getcol("NAME")
-            taql_freq = "SELECT CHAN_FREQ FROM {0}::SPECTRAL_WINDOW".format(self.bptable)
-            t = pt.taql(taql_freq)
-            freqs = t.getcol('CHAN_FREQ')
-
-            #check for flags and mask
-            amp_sols[flags] = np.nan
-            phase_sols[flags] = np.nan
-
-            self.ants = ant_names
-            self.time = times
-            self.phase = phase_sols * 180./np.pi #put into degrees
-            self.amp = amp_sols
-            self.flags = flags
-            self.freq = freqs / 1e9 # GHz
-            self.t0 = get_time(times[0])
-
-        else:
-            logger.info('BP table not present. Filling with NaNs.')
-            self.ants = ['RT2','RT3','RT4','RT5','RT6','RT7','RT8','RT9','RTA','RTB','RTC','RTD']
-            self.time = np.array(np.nan)
-            self.phase = np.full((12,2,2),np.nan)
-            self.amp = np.full((12,2,2),np.nan)
-            self.freq = np.full((2,2),np.nan)
+        # missing tables give NaN placeholders
+        sol = SolTable(self.bptable, 'Bscan')
+        self.ants = sol.ants
+        self.time = sol.time
+        self.data = sol.values #complex solutions, amplitude and phase are derived from them
+        self.phase = sol.phase #degrees
+        self.amp = sol.amp
+        self.flags = sol.flags #bit-packed along the channels
+        self.freq = sol.freq # GHz
+        if sol.present:
+            self.t0 = get_time(sol.time[0])
+
+    @classmethod
+    def from_cube(cls, cube, beam):
+        """
+        Create the solutions of one beam from a BandpassCube without reading
+        the table again. The arrays are views into the cube.
+        """
+        b = cube.beam_index(beam)
+        bp = cls.__new__(cls)
+        bp.bptable = cube.tables[beam]
+        bp.ants = cube.ants
+        bp.time = cube.time[b:b+1]
+        bp.phase = cube.phase[b]
+        bp.data = cube.data[b]
+        bp.amp = cube.amp[b]
+        bp.flags = cube.flags[b]
+        bp.freq = cube.freq[np.newaxis, :]
+        if cube.present[b]:
+            bp.t0 = get_time(cube.time[b])
+        return bp
+
+    def delays(self, pad=8):
+        """ return [ant, pol] residual delays in ns, see delays.estimate_delays """
+        from .delays import estimate_delays
+
+        return estimate_delays(self.freq[0,:], self.data, pad=pad)[0]
 
     def get_ant_bpass(self, ant='RT3'):
         """ return freq, [XX, YY] amp, [XX, YY] phase for a given ANT name """
@@ -93,6 +96,7 @@ class BPSols():
 
     def plot_amp(self, ants=['RT3'], imagepath=None):
         """Plot amplitude, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for bandpass amplitude")
         for a, ant in enumerate(ants):
@@ -107,6 +111,7 @@ class BPSols():
 
     def plot_phase(self, ants=['RT3'], imagepath=None):
         """Plot phase, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for bandpass phase")
         for a, ant in enumerate(ants):
@@ -123,19 +128,28 @@ class BPSols():
     def normalize(self, other):
         """
         multiply (divide) the solution by the other one.
+        If the other solution has a different frequency grid, it is
+        regridded onto the grid of this one first.
         """
 
-        if self.amp.shape != other.amp.shape:
+        if self.amp.shape[::2] != other.amp.shape[::2]:
             logger.warning('The shapes are different: {} vs {}'.\
                            format(self.amp.shape, other.amp.shape))
 
-        amp_norm = self.amp / other.amp
-        phase_norm = self.phase - other.phase
+        other_amp, other_phase = other.amp, other.phase
+        if not np.array_equal(self.freq[0,:], other.freq[0,:]):
+            from .regrid import regrid, regrid_phase
+            other_amp = regrid(other.freq[0,:], other.amp, self.freq[0,:])
+            other_phase = regrid_phase(other.freq[0,:], other.phase, self.freq[0,:])
+
+        amp_norm = self.amp / other_amp
+        phase_norm = wrap_phase(self.phase - other_phase)
 
         return amp_norm, phase_norm
 
     def plot_norm_amp(self, other, ant='RT3', imagepath=None, ax=None):
         """Plot norm amplitude, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for normalized bandpass amplitude")
         amp_norm, phase_norm = self.normalize(other)
@@ -153,7 +167,7 @@ class BPSols():
                         marker=',',s=1)
 
         ax.set_ylim(0.52,1.52)
-        ax.set_xlim(1.22,1.53)
+        ax.set_xlim(np.nanmin(self.freq), np.nanmax(self.freq))
             # ax.legend(markerscale=3,fontsize=14)
         # if imagepath is not None:
             # fig.savefig('{}'.format(imagepath))
@@ -161,6 +175,7 @@ class BPSols():
 
     def plot_norm_phase(self, other, ant='RT3', imagepath=None, ax=None):
         """Plot norm phase, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for bandpass phase")
         amp_norm, phase_norm = self.normalize(other)
@@ -179,7 +194,7 @@ class BPSols():
                         marker=',',s=1)
 
         ax.set_ylim(-203,203)
-        ax.set_xlim(1.22,1.53)
+        ax.set_xlim(np.nanmin(self.freq), np.nanmax(self.freq))
         return fig, ax
 
 
@@ -189,57 +204,42 @@ class GainSols():
         self.read_data()
 
     def read_data(self):
-        #check if table exists
-        #otherwise, place NaNs in place for everything
-        if os.path.isdir(self.gaintable):
-            taql_antnames = "SELECT NAME FROM {0}::ANTENNA".format(self.gaintable)
-            t= pt.taql(taql_antnames)
-            ant_names=t.getcol("NAME")
-
-            #then get number of times
-            #need this for setting shape
-            taql_time =  "select TIME from {0} orderby unique TIME".format(self.gaintable)
-            t= pt.taql(taql_time)
-            times = t.getcol('TIME')
-
-            #then iterate over antenna
-            #set array sahpe to be [n_ant,n_time,n_stokes]
-            #how can I get n_stokes? Could be 2 or 4, want to find from data
-            #get 1 data entry
-            taql_stokes = "SELECT abs(CPARAM) AS amp from {0} limit 1" .format(self.gaintable)
-            t_pol = pt.taql(taql_stokes)
-            pol_array = t_pol.getcol('amp')
-            n_stokes = pol_array.shape[2] #shape is time, one, nstokes
-
-            amp_ant_array = np.empty((len(ant_names),len(times),n_stokes),dtype=object)
-            phase_ant_array = np.empty((len(ant_names),len(times),n_stokes),dtype=object)
-            flags_ant_array = np.empty((len(ant_names),len(times),n_stokes),dtype=bool)
-
-            for ant in xrange(len(ant_names)):
-                taql_command = ("SELECT abs(CPARAM) AS amp, arg(CPARAM) AS phase, FLAG FROM {0} "
-                                "WHERE ANTENNA1={1}").format(self.gaintable,ant)
-                t = pt.taql(taql_command)
-                amp_ant_array[ant,:,:] = t.getcol('amp')[:,0,:]
-                phase_ant_array[ant,:,:] = t.getcol('phase')[:,0,:]
-                flags_ant_array[ant,:,:] = t.getcol('FLAG')[:,0,:]
-
-            #check for flags and mask
-            amp_ant_array[flags_ant_array] = np.nan
-            phase_ant_array[flags_ant_array] = np.nan
-
-            self.amp = amp_ant_array
-            self.phase = phase_ant_array * 180./np.pi #put into degrees
-            self.ants = ant_names
-            self.time = times
-            self.flags = flags_ant_array
-            self.t0 = get_time(times[0])
-        else:
-            logger.info('Gain table not present. Filling with NaNs.')
-            self.amp = np.full((12,2,2),np.nan)
-            self.phase = np.full((12,2,2),np.nan)
-            self.ants = ['RT2','RT3','RT4','RT5','RT6','RT7','RT8','RT9','RTA','RTB','RTC','RTD']
-            self.time = np.full((2),np.nan)
-            self.flags = np.full((12,2,2),np.nan)
+        # missing tables give NaN placeholders
+        self._set_sols(SolTable(self.gaintable, 'G1ap'))
+
+    def set_data(self, time_col, ant_col, cparam, flags):
+        """
+        Sort the TIME, ANTENNA1, CPARAM and FLAG columns of the table
+        into arrays of shape [n_ant,n_time,n_stokes]
+        """
+        self._set_sols(SolTable.from_rows(self.gaintable, 'G1ap', time_col, ant_col,
+                                          cparam, flags))
+
+    def _set_sols(self, sol):
+        self.amp = sol.amp.astype(float)
+        self.phase = sol.phase #degrees
+        self.ants = sol.ants
+        self.time = sol.time
+        self.flags = sol.flags #bit-packed along the times
+        if sol.present:
+            self.t0 = get_time(sol.time[0])
+
+    @classmethod
+    def from_tables(cls, gaintables):
+        """
+        Read the solutions of several gain tables (e.g. all beams of a task)
+        with one concatenated query
+
+        Returns:
+            list: GainSols, one per table
+        """
+        res = []
+        for table, sol in zip(gaintables, read_tables(gaintables, 'G1ap')):
+            g = cls.__new__(cls)
+            g.gaintable = table
+            g._set_sols(sol)
+            res.append(g)
+        return res
 
     def get_ant_gains(self, ant='RT3'):
         """ return time, [XX,YY] amp, [XX, YY] phase for a given ANT name """
@@ -254,8 +254,38 @@ class GainSols():
             res.update({antname:tap})
         return res
 
-    def normalize(self, other):
-        """ divide by the other solutions """
+    def coordinate(self, mode='hourangle'):
+        """
+        Solution times as minutes since the first solution ('start'),
+        sidereal time ('lst') or hour angle of the calibrator ('hourangle')
+        in hours, see sidereal.solution_coordinate
+        """
+        from .sidereal import solution_coordinate, table_ra
+
+        ra = table_ra(self.gaintable) if mode == 'hourangle' else np.nan
+        return solution_coordinate(self.time, mode, ra=ra)
+
+    def normalize(self, other, align='start'):
+        """
+        divide by the other solutions
+
+        With align 'start' the solutions are aligned on the time since
+        their first solution, with 'hourangle' or 'lst' the other solutions
+        are resampled onto the hour angles (sidereal times) of these, which
+        compares observations of different days at the same elevation.
+
+        Returns:
+            tuple: times (minutes, or hours for 'hourangle' and 'lst'),
+                amplitude ratio and phase difference (degrees)
+        """
+        if align != 'start':
+            from .sidereal import resample, resample_phase
+
+            x = self.coordinate(align)
+            x_other = other.coordinate(align)
+            a2 = resample(x_other, other.amp, x, axis=1)
+            p2 = resample_phase(x_other, other.phase, x, axis=1)
+            return x, self.amp / a2, wrap_phase(self.phase - p2)
 
         t1 = self.time - self.time[0]
         t2 = other.time - other.time[0]
@@ -289,12 +319,13 @@ class GainSols():
             t = t1
 
         amp_norm = a1 / a2
-        phase_norm = p1 - p2
+        phase_norm = wrap_phase(p1 - p2)
 
         return t/60, amp_norm, phase_norm
 
     def plot_amp(self, ants=['RT3'], imagepath=None):
         """Plot amplitude, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for gain amplitude")
         for a, ant in enumerate(ants):
@@ -311,6 +342,7 @@ class GainSols():
 
     def plot_phase(self, ants=['RT3'], imagepath=None):
         """Plot phase, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for gain phase")
         for a, ant in enumerate(ants):
@@ -325,6 +357,7 @@ class GainSols():
 
     def plot_norm_amp(self, other, ant='RT3', imagepath=None, ax=None):
         """Plot norm amplitude, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for gain amplitude")
         t, amp_norm, phase_norm = self.normalize(other)
@@ -347,6 +380,7 @@ class GainSols():
 
     def plot_norm_phase(self, other, ant='RT3', imagepath=None, ax=None):
         """Plot norm phase, one plot per antenna"""
+        import matplotlib.pyplot as plt
 
         logging.info("Creating plots for bandpass phase")
         t, amp_norm, phase_norm = self.normalize(other)
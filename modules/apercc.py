@@ -7,17 +7,31 @@ __version__ = "0.1"
 import numpy as np
 import os
 import sys
-#from scandata import ScanData
-import apercal.libs.lib as lib
+from .scandata import ScanData
+from .metrics import compare_beams, compare_observations, bandpass_outliers, beam_similarity
+from .cube import BandpassCube
+from .obsindex import ObservationIndex
+from .scandata import get_data_roots
+from .metricstore import MetricStore
+from .visstats import beam_vis_stats
+from .plan import plan_task, format_plan, learn
 from time import time
 import logging
-from apercal.modules.prepare import prepare
-from apercal.modules.preflag import preflag
-from apercal.modules.ccal import ccal
-from apercal.subs.managefiles import director
 
+# steps comparing a task to another observation
+COMPARE_OBS_STEPS = ['bpass_compare_obs', 'gain_compare_obs']
 
-def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all_nodes=False, steps=None):
+# name of the index of observations in the directory of the metric store
+OBS_INDEX_NAME = 'obs_index.pkl'
+
+# indexes of observations already loaded or built in this process
+_obs_indexes = dict()
+
+# Apercal is imported inside apercc and its steps,
+# so only runs that need it pay for importing it
+
+
+def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all_nodes=False, steps=None, metric_store=None, obs_index=None, dry_run=False):
     """
     Main function to run the cross-calibration stability evaluation.
 
@@ -30,7 +44,7 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
 
     Example:
         scanid, source name, beam: [190108926, '3C147_36', 36]
-        steps: ['prepare', 'preflag', 'crosscal', bpass_compare', 'gain_comare', 'bpass_compare_obs', 'gain_compare_obs']
+        steps: ['prepare', 'preflag', 'crosscal', bpass_compare', 'gain_compare', 'vis_stats', 'bpass_compare_obs', 'gain_compare_obs']
         function cal: apercc(cal_list=[[190108926, '3C147_36', 36], [190108927, '3C147_37', 37]) or apercc(task_id = 190409056, cal_name='3C196')
 
     Args:
@@ -44,6 +58,16 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
             if not specified the first name in the calibrator list will be used
         search_all_nodes (bool): 
         steps (List(str)): List of steps in this task
+        metric_store (str or MetricStore): Store (or its directory) to which
+            the compare steps append their stability metrics, optional
+        obs_index (str): File in which the index of observations used to find
+            the observation to compare to is kept between runs, default
+            obs_index.pkl in the directory of the metric store. Without an
+            existing index the comparisons across observations only run if
+            they are requested in steps
+        dry_run (bool): Only print and return the plan of the run with the
+            estimated bytes read, wall time and peak memory of every step,
+            without reading or writing any data
 
     To Do: Use existing data using the task_id option and the name of the calibrator?
 
@@ -54,8 +78,12 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
 
     # start time of this function
     start_time = time()
+    # wall time of every step, to learn the throughputs used by dry runs
+    step_times = dict()
 
     # check input
+    # the comparisons across observations only run by default once there is an index
+    default_steps = not steps
     # if no list of a calibrators is given
     cal_list_mode = True
     if cal_list is None:
@@ -71,7 +99,7 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
                 if 'crosscal' in steps:
                     steps.remove('crosscal')
             else:
-                steps = ['bpass_compare', 'gain_comare',
+                steps = ['bpass_compare', 'gain_compare',
                          'bpass_compare_obs', 'gain_compare_obs']
             # using existing data
             cal_list_mode = False
@@ -84,7 +112,17 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
         print("Using list of calibrators")
         if not steps:
             steps = ['prepare', 'preflag', 'crosscal', 'bpass_compare',
-                     'gain_comare', 'bpass_compare_obs', 'gain_compare_obs']
+                     'gain_compare', 'bpass_compare_obs', 'gain_compare_obs']
+
+    # the index of observations is kept next to the metric store
+    if obs_index is None and metric_store is not None:
+        obs_index = os.path.join(metric_store.root if isinstance(metric_store, MetricStore)
+                                 else metric_store, OBS_INDEX_NAME)
+    if default_steps and (obs_index is None or not os.path.exists(obs_index)):
+        # building the index walks and opens every bandpass table of the archive
+        steps = [step for step in steps if step not in COMPARE_OBS_STEPS]
+        print("No index of observations, skipping the comparison across observations "
+              "(request the steps {} to build the index)".format(', '.join(COMPARE_OBS_STEPS)))
 
     # # check that preflag is in it if prepare is run
     # else:
@@ -108,6 +146,16 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
             base_dir = '/data/apertif/crosscal/{}/'.format(task_id)
     elif len(base_dir) > 0 and base_dir[-1] != '/':
         base_dir = base_dir + '/'
+
+    # plan the run without touching the data
+    if dry_run:
+        task_plan = plan_task(task_id, cal_name if cal_name is not None else cal_list[0][1],
+                              base_dir, steps,
+                              beams=[cal[2] for cal in cal_list] if cal_list_mode else None,
+                              search_all_nodes=search_all_nodes)
+        print(format_plan(task_plan))
+        return task_plan
+
     if not os.path.exists(base_dir) and cal_list_mode:
         try:
             os.mkdir(base_dir)
@@ -118,6 +166,8 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
         print("Directory was not found. Abort")
         return -1
 
+    import apercal.libs.lib as lib
+
     logfilepath = os.path.join(base_dir, 'apercc.log')
 
     lib.setup_logger('debug', logfile=logfilepath)
@@ -141,6 +191,7 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
     logger.debug("base_dir = {}".format(base_dir))
     logger.debug("search_all_nodes = {}".format(search_all_nodes))
     logger.debug("steps = {}".format(steps))
+    logger.debug("metric_store = {}".format(metric_store))
 
     # number of calibrators
     if cal_list is not None:
@@ -160,6 +211,7 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
     # ==============================
 
     if "prepare" in steps:
+        from apercal.modules.prepare import prepare
 
         start_time_prepare = time()
 
@@ -192,6 +244,7 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
 
         logger.info("Getting data for calibrators ... Done ({0:.0f}s)".format(
             time() - start_time_prepare))
+        step_times['prepare'] = time() - start_time_prepare
     else:
         logger.info("Skipping getting data for calibrators")
 
@@ -199,29 +252,36 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
     # ===============================
 
     if 'preflag' in steps:
+        from apercal.modules.preflag import preflag
+        from apercal.subs.managefiles import director
+
         start_time_flag = time()
 
         logger.info("Flagging data of calibrators")
 
-        # Flag fluxcal (pretending it's a target)
-        # needs to be changed for parallel preflag and make it a loop
-        flag = preflag(filename=None)
-        flag.basedir = base_dir
-        flag.fluxcal = ''
-        flag.polcal = ''
-        flag.target = name_cal.upper().strip().split('_')[0] + '.MS'
-        flag.beam = "{:02d}".format(beam_list[0])
-        flag.preflag_targetbeams = "{:02d}".format(beamnr)
-        try:
-            director(flag, 'rm', base_dir + '/param.npy',
-                     ignore_nonexistent=True)
-            flag.go()
-        except Exception as e:
-            logger.warning("Preflag failed")
-            logger.exception(e)
-        else:
-            logger.info("Flagging data of calibrators ... Done ({0:.0f}s)".format(
-                time() - start_time_flag))
+        # Flag fluxcal (pretending it's a target), one beam at a time
+        for beam_nr in beam_list:
+            logger.info("Running preflag for beam {0}".format(beam_nr))
+            flag = preflag(filename=None)
+            flag.basedir = base_dir
+            flag.fluxcal = ''
+            flag.polcal = ''
+            flag.target = name_cal.upper().strip().split('_')[0] + '.MS'
+            flag.beam = "{:02d}".format(beam_nr)
+            flag.preflag_targetbeams = "{:02d}".format(beam_nr)
+            try:
+                director(flag, 'rm', base_dir + '/param.npy',
+                         ignore_nonexistent=True)
+                flag.go()
+            except Exception as e:
+                logger.warning("Preflag failed for beam {}".format(beam_nr))
+                logger.exception(e)
+            else:
+                logger.info("Running preflag for beam {0} ... Done".format(beam_nr))
+
+        logger.info("Flagging data of calibrators ... Done ({0:.0f}s)".format(
+            time() - start_time_flag))
+        step_times['preflag'] = time() - start_time_flag
     else:
         logger.info("Skipping running preflag for calibrators")
 
@@ -229,6 +289,9 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
     # ===============================
 
     if 'crosscal' in steps:
+        from apercal.modules.ccal import ccal
+        from apercal.subs.managefiles import director
+
         start_time_crosscal = time()
 
         logger.info("Running crosscal for calibrators")
@@ -262,22 +325,46 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
 
         logger.info("Running crosscal for calibrators ... Done ({0:.0f}s)".format(
             time() - start_time_crosscal))
+        step_times['crosscal'] = time() - start_time_crosscal
     else:
         logger.info("Skipping running crosscal for calibrators")
 
     # Running Bandbpass comparison
     # ============================
 
+    if any(step in steps for step in ['bpass_compare', 'gain_compare', 'vis_stats',
+                                      'bpass_compare_obs', 'gain_compare_obs']):
+        # the beam directories are in base_dir, which is named after the task id
+        scan_data = ScanData(task_id, name_cal.upper().strip().split('_')[0],
+                             base_dir=os.path.dirname(base_dir.rstrip('/')),
+                             search_all_nodes=search_all_nodes)
+        if metric_store is not None and not isinstance(metric_store, MetricStore):
+            metric_store = MetricStore(metric_store)
+
     if 'bpass_compare' in steps:
 
         start_time_prepare = time()
 
         logger.info("Comparing bandpass")
 
-        logger.info("#### Doing nothing here yet ####")
+        # the bandpass tables of all beams are read once for all comparisons
+        bpass_cube = BandpassCube.from_scandata(scan_data)
+
+        bpass_metrics = compare_beams(scan_data, kind='bpass', store=metric_store,
+                                      cube=bpass_cube)
+        logger.info("Got bandpass metrics for {} beams".format(len(bpass_metrics)))
+
+        # quick check of every run for beams, antennas and channels that stand out
+        bpass_outliers = bandpass_outliers(scan_data, cube=bpass_cube)
+        logger.info("Found {} bandpass outliers".format(
+            sum(len(found) for found in bpass_outliers.values())))
+
+        # which beams behave alike, per antenna
+        beam_similarity(scan_data, store=metric_store, cube=bpass_cube)
 
         logger.info("Comparing bandpass ... Done ({0:.0f})".format(
             time() - start_time_prepare))
+        step_times['bpass_compare'] = time() - start_time_prepare
     else:
         logger.info("Skipping comparing bandpass")
 
@@ -290,42 +377,130 @@ def apercc(cal_list=None, task_id=None, cal_name=None, base_dir=None, search_all
 
         logger.info("Comparing gain solutions")
 
-        logger.info("#### Doing nothing here yet ####")
+        gain_metrics = compare_beams(scan_data, kind='gain', store=metric_store)
+        logger.info("Got gain metrics for {} beams".format(len(gain_metrics)))
 
         logger.info("Comparing gain solutions ... Done ({0:.0f})".format(
             time() - start_time_gain))
+        step_times['gain_compare'] = time() - start_time_gain
     else:
         logger.info("Skipping comparing gain solutions")
 
+    # Running statistics of the calibrated visibilities
+    # =================================================
+
+    if 'vis_stats' in steps:
+
+        start_time_vis = time()
+
+        logger.info("Getting statistics of the calibrated visibilities")
+
+        ms_list = scan_data.get_ms()
+        if ms_list != -1:
+            vis_stats = beam_vis_stats(ms_list, source=scan_data.source_name)
+            if metric_store is not None:
+                for beam, stats in vis_stats.items():
+                    metric_store.append(stats.records(), task_id, scan_data.source_name,
+                                        beam, stats.time)
+            logger.info("Got visibility statistics for {} beams".format(len(vis_stats)))
+
+        logger.info("Getting statistics of the calibrated visibilities ... Done ({0:.0f})".format(
+            time() - start_time_vis))
+        step_times['vis_stats'] = time() - start_time_vis
+    else:
+        logger.info("Skipping statistics of the calibrated visibilities")
+
+    # Finding the observation to compare to
+    # =====================================
+    ref_scan_data = None
+    if 'bpass_compare_obs' in steps or 'gain_compare_obs' in steps:
+        ref_scan_data = find_reference(scan_data, obs_index=obs_index,
+                                       search_all_nodes=search_all_nodes)
+
     # Running Bandbpass comparison between observations
     # =================================================
-    if 'bpass_compare_obs' in steps:
+    if 'bpass_compare_obs' in steps and ref_scan_data is not None:
 
         start_time_bandpass = time()
 
         logger.info("Comparing banpdass solutions across observations")
 
-        logger.info("#### Doing nothing here yet ####")
+        bpass_obs_metrics = compare_observations(scan_data, ref_scan_data, kind='bpass',
+                                                 store=metric_store)
+        logger.info("Got bandpass metrics relative to task {0} for {1} beams".format(
+            ref_scan_data.task_id, len(bpass_obs_metrics)))
 
         logger.info("Comparing banpdass solutions across observations ... Done ({0:.0f})".format(
             time() - start_time_bandpass))
+        step_times['bpass_compare_obs'] = time() - start_time_bandpass
     else:
         logger.info("Skipping comparing banpdass solutions across observations")
 
-    # Running Bandbpass comparison between observations
-    # =================================================
-    if 'bpass_compare_obs' in steps:
+    # Running gain comparison between observations
+    # ============================================
+    if 'gain_compare_obs' in steps and ref_scan_data is not None:
 
         start_time_gain = time()
 
-        logger.info("Comparing banpdass solutions across observations")
+        logger.info("Comparing gain solutions across observations")
 
-        logger.info("#### Doing nothing here yet ####")
+        gain_obs_metrics = compare_observations(scan_data, ref_scan_data, kind='gain',
+                                                store=metric_store)
+        logger.info("Got gain metrics relative to task {0} for {1} beams".format(
+            ref_scan_data.task_id, len(gain_obs_metrics)))
 
-        logger.info("Comparing banpdass solutions across observations ... Done ({0:.0f})".format(
+        logger.info("Comparing gain solutions across observations ... Done ({0:.0f})".format(
             time() - start_time_gain))
+        step_times['gain_compare_obs'] = time() - start_time_gain
     else:
-        logger.info("Skipping comparing banpdass solutions across observations")
+        logger.info("Skipping comparing gain solutions across observations")
+
+    # update the throughputs used to plan later runs
+    learn(task_id, name_cal, base_dir, step_times, search_all_nodes=search_all_nodes)
 
     logger.info(
         "Apertif cross-calibration stability evaluation ... Done ({0:.0f}s)".format(time() - start_time))
+
+
+def find_reference(scan_data, obs_index=None, search_all_nodes=False):
+    """
+    Find the observation of the same calibrator and frequency setup
+    nearest in time to a task, using an ObservationIndex
+
+    The index is built once (per process, or once at all if it is saved
+    to obs_index). Later calls only add the tables of the task and drop
+    or read again the indexed tables that were deleted or written again.
+
+    Args:
+        scan_data (ScanData): data of the task
+        obs_index (str): file with a saved index, updated and saved again
+        search_all_nodes (bool): index the data directories of all nodes
+
+    Returns:
+        ScanData: data of the comparable task, or None
+    """
+    logger = logging.getLogger(__name__)
+    roots = get_data_roots(scan_data.base_dir, search_all_nodes=search_all_nodes)
+    key = obs_index if obs_index is not None else tuple(roots)
+    index = _obs_indexes.get(key)
+    if index is None and obs_index is not None and os.path.exists(obs_index):
+        index = ObservationIndex.load(obs_index)
+        index.roots = roots
+    if index is None:
+        # the whole archive is indexed only once
+        index = ObservationIndex(roots=roots)
+        index.scan()
+    else:
+        index.refresh()
+        index.scan(task_ids=[scan_data.task_id])
+    _obs_indexes[key] = index
+    if obs_index is not None:
+        index.save(obs_index)
+
+    tasks = index.comparable_tasks(scan_data.task_id)
+    if not tasks:
+        logger.warning("No observation found to compare task {} to".format(scan_data.task_id))
+        return None
+    logger.info("Comparing task {0} to task {1}".format(scan_data.task_id, tasks[0]))
+    return ScanData(tasks[0], scan_data.source_name, base_dir=scan_data.base_dir,
+                    search_all_nodes=search_all_nodes)
@@ -0,0 +1,302 @@
+# aperCC: apply reference solutions to calibrator scans
+
+"""
+Apply bandpass and gain solutions to measurement sets with numpy
+
+The solutions are read once (all beams of the reference with one
+concatenated query per kind), interpolated onto the frequency grid and
+the times of every target measurement set, and the visibilities are
+corrected and written to CORRECTED_DATA in chunks of rows:
+
+    V_corr(ij) = V(ij) / (B_i B_j^* g_i g_j^*)
+
+with the receptors of antenna i and j taken from the correlation type
+(XX, XY, YX, YY or RR, RL, LR, LL). Visibilities for which a solution is
+flagged or missing are flagged. Frequencies are interpolated linearly.
+Gains are interpolated linearly in amplitude and phase when the
+solutions cover the times of the measurement set, otherwise (e.g. for
+solutions of another observation) their vector mean is applied.
+
+The beams are corrected in parallel processes, with one process
+instead of one CASA task per beam.
+
+Example:
+    apply_reference(ScanData(ref_task, '3C147'), ScanData(task, '3C147'), processes=8)
+"""
+
+import os
+import logging
+import warnings
+import multiprocessing
+
+import numpy as np
+
+from .Sols import BPSols, GainSols
+from .cube import BandpassCube
+from . import throttle
+from .tableio import update_table, get_antennas, get_frequencies, get_corr_types
+
+logger = logging.getLogger(__name__)
+
+# receptors of antenna 1 and antenna 2 of every correlation type
+# (casacore Stokes codes), receptor 0 is X or R and 1 is Y or L
+CORR_RECEPTORS = {5: (0, 0), 6: (0, 1), 7: (1, 0), 8: (1, 1),
+                  9: (0, 0), 10: (0, 1), 11: (1, 0), 12: (1, 1)}
+
+# approximate maximum memory used for the chunks of visibilities
+MAX_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def corr_receptors(corr_types):
+    """
+    Receptor indices of the two antennas for every correlation
+
+    Returns:
+        tuple: two arrays with the receptor of antenna 1 and antenna 2
+    """
+    try:
+        pairs = [CORR_RECEPTORS[int(c)] for c in corr_types]
+    except KeyError as e:
+        raise ValueError("Unsupported correlation type {}".format(e))
+    return np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs])
+
+
+def antenna_index(sol_ants, ms_ants):
+    """Index of every antenna of the measurement set in the solutions, -1 if missing"""
+    sol_ants = list(sol_ants)
+    return np.array([sol_ants.index(ant) if ant in sol_ants else -1 for ant in ms_ants])
+
+
+def _missing_row(sols, index):
+    """Append a row of NaN for the antennas without solutions (index -1)"""
+    nan = np.full((1,) + sols.shape[1:], np.nan, dtype=sols.dtype)
+    return np.concatenate([sols, nan])[index]
+
+
+def interp_bandpass(bp, freq):
+    """
+    Interpolate bandpass solutions linearly onto a frequency grid
+
+    Args:
+        bp (BPSols): bandpass solutions
+        freq (numpy.ndarray): [chan] frequencies in GHz
+
+    Returns:
+        numpy.ndarray: [ant, chan, pol] complex solutions, NaN where flagged
+            or outside the band of the solutions
+    """
+    sol_freq = np.ravel(bp.freq[0, :])
+    data = np.asarray(bp.data, dtype=np.complex64)
+    if np.array_equal(sol_freq, freq):
+        return data
+    if sol_freq[0] > sol_freq[-1]:
+        sol_freq, data = sol_freq[::-1], data[:, ::-1]
+    pos = np.interp(freq, sol_freq, np.arange(len(sol_freq)), left=np.nan, right=np.nan)
+    outside = ~np.isfinite(pos)
+    pos[outside] = 0.
+    lo = np.minimum(pos.astype(int), len(sol_freq) - 2)
+    w = (pos - lo)[None, :, None]
+    res = data[:, lo] * (1. - w) + data[:, lo + 1] * w
+    # exact hits of a channel do not depend on the next one
+    res = np.where(w == 0, data[:, lo], res)
+    res[:, outside] = np.nan
+    return res.astype(np.complex64)
+
+
+def interp_gains(gains, times, mode='auto'):
+    """
+    Interpolate gain solutions onto times
+
+    Args:
+        gains (GainSols): gain solutions
+        times (numpy.ndarray): [time] times (MJD seconds)
+        mode (str): 'linear' to interpolate amplitude and phase, 'mean' for
+            the vector mean of the solutions, 'auto' for linear if the times
+            are covered by the solutions and mean otherwise
+
+    Returns:
+        numpy.ndarray: [ant, time, pol] complex gains, NaN where flagged
+    """
+    amp = np.asarray(gains.amp, dtype=float)
+    phase = np.radians(np.asarray(gains.phase, dtype=float))
+    sol_times = np.atleast_1d(gains.time)
+    cgains = amp * np.exp(1j * phase)
+    if mode == 'auto':
+        half = 0.5 * np.median(np.diff(sol_times)) if len(sol_times) > 1 else 0.
+        covered = np.min(times) >= sol_times[0] - half and np.max(times) <= sol_times[-1] + half
+        mode = 'linear' if covered else 'mean'
+    if mode == 'mean':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(cgains, axis=1)
+        return np.repeat(mean[:, None, :], len(times), axis=1)
+    if mode != 'linear':
+        raise ValueError("Unknown interpolation mode {}".format(mode))
+
+    if len(sol_times) == 1:
+        return np.repeat(cgains, len(times), axis=1)
+    # interpolate between the unflagged solutions of every antenna and receptor
+    res = np.full((amp.shape[0], len(times), amp.shape[2]), np.nan, dtype=complex)
+    for a in range(amp.shape[0]):
+        for p in range(amp.shape[2]):
+            valid = np.isfinite(amp[a, :, p]) & np.isfinite(phase[a, :, p])
+            if valid.sum() == 0:
+                continue
+            t = sol_times[valid]
+            res[a, :, p] = np.interp(times, t, amp[a, valid, p]) * np.exp(
+                1j * np.interp(times, t, np.unwrap(phase[a, valid, p])))
+    return res
+
+
+def apply_solutions(ms, bp=None, gains=None, datacolumn='DATA', outcolumn='CORRECTED_DATA',
+                    time_interp='auto', max_bytes=MAX_CHUNK_BYTES):
+    """
+    Correct the visibilities of a measurement set with bandpass and gain solutions
+
+    Args:
+        ms (str): path of the measurement set
+        bp (BPSols): bandpass solutions, optional
+        gains (GainSols): gain solutions, optional
+        datacolumn (str): column with the visibilities to correct
+        outcolumn (str): column to write the corrected visibilities to,
+            created if it does not exist
+        time_interp (str): interpolation of the gains, see interp_gains
+        max_bytes (int): approximate maximum memory used per chunk of rows
+
+    Returns:
+        float: fraction of the visibilities flagged after the correction
+    """
+    ms_ants = get_antennas(ms)
+    freq = get_frequencies(ms)[0]
+    p1, p2 = corr_receptors(get_corr_types(ms))
+
+    bpass = None
+    if bp is not None:
+        bpass = _missing_row(interp_bandpass(bp, freq), antenna_index(bp.ants, ms_ants))
+
+    t = update_table(ms)
+    try:
+        if outcolumn not in t.colnames():
+            import casacore.tables as pt
+
+            desc = t.getcoldesc(datacolumn)
+            desc['name'] = outcolumn
+            t.addcols(pt.maketabdesc(pt.makecoldesc(outcolumn, desc)))
+            logger.info("Added column {0} to {1}".format(outcolumn, ms))
+
+        nrow = t.nrows()
+        ncorr = len(p1)
+        chunk = max(1, int(max_bytes // (len(freq) * ncorr * 64)))
+        data = np.empty((min(chunk, nrow), len(freq), ncorr), dtype=np.complex64)
+        flags = np.empty(data.shape, dtype=bool)
+        gain_index = antenna_index(gains.ants, ms_ants) if gains is not None else None
+        nflagged = 0
+        for start in range(0, nrow, chunk):
+            n = min(chunk, nrow - start)
+            a1 = t.getcol('ANTENNA1', start, n)
+            a2 = t.getcol('ANTENNA2', start, n)
+            t.getcolnp(datacolumn, data[:n], start, n)
+            t.getcolnp('FLAG', flags[:n], start, n)
+
+            # [row, chan, corr] product of the solutions of both antennas
+            sols = np.ones(data[:n].shape, dtype=np.complex64)
+            if bpass is not None:
+                sols *= bpass[a1][:, :, p1] * np.conj(bpass[a2][:, :, p2])
+            if gains is not None:
+                times, tindex = np.unique(t.getcol('TIME', start, n), return_inverse=True)
+                g = _missing_row(interp_gains(gains, times, time_interp).astype(np.complex64),
+                                 gain_index)
+                sols *= (g[a1, tindex][:, p1] * np.conj(g[a2, tindex][:, p2]))[:, None, :]
+
+            bad = ~np.isfinite(sols) | (sols == 0)
+            sols[bad] = 1.
+            corrected = data[:n] / sols
+            corrected[bad] = 0.
+            flags[:n] |= bad
+            nflagged += flags[:n].sum()
+            t.putcol(outcolumn, corrected, start, n)
+            t.putcol('FLAG', flags[:n], start, n)
+    finally:
+        t.close()
+    fraction = nflagged / float(max(nrow * len(freq) * ncorr, 1))
+    logger.info("Corrected {0} rows of {1}, {2:.1%} flagged".format(nrow, ms, fraction))
+    return fraction
+
+
+def _apply(args):
+    """Worker applying the solutions of one beam"""
+    ms, bp, gains, kwargs = args
+    try:
+        return apply_solutions(ms, bp=bp, gains=gains, **kwargs)
+    except Exception as e:
+        logger.warning("Could not apply solutions to {}".format(ms))
+        logger.exception(e)
+        return None
+
+
+def apply_beams(jobs, processes=1, **kwargs):
+    """
+    Apply solutions to the measurement sets of many beams in parallel
+
+    Args:
+        jobs (dict): {beam: (ms, BPSols or None, GainSols or None)}
+        processes (int): number of measurement sets corrected at the same time
+        **kwargs: passed on to apply_solutions
+
+    Returns:
+        dict: {beam: flagged fraction}, beams that failed are left out
+    """
+    beams = sorted(jobs)
+    args = [jobs[beam] + (kwargs,) for beam in beams]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=throttle.init_worker,
+                                    initargs=(throttle.settings(),))
+        try:
+            results = pool.map(_apply, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_apply(arg) for arg in args]
+    return dict((beam, res) for beam, res in zip(beams, results) if res is not None)
+
+
+def apply_reference(ref_scandata, scandata, processes=1, **kwargs):
+    """
+    Apply the bandpass and gain solutions of a reference task to the
+    calibrator measurement sets of another task, beam by beam
+
+    Args:
+        ref_scandata (ScanData): task with the solutions
+        scandata (ScanData): task with the measurement sets to correct
+        processes (int): number of beams corrected at the same time
+        **kwargs: passed on to apply_solutions
+
+    Returns:
+        dict: {beam: flagged fraction}
+    """
+    ms_list = scandata.get_ms()
+    if ms_list == -1:
+        return dict()
+    ms_beams = dict((int(os.path.basename(os.path.dirname(os.path.dirname(ms)))), ms)
+                    for ms in ms_list)
+
+    # read the solutions of all beams at once
+    cube = BandpassCube.from_scandata(ref_scandata)
+    gaintables = ref_scandata.get_gaintable()
+    gains = dict()
+    if gaintables != -1:
+        for table, g in zip(gaintables, GainSols.from_tables(gaintables)):
+            gains[int(os.path.basename(os.path.dirname(os.path.dirname(table))))] = g
+
+    jobs = dict()
+    for beam, ms in ms_beams.items():
+        bp = BPSols.from_cube(cube, beam) \
+            if beam in cube.beams and cube.present[cube.beam_index(beam)] else None
+        if bp is None and beam not in gains:
+            logger.warning("No reference solutions for beam {0:02d}".format(beam))
+            continue
+        jobs[beam] = (ms, bp, gains.get(beam))
+    logger.info("Applying the solutions of task {0} to {1} beams of task {2}".format(
+        ref_scandata.task_id, len(jobs), scandata.task_id))
+    return apply_beams(jobs, processes=processes, **kwargs)
@@ -0,0 +1,253 @@
+# aperCC: pooled, concurrent client for the ATDB REST interface
+
+"""
+Look up task metadata in ATDB
+
+AtdbClient keeps persistent HTTP connections in a pool, so a lookup does
+not pay for a new connection (and TLS handshake) every time. It runs up
+to max_connections requests at the same time from a thread pool, retries
+failed requests (connection errors, 5xx and 429 responses) with
+exponential backoff, and caches responses in memory and optionally on
+disk. Paged responses ({'count', 'next', 'results'}) are followed to the
+last page.
+
+The URL of the service defaults to the environment variable ATDB_URL,
+so the client can be pointed at a local stand-in serving canned JSON.
+
+Example:
+    client = AtdbClient(cache_dir='~/.apercc_atdb')
+    meta = client.observations([190601001, 190601002, ...])
+    meta[190601001]['name'], meta[190601001]['central_frequency']
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit, urlencode, urljoin
+    from queue import Queue, Empty
+except ImportError:  # Python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit, urljoin
+    from urllib import urlencode
+    from Queue import Queue, Empty
+
+logger = logging.getLogger(__name__)
+
+ATDB_URL = 'https://atdb.astron.nl/atdb/'
+
+# query of the imaging observations, as used by atdbquery('imaging')
+IMAGING = {'observing_mode__icontains': 'imaging'}
+
+
+class AtdbError(IOError):
+    """A request to ATDB failed"""
+
+
+class _Retry(AtdbError):
+    """A request to ATDB failed in a way that may succeed when retried"""
+
+
+class AtdbClient(object):
+    """
+    Client for the ATDB REST interface
+
+    Args:
+        url (str): base URL of ATDB, default the environment variable
+            ATDB_URL or https://atdb.astron.nl/atdb/
+        max_connections (int): maximum number of requests at the same time,
+            and of connections kept open
+        retries (int): number of times a failed request is retried
+        backoff (float): seconds to wait before the first retry, doubled
+            for every next retry
+        timeout (float): timeout of a request in seconds
+        cache_dir (str): directory to cache responses in between runs, optional
+        cache_ttl (float): seconds a cached response is used, None for ever
+    """
+
+    def __init__(self, url=None, max_connections=8, retries=4, backoff=0.5, timeout=30.,
+                 cache_dir=None, cache_ttl=86400.):
+        if url is None:
+            url = os.environ.get('ATDB_URL', ATDB_URL)
+        self.url = url if url.endswith('/') else url + '/'
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        if self.cache_dir and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.cache_ttl = cache_ttl
+        self._cache = dict()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._connections = Queue()
+
+    def close(self):
+        """Close the pooled connections"""
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except Empty:
+                break
+
+    def _connect(self, scheme, netloc):
+        try:
+            conn = self._connections.get_nowait()
+            if (conn.scheme, conn.netloc) == (scheme, netloc):
+                return conn
+            conn.close()
+        except Empty:
+            pass
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        conn = cls(netloc, timeout=self.timeout)
+        conn.scheme, conn.netloc = scheme, netloc
+        return conn
+
+    def _request(self, url):
+        """One GET request over a pooled connection, returns the JSON or None for 404"""
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        with self._slots:
+            conn = self._connect(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers={'Accept': 'application/json'})
+                response = conn.getresponse()
+                body = response.read()
+            except (HTTPException, socket.error) as e:
+                conn.close()
+                raise _Retry("Request for {0} failed: {1}".format(url, e))
+            if response.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self._connections.put(conn)
+        if response.status == 404:
+            return None
+        if response.status == 429 or response.status >= 500:
+            raise _Retry("Request for {0} returned {1}".format(url, response.status))
+        if response.status >= 400:
+            raise AtdbError("Request for {0} returned {1}".format(url, response.status))
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise _Retry("Request for {0} returned invalid JSON".format(url))
+
+    def _cache_file(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _cached(self, url):
+        with self._lock:
+            if url in self._cache:
+                return True, self._cache[url]
+        if self.cache_dir:
+            filename = self._cache_file(url)
+            if os.path.exists(filename) and (self.cache_ttl is None or
+                                             time.time() - os.path.getmtime(filename) < self.cache_ttl):
+                try:
+                    with open(filename) as f:
+                        res = json.load(f)
+                except ValueError:
+                    return False, None
+                with self._lock:
+                    self._cache[url] = res
+                return True, res
+        return False, None
+
+    def _store(self, url, res):
+        with self._lock:
+            self._cache[url] = res
+        if self.cache_dir:
+            filename = self._cache_file(url)
+            tmp = '{0}.{1}.tmp'.format(filename, threading.current_thread().ident)
+            with open(tmp, 'w') as f:
+                json.dump(res, f)
+            os.rename(tmp, filename)
+
+    def get(self, path, params=None):
+        """
+        GET a path (relative to the base URL, or an absolute URL) with retries and caching
+
+        Args:
+            path (str): e.g. 'observations/'
+            params (dict): query parameters
+
+        Returns:
+            JSON of the response, None if it was not found
+        """
+        url = urljoin(self.url, path)
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(sorted(params.items()))
+        found, res = self._cached(url)
+        if found:
+            return res
+        for attempt in range(self.retries + 1):
+            try:
+                res = self._request(url)
+                break
+            except _Retry as e:
+                if attempt == self.retries:
+                    raise AtdbError("{0}, giving up after {1} retries".format(e, self.retries))
+                wait = self.backoff * 2 ** attempt
+                logger.debug("{0}, retrying in {1:.1f}s".format(e, wait))
+                time.sleep(wait)
+        self._store(url, res)
+        return res
+
+    def query(self, path='observations/', **params):
+        """
+        All results of a query, following the pages
+
+        Returns:
+            list: the results
+        """
+        res = self.get(path, params)
+        if res is None:
+            return []
+        if not isinstance(res, dict) or 'results' not in res:
+            return res if isinstance(res, list) else [res]
+        results = list(res['results'])
+        while res.get('next'):
+            res = self.get(res['next'])
+            if res is None:
+                break
+            results.extend(res['results'])
+        return results
+
+    def observation(self, task_id):
+        """Metadata of a task, or None if ATDB does not know it"""
+        res = self.query(taskID=task_id)
+        return res[0] if res else None
+
+    def map(self, func, items):
+        """Apply a function to items with max_connections threads"""
+        items = list(items)
+        if len(items) <= 1 or self.max_connections <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.max_connections, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def observations(self, task_ids):
+        """
+        Metadata of many tasks, looked up concurrently
+
+        Returns:
+            dict: {task id: metadata}, tasks that ATDB does not know are left out
+        """
+        task_ids = [int(task_id) for task_id in task_ids]
+        results = self.map(self.observation, task_ids)
+        return dict((task_id, res) for task_id, res in zip(task_ids, results) if res is not None)
+
+    def imaging(self):
+        """All imaging observations, like atdbquery('imaging')"""
+        return self.query(**IMAGING)
@@ -0,0 +1,302 @@
+# aperCC: solution cubes covering all beams of a task
+
+"""
+Load the bandpass solutions of all beams of a task into one
+preallocated [beam, ant, chan, pol] cube (and the gain solutions into
+a [beam, ant, time, pol] cube).
+
+The cube is allocated once from the shape of the first table found
+and all beams are read with a single TaQL query over the concatenated
+tables, filled in place with getcolnp, so no per-beam arrays are
+created. Beams without a table are recorded in
+the presence mask and their slices stay NaN with the same shape as
+the real data. Tables whose rows are not one per antenna in antenna
+order are sorted by ANTENNA1 (see soltable.sort_solutions), and tables
+with several solution times are skipped.
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from .tableio import open_table, concat_query, get_antennas, get_frequencies
+from .soltable import sort_solutions
+from .stats import wrap_phase
+from .flags import PackedFlags
+
+logger = logging.getLogger(__name__)
+
+
+class BandpassCube(object):
+    """
+    Bandpass solutions of a set of beams
+
+    Args:
+        tables (dict): {beam number: path to the bandpass table}, paths
+            that do not exist are treated as missing beams
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.beams = np.array(sorted(tables.keys()), dtype=int)
+        self.present = np.zeros(len(self.beams), dtype=bool)
+        self._amp = None
+        self._phase = None
+        self.read_data()
+
+    @classmethod
+    def from_scandata(cls, scandata):
+        """Create the cube for all beam directories of a ScanData object"""
+        tables = dict()
+        for single_dir, beam in zip(scandata.dir_list, scandata.beam_list):
+            tables[int(beam)] = "{0}/raw/{1}.{2}".format(
+                single_dir, scandata.source_name, scandata.bpass_suffix)
+        return cls(tables)
+
+    @staticmethod
+    def _cell_shape(table):
+        """[chan, pol] shape of the solutions in a table, None if it is empty"""
+        if table.nrows() == 0:
+            return None
+        return tuple(table.getcell('CPARAM', 0).shape)
+
+    def _allocate(self, cell_shape, path):
+        """Allocate the cube for tables with solutions of the given [chan, pol] shape"""
+        self.ants = get_antennas(path)
+        self.freq = get_frequencies(path)[0]  # GHz
+        shape = (len(self.beams), len(self.ants)) + cell_shape
+        logger.debug("Allocating bandpass cube of shape {}".format(shape))
+        self.data = np.full(shape, np.nan, dtype=np.complex64)
+        self.flags = np.ones(shape, dtype=bool)
+        self.time = np.full(len(self.beams), np.nan)
+
+    def read_data(self):
+        """Fill the slices of all beams with a table using one concatenated query"""
+        self.data = None
+        valid = []
+        for b, beam in enumerate(self.beams):
+            path = self.tables[beam]
+            if not os.path.isdir(path):
+                logger.info("BP table for beam {0:02d} not present".format(beam))
+                continue
+            cell_shape = self._cell_shape(open_table(path))
+            if cell_shape is None:
+                logger.warning("BP table {0} is empty, skipping it".format(path))
+                continue
+            if self.data is None:
+                self._allocate(cell_shape, path)
+            if cell_shape != self.data.shape[2:]:
+                logger.warning("BP table {0} has a different shape, skipping it".format(path))
+                continue
+            valid.append(b)
+
+        if self.data is None:
+            logger.warning("No bandpass tables found")
+            self.data = np.full((len(self.beams), 0, 0, 0), np.nan, dtype=np.complex64)
+            self.flags = PackedFlags(np.ones(self.data.shape, dtype=bool), axis=2)
+            self.time = np.full(len(self.beams), np.nan)
+            self.ants = ()
+            self.freq = np.zeros(0)
+            return
+
+        t, row_ranges = concat_query([self.tables[self.beams[b]] for b in valid],
+                                     ['TIME', 'ANTENNA1', 'CPARAM', 'FLAG'])
+        times = t.getcol('TIME')
+        ant_col = t.getcol('ANTENNA1')
+        nant = self.data.shape[1]
+        # tables with one row per antenna in antenna order, at a single time
+        ordered = [end - start == nant and np.array_equal(ant_col[start:end], np.arange(nant))
+                   and (times[start:end] == times[start]).all() for start, end in row_ranges]
+        skipped = []
+        if all(ordered) and valid == list(range(valid[0], valid[-1] + 1)):
+            # consecutive beams: read straight into the cube
+            rows = slice(valid[0], valid[-1] + 1)
+            t.getcolnp('CPARAM', self.data[rows].reshape((-1,) + self.data.shape[2:]))
+            t.getcolnp('FLAG', self.flags[rows].reshape((-1,) + self.flags.shape[2:]))
+        else:
+            data = np.empty((len(ant_col),) + self.data.shape[2:], dtype=self.data.dtype)
+            flags = np.empty(data.shape, dtype=bool)
+            t.getcolnp('CPARAM', data)
+            t.getcolnp('FLAG', flags)
+            for b, (start, end), in_order in zip(valid, row_ranges, ordered):
+                if in_order:
+                    self.data[b] = data[start:end]
+                    self.flags[b] = flags[start:end]
+                    continue
+                # other row orders are sorted by antenna like soltable does
+                try:
+                    _, self.data[b], self.flags[b] = sort_solutions(
+                        times[start:end], ant_col[start:end], data[start:end],
+                        flags[start:end], nant, 'chan')
+                except (ValueError, IndexError) as e:
+                    logger.warning("BP table {0} does not fit the cube ({1}), skipping it".format(
+                        self.tables[self.beams[b]], e))
+                    self.data[b] = np.nan
+                    self.flags[b] = True
+                    skipped.append(b)
+        read = [(b, start) for b, (start, end) in zip(valid, row_ranges) if b not in skipped]
+        for b, start in read:
+            self.time[b] = times[start]
+            self.present[b] = True
+
+        # flagged and missing data become NaN, the flags are kept bit-packed
+        self.data[self.flags] = np.nan
+        self.flags = PackedFlags(self.flags, axis=2)
+
+    def beam_index(self, beam):
+        """Index of a beam number along the beam axis"""
+        return int(np.where(self.beams == beam)[0][0])
+
+    @property
+    def amp(self):
+        """[beam, ant, chan, pol] amplitude"""
+        if self._amp is None:
+            self._amp = np.abs(self.data)
+        return self._amp
+
+    @property
+    def phase(self):
+        """[beam, ant, chan, pol] phase in degrees"""
+        if self._phase is None:
+            self._phase = np.angle(self.data, deg=True)
+        return self._phase
+
+    def normalize(self, ref_beam=0):
+        """
+        Divide all beams by a reference beam
+
+        Returns:
+            tuple: [beam, ant, chan, pol] normalized amplitude and
+                phase difference (degrees, wrapped into [-180, 180))
+        """
+        r = self.beam_index(ref_beam)
+        amp_norm = self.amp / self.amp[r]
+        phase_norm = wrap_phase(self.phase - self.phase[r])
+        return amp_norm, phase_norm
+
+    def fit(self, nterms=8, basis='poly'):
+        """
+        Fit smooth models to the amplitude and phase of all beams at once
+
+        Returns:
+            BandpassFit: coefficients of shape [beam, ant, pol, nterms]
+        """
+        from .fitting import fit_bandpass
+
+        return fit_bandpass(self.freq, self.amp, self.phase, nterms=nterms, basis=basis)
+
+    def delays(self, pad=8):
+        """
+        Residual delays of all beams from one batched FFT
+
+        Returns:
+            numpy.ndarray: [beam, ant, pol] delays in ns
+        """
+        from .delays import estimate_delays
+
+        return estimate_delays(self.freq, self.data, pad=pad)[0]
+
+    def share(self):
+        """
+        Publish the cube in shared memory for worker processes
+
+        Returns:
+            SharedCube: descriptor, whose attach gives the cube without copying
+        """
+        from .shared import SharedCube
+
+        return SharedCube(self)
+
+
+class GainCube(object):
+    """
+    Gain solutions of a set of beams
+
+    The amplitude and phase (degrees) have the shape [beam, ant, time, pol]
+    and time (MJD seconds) the shape [beam, time]. Every beam is a
+    separate scan with its own solution times, so the time axis has the
+    length of the longest beam and shorter beams are padded with NaN.
+
+    Args:
+        tables (dict): {beam number: path to the gain table}, paths that
+            do not exist are treated as missing beams
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.beams = np.array(sorted(tables.keys()), dtype=int)
+        self.present = np.zeros(len(self.beams), dtype=bool)
+        self.read_data()
+
+    @classmethod
+    def from_scandata(cls, scandata):
+        """Create the cube for all beam directories of a ScanData object"""
+        tables = dict()
+        for single_dir, beam in zip(scandata.dir_list, scandata.beam_list):
+            tables[int(beam)] = "{0}/raw/{1}.{2}".format(
+                single_dir, scandata.source_name, scandata.gaintable_suffix)
+        return cls(tables)
+
+    def read_data(self):
+        """Read all beams with one concatenated query and stack them"""
+        from .Sols import GainSols
+
+        paths = [self.tables[beam] for beam in self.beams]
+        sols = [g if os.path.isdir(path) else None
+                for path, g in zip(paths, GainSols.from_tables(paths))]
+        first = next((g for g in sols if g is not None), None)
+        if first is None:
+            logger.warning("No gain tables found")
+            self.ants = ()
+            self.amp = np.full((len(self.beams), 0, 0, 0), np.nan)
+            self.phase = np.full(self.amp.shape, np.nan)
+            self.time = np.full((len(self.beams), 0), np.nan)
+            return
+
+        self.ants = first.ants
+        ntime = max(len(g.time) for g in sols if g is not None)
+        shape = (len(self.beams), len(self.ants), ntime, first.amp.shape[2])
+        logger.debug("Allocating gain cube of shape {}".format(shape))
+        self.amp = np.full(shape, np.nan)
+        self.phase = np.full(shape, np.nan)
+        self.time = np.full((len(self.beams), ntime), np.nan)
+        for b, g in enumerate(sols):
+            if g is None:
+                logger.info("Gain table for beam {0:02d} not present".format(self.beams[b]))
+                continue
+            if list(g.ants) != list(self.ants) or g.amp.shape[2] != shape[3]:
+                logger.warning("Gain table {0} has different antennas or polarisations, "
+                               "skipping it".format(g.gaintable))
+                continue
+            n = len(g.time)
+            self.amp[b, :, :n] = g.amp
+            self.phase[b, :, :n] = g.phase
+            self.time[b, :n] = g.time
+            self.present[b] = True
+
+    def beam_index(self, beam):
+        """Index of a beam number along the beam axis"""
+        return int(np.where(self.beams == beam)[0][0])
+
+    def align(self, mode='hourangle', grid=None, **kwargs):
+        """
+        Resample all beams onto one grid of hour angle, sidereal time or
+        time since the start, see sidereal.align_cubes
+
+        Returns:
+            tuple: grid and [beam, ant, grid, pol] amplitude and phase
+        """
+        from .sidereal import align_cubes
+
+        grid, amps, phases = align_cubes([self], mode=mode, grid=grid, **kwargs)
+        return grid, amps[0], phases[0]
+
+    def spectra(self, **kwargs):
+        """
+        Power spectra of the gain fluctuations of all beams at once,
+        see spectra.gain_spectra
+        """
+        from .spectra import gain_spectra
+
+        return gain_spectra(self, **kwargs)
@@ -0,0 +1,101 @@
+# aperCC: residual delays from complex bandpass solutions
+
+"""
+Estimate residual delays from complex bandpass solutions
+
+A residual delay shows up as a linear phase slope over frequency. For
+all spectra of a task (beam x antenna x correlation) at once, the
+flag-aware complex bandpass is Fourier transformed over frequency with
+zero padding, the peak of the delay spectrum is located and refined to
+a fraction of a bin with a parabola through the peak and its
+neighbours. This gives one number per spectrum to trend, which can be
+tracked per beam across observations in the metric store.
+
+Example:
+    delays, peak = estimate_delays(cube.freq, cube.data)
+    store_delays(cube, task_id, '3C147', store)
+"""
+
+import logging
+
+import numpy as np
+
+from .metrics import corr_names
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_delays(freq, data, flags=None, pad=8):
+    """
+    Estimate delays of many complex spectra with one zero-padded FFT
+
+    Args:
+        freq (numpy.ndarray): [chan] channel frequencies in GHz, evenly spaced
+        data (numpy.ndarray): [..., chan, pol] complex solutions, NaN where flagged
+        flags (numpy.ndarray): optional [..., chan, pol] flags
+        pad (int): zero padding factor of the FFT
+
+    Returns:
+        tuple: [..., pol] delays in ns and [..., pol] peak amplitude of the
+            delay spectrum relative to the mean amplitude of the valid channels
+            (1 for a pure delay, lower for noisy or non-linear phases).
+            Spectra without valid channels get NaN.
+    """
+    freq = np.ravel(freq)
+    nchan = len(freq)
+    x = np.moveaxis(np.asarray(data), -2, -1)
+    valid = np.isfinite(x)
+    if flags is not None:
+        valid &= ~np.moveaxis(flags, -2, -1)
+    # only the phases matter, flagged channels get zero weight
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.where(valid, x / np.abs(x), 0.)
+    x[~np.isfinite(x)] = 0.
+
+    nfft = 1
+    while nfft < pad * nchan:
+        nfft *= 2
+    spec = np.abs(np.fft.fft(x, n=nfft, axis=-1))
+
+    peak = np.argmax(spec, axis=-1)
+    # parabola through the peak and its neighbours (circular)
+    y0 = np.take_along_axis(spec, ((peak - 1) % nfft)[..., None], axis=-1)[..., 0]
+    y1 = np.take_along_axis(spec, peak[..., None], axis=-1)[..., 0]
+    y2 = np.take_along_axis(spec, ((peak + 1) % nfft)[..., None], axis=-1)[..., 0]
+    denom = y0 - 2. * y1 + y2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(denom < 0, 0.5 * (y0 - y2) / denom, 0.)
+    k = peak + offset
+    k = np.where(k > nfft / 2., k - nfft, k)
+
+    chan_width = np.median(np.diff(freq))  # GHz
+    delays = k / (nfft * chan_width)  # ns
+    nvalid = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        strength = y1 / nvalid
+    delays[nvalid == 0] = np.nan
+    strength[nvalid == 0] = np.nan
+    logger.debug("Estimated delays of {0} spectra with a {1} point FFT".format(
+        nvalid.size, nfft))
+    return delays, strength
+
+
+def store_delays(cube, task_id, source, store, pad=8):
+    """
+    Estimate the delays of all beams of a BandpassCube and append them
+    to a MetricStore as metric 'bp_delay' (ns)
+
+    Returns:
+        numpy.ndarray: [beam, ant, pol] delays in ns
+    """
+    delays, _ = estimate_delays(cube.freq, cube.data, pad=pad)
+    corrs = corr_names(delays.shape[-1]) if delays.size else []
+    for b, beam in enumerate(cube.beams):
+        if not cube.present[b]:
+            continue
+        records = [('bp_delay', ant, corr, float(delays[b, a, c]))
+                   for a, ant in enumerate(cube.ants)
+                   for c, corr in enumerate(corrs)
+                   if np.isfinite(delays[b, a, c])]
+        store.append(records, task_id, source, beam, cube.time[b])
+    return delays
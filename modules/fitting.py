@@ -0,0 +1,252 @@
+# aperCC: low-order fits of bandpass solutions
+
+"""
+Fit smooth models to bandpass amplitudes and phases
+
+For every beam/antenna/correlation a polynomial (Legendre) or cubic
+B-spline model is fitted to the amplitude and the unwrapped phase.
+All spectra on the same frequency grid share one design matrix and are
+solved together in one batched weighted least-squares problem, with
+flagged channels getting zero weight. Only the coefficients and the
+residual statistics are kept, so comparing observations works on a
+handful of numbers per spectrum instead of all channels.
+
+Example:
+    fit = fit_bandpass(cube.freq, cube.amp, cube.phase, nterms=8)
+    rms = rms_difference(fit, ref_fit)
+"""
+
+import logging
+
+import numpy as np
+
+from .stats import wrap_phase
+
+logger = logging.getLogger(__name__)
+
+_design_cache = dict()
+
+
+def _bspline_basis(x, nterms, degree=3):
+    """Cubic B-spline basis with uniform knots on [-1, 1], shape [chan, nterms]"""
+    inner = np.linspace(-1., 1., nterms - degree + 1)
+    knots = np.concatenate([[-1.] * degree, inner, [1.] * degree])
+    # degree 0: indicator of the knot interval, the last interval includes 1
+    basis = np.zeros((len(x), len(knots) - 1))
+    for i in range(len(knots) - 1):
+        if knots[i] < knots[i + 1]:
+            basis[:, i] = (x >= knots[i]) & (x < knots[i + 1])
+    basis[x >= 1., np.searchsorted(knots, 1.) - 1] = 1.
+    for d in range(1, degree + 1):
+        new = np.zeros((len(x), len(knots) - 1 - d))
+        for i in range(len(knots) - 1 - d):
+            left = knots[i + d] - knots[i]
+            right = knots[i + d + 1] - knots[i + 1]
+            if left > 0:
+                new[:, i] += (x - knots[i]) / left * basis[:, i]
+            if right > 0:
+                new[:, i] += (knots[i + d + 1] - x) / right * basis[:, i + 1]
+        basis = new
+    return basis
+
+
+def design_matrix(freq, nterms, basis='poly'):
+    """
+    Design matrix of the model for a frequency grid
+
+    The frequencies are mapped onto [-1, 1]. Matrices are cached per
+    grid, number of terms and basis.
+
+    Args:
+        freq (numpy.ndarray): channel frequencies
+        nterms (int): number of coefficients
+        basis (str): 'poly' for Legendre polynomials or 'spline' for
+            cubic B-splines (nterms >= 4)
+
+    Returns:
+        numpy.ndarray: read-only [chan, nterms] matrix
+    """
+    freq = np.asarray(freq, dtype=float)
+    key = (freq.tobytes(), nterms, basis)
+    if key not in _design_cache:
+        x = 2. * (freq - freq.min()) / (freq.max() - freq.min()) - 1.
+        if basis == 'poly':
+            matrix = np.polynomial.legendre.legvander(x, nterms - 1)
+        elif basis == 'spline':
+            if nterms < 4:
+                raise ValueError("A cubic spline basis needs at least 4 terms")
+            matrix = _bspline_basis(x, nterms)
+        else:
+            raise ValueError("Unknown basis {}".format(basis))
+        matrix.flags.writeable = False
+        _design_cache[key] = matrix
+    return _design_cache[key]
+
+
+def unwrap_phase(phase, axis=-1):
+    """
+    Unwrap phases in degrees along an axis, skipping NaNs
+
+    NaNs stay NaN, the phases after a gap continue from the last valid one.
+    """
+    phase = np.moveaxis(np.asarray(phase, dtype=float), axis, -1)
+    valid = np.isfinite(phase)
+    # carry the last valid value into the gaps, so they add no jumps
+    idx = np.where(valid, np.arange(phase.shape[-1]), 0)
+    np.maximum.accumulate(idx, axis=-1, out=idx)
+    filled = np.take_along_axis(np.where(valid, phase, 0.), idx, axis=-1)
+    unwrapped = np.degrees(np.unwrap(np.radians(filled), axis=-1))
+    unwrapped[~valid] = np.nan
+    return np.moveaxis(unwrapped, -1, axis)
+
+
+def fit_spectra(design, data, weights=None):
+    """
+    Weighted least-squares fit of many spectra with a shared design matrix
+
+    Args:
+        design (numpy.ndarray): [chan, nterms] design matrix
+        data (numpy.ndarray): [..., chan] spectra, NaNs get zero weight
+        weights (numpy.ndarray): [..., chan] weights, default 1
+
+    Returns:
+        tuple: [..., nterms] coefficients, [..., ] weighted residual rms and
+            [..., ] number of channels used. Spectra that do not constrain
+            all coefficients (fewer channels than coefficients, or flagged
+            gaps that leave a spline term without data) get NaN.
+    """
+    nchan, nterms = design.shape
+    shape = data.shape[:-1]
+    y = data.reshape(-1, nchan)
+    w = np.ones(y.shape) if weights is None else \
+        np.broadcast_to(weights, data.shape).reshape(-1, nchan).astype(float)
+    valid = np.isfinite(y) & (w > 0)
+    w = np.where(valid, w, 0.)
+    y = np.where(valid, y, 0.)
+
+    # normal equations of all spectra with two matrix products
+    outer = (design[:, :, None] * design[:, None, :]).reshape(nchan, nterms * nterms)
+    normal = np.dot(w, outer).reshape(-1, nterms, nterms)
+    rhs = np.dot(w * y, design)
+
+    nvalid = valid.sum(axis=-1)
+    # a basis function without weight leaves its coefficient free
+    constrained = np.dot(w, design ** 2) > 0
+    good = (nvalid >= nterms) & constrained.all(axis=-1)
+    coeffs = np.full((len(y), nterms), np.nan)
+    if good.any():
+        try:
+            coeffs[good] = np.linalg.solve(normal[good], rhs[good][:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            # some other system is singular, solve them one by one
+            for i in np.where(good)[0]:
+                try:
+                    coeffs[i] = np.linalg.solve(normal[i], rhs[i])
+                except np.linalg.LinAlgError:
+                    good[i] = False
+            logger.debug("{} spectra could not be fitted".format(
+                np.sum((nvalid >= nterms) & ~good)))
+
+    resid = np.where(valid, y - np.dot(np.nan_to_num(coeffs), design.T), 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms = np.sqrt((w * resid ** 2).sum(axis=-1) / w.sum(axis=-1))
+    rms[~good] = np.nan
+
+    return (coeffs.reshape(shape + (nterms,)), rms.reshape(shape),
+            nvalid.reshape(shape))
+
+
+class BandpassFit(object):
+    """
+    Coefficients and residual statistics of bandpass fits
+
+    The arrays have the leading axes of the input without the channel
+    axis, i.e. [beam, ant, pol] for a cube and [ant, pol] for BPSols,
+    with the coefficients along an extra last axis.
+    """
+
+    def __init__(self, freq, nterms, basis, amp_coeffs, amp_rms,
+                 phase_coeffs, phase_rms, nvalid):
+        self.freq = np.array(freq, dtype=float)
+        self.freq_range = (float(np.min(freq)), float(np.max(freq)))
+        self.nterms = nterms
+        self.basis = basis
+        self.amp_coeffs = amp_coeffs
+        self.amp_rms = amp_rms
+        self.phase_coeffs = phase_coeffs
+        self.phase_rms = phase_rms
+        self.nvalid = nvalid
+        # Gram matrix of the basis on the fitted grid, to compare models
+        # through their coefficients
+        design = design_matrix(freq, nterms, basis)
+        self.gram = np.dot(design.T, design) / len(design)
+
+    def evaluate(self, freq):
+        """Return the [..., chan] amplitude and phase models on a grid inside the fitted band"""
+        freq = np.asarray(freq, dtype=float)
+        x = 2. * (freq - self.freq_range[0]) / (self.freq_range[1] - self.freq_range[0]) - 1.
+        if self.basis == 'poly':
+            design = np.polynomial.legendre.legvander(x, self.nterms - 1)
+        else:
+            design = _bspline_basis(x, self.nterms)
+        return np.dot(self.amp_coeffs, design.T), np.dot(self.phase_coeffs, design.T)
+
+
+def fit_bandpass(freq, amp, phase, nterms=8, basis='poly', weights=None):
+    """
+    Fit all bandpass spectra at once
+
+    Args:
+        freq (numpy.ndarray): channel frequencies (any unit)
+        amp (numpy.ndarray): [..., chan, pol] amplitudes, NaN where flagged
+        phase (numpy.ndarray): [..., chan, pol] phases in degrees, NaN where flagged
+        nterms (int): number of coefficients per spectrum
+        basis (str): 'poly' or 'spline'
+        weights (numpy.ndarray): optional [..., chan, pol] weights
+
+    Returns:
+        BandpassFit: fits of amplitude and unwrapped phase, [..., pol] spectra
+    """
+    freq = np.ravel(freq)
+    design = design_matrix(freq, nterms, basis)
+    amp = np.moveaxis(np.asarray(amp, dtype=float), -2, -1)
+    phase = unwrap_phase(np.moveaxis(np.asarray(phase, dtype=float), -2, -1))
+    if weights is not None:
+        weights = np.moveaxis(weights, -2, -1)
+
+    amp_coeffs, amp_rms, nvalid = fit_spectra(design, amp, weights)
+    phase_coeffs, phase_rms, _ = fit_spectra(design, phase, weights)
+    logger.debug("Fitted {0} spectra with {1} {2} terms".format(
+        nvalid.size, nterms, basis))
+    return BandpassFit(freq, nterms, basis, amp_coeffs, amp_rms,
+                       phase_coeffs, phase_rms, nvalid)
+
+
+def rms_difference(fit, ref):
+    """
+    RMS difference over the band between two sets of fitted models
+
+    The amplitude difference is computed from the coefficients only. The
+    phase models keep the absolute level of the unwrapped phase, which
+    can differ by multiples of 360 degrees for phases that are close, so
+    the phase difference is wrapped per channel of the fitted grid.
+
+    Args:
+        fit, ref (BandpassFit): fits with the same basis, number of terms
+            and frequency range (the coefficients of fits over different
+            ranges belong to differently scaled frequencies)
+
+    Returns:
+        tuple: [..., pol] rms difference of the amplitude and phase models
+    """
+    if (fit.basis, fit.nterms) != (ref.basis, ref.nterms):
+        raise ValueError("Fits with different models cannot be compared")
+    if not np.allclose(fit.freq_range, ref.freq_range, rtol=1e-9, atol=0.):
+        raise ValueError("Fits over different frequency ranges {0} and {1} cannot be "
+                         "compared, fit them on a common grid".format(fit.freq_range,
+                                                                      ref.freq_range))
+    d = fit.amp_coeffs - ref.amp_coeffs
+    amp_rms = np.sqrt(np.einsum('...k,kl,...l->...', d, fit.gram, d))
+    d = wrap_phase(fit.evaluate(fit.freq)[1] - ref.evaluate(fit.freq)[1])
+    phase_rms = np.sqrt(np.mean(d ** 2, axis=-1))
+    return amp_rms, phase_rms
@@ -0,0 +1,155 @@
+# aperCC: bit-packed flags and flag statistics
+
+"""
+Store flags with one bit per value and compute flag occupancy on the packed form
+
+The solutions of a task have flags of shape [ant, chan|time, pol] (or
+[beam, ant, chan, pol] for a cube). PackedFlags keeps them packed along
+the channel/time axis with numpy.packbits, which takes an eighth of the
+memory of a boolean array and keeps pickled caches small. Flag counts
+and fractions per axis are computed on the packed bytes with a popcount
+table (summing over the packed axis) or with eight bit planes (keeping
+the packed axis), so the flags never have to be unpacked.
+
+Example:
+    sol = BPSols(table)
+    sol.flags.occupancy(keep=1)      # flagged fraction per channel
+    sol.flags.occupancy(keep=(0, 2))  # per antenna and correlation
+    task_ids, fractions = flag_trend({task_id: sol.flags, ...}, keep=0)
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# number of set bits of every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class PackedFlags(object):
+    """
+    Boolean flags packed to one bit per value
+
+    Args:
+        flags (numpy.ndarray): boolean flags
+        axis (int): axis along which the flags are packed, usually the
+            channel or time axis
+    """
+
+    def __init__(self, flags, axis=-2):
+        flags = np.asarray(flags, dtype=bool)
+        self.shape = flags.shape
+        self.axis = axis % flags.ndim
+        self.packed = np.packbits(np.moveaxis(flags, self.axis, -1), axis=-1)
+
+    @classmethod
+    def from_nan(cls, data, axis=-2):
+        """Flags of the NaN values of an array"""
+        return cls(~np.isfinite(data), axis=axis)
+
+    @classmethod
+    def _from_packed(cls, packed, shape, axis):
+        flags = cls.__new__(cls)
+        flags.packed = packed
+        flags.shape = shape
+        flags.axis = axis
+        return flags
+
+    def __getitem__(self, index):
+        """Flags of one index of the first axis, e.g. one beam of a cube"""
+        if self.axis == 0:
+            raise IndexError("Cannot index the packed axis")
+        return self._from_packed(self.packed[index], self.shape[1:], self.axis - 1)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def unpack(self):
+        """Return the flags as a boolean array"""
+        flags = np.unpackbits(self.packed, axis=-1)[..., :self.shape[self.axis]]
+        return np.moveaxis(flags.astype(bool), -1, self.axis)
+
+    def count(self, keep=None):
+        """
+        Number of flagged values per index of the kept axes
+
+        Args:
+            keep (int or tuple): axes to keep, all other axes are summed
+                over. None for the total number.
+
+        Returns:
+            numpy.ndarray: counts with the kept axes in their original order
+        """
+        if keep is None:
+            return int(_POPCOUNT[self.packed].sum(dtype=np.int64))
+        keep = sorted(set(np.atleast_1d(keep) % self.ndim))
+        # the packed array has the other axes in order and the packed axis last
+        order = [ax for ax in range(self.ndim) if ax != self.axis] + [self.axis]
+        summed = tuple(i for i, ax in enumerate(order[:-1]) if ax not in keep)
+        if self.axis not in keep:
+            return _POPCOUNT[self.packed].sum(axis=summed + (self.ndim - 1,), dtype=np.int64)
+
+        # keep the packed axis: count every bit plane separately
+        nbits = self.packed.shape[-1] * 8
+        counts = np.zeros(tuple(self.shape[ax] for ax in order[:-1] if ax in keep) +
+                          (nbits,), dtype=np.int64)
+        for bit in range(8):
+            plane = (self.packed >> (7 - bit)) & 1
+            counts[..., bit::8] = plane.sum(axis=summed, dtype=np.int64)
+        counts = counts[..., :self.shape[self.axis]]
+        # put the packed axis back among the kept axes
+        return np.moveaxis(counts, -1, keep.index(self.axis))
+
+    def occupancy(self, keep=None):
+        """Fraction of flagged values per index of the kept axes, see count"""
+        counts = self.count(keep)
+        if keep is None:
+            return counts / float(self.size) if self.size else np.nan
+        keep = set(np.atleast_1d(keep) % self.ndim)
+        n = np.prod([self.shape[ax] for ax in range(self.ndim) if ax not in keep])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return counts / float(n)
+
+
+def flag_trend(flags, keep=None):
+    """
+    Flagged fractions of many tasks
+
+    Args:
+        flags (dict): {task id: PackedFlags}, usually with the same shape for every task
+        keep (int or tuple): axes to keep, see PackedFlags.count
+
+    Returns:
+        tuple: sorted task ids and a [task, ...] array of flagged fractions
+            (NaN for tasks whose flags do not have the most common shape)
+    """
+    task_ids = sorted(flags)
+    if not task_ids:
+        return task_ids, np.array([])
+    shapes = [flags[task_id].shape for task_id in task_ids]
+    shape = max(set(shapes), key=shapes.count)
+    fractions = []
+    for task_id in task_ids:
+        if flags[task_id].shape == shape:
+            fractions.append(flags[task_id].occupancy(keep))
+        else:
+            logger.warning("Flags of task {0} have shape {1} instead of {2}".format(
+                task_id, flags[task_id].shape, shape))
+            fractions.append(None)
+    template = next(f for f in fractions if f is not None)
+    return task_ids, np.array([f if f is not None else np.full(np.shape(template), np.nan)
+                               for f in fractions])
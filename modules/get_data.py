@@ -8,18 +8,27 @@ Functions related to getting data
 for looking at crosscal solution stability
 """
 
-from atdbquery import atdbquery
 from datetime import datetime
 
-def get_cal_scan_dict(centfreq,maxint=7,nskip=1,nswitch=30):
+def get_cal_scan_dict(centfreq,maxint=7,nskip=1,nswitch=30,client=None):
     """Use atdbquery to find all scans that are part of calibrator set
     Only include scans with correct centfreq
     Assume duration up to maxint minutes
     Can skip up to one scan (lost due to specification issues)
     And want at least nswitch scans (most of a set)
+
+    Queries ATDB with an AtdbClient if given (see atdb.py),
+    otherwise with atdbquery
+
+    Returns a dictionary {first taskid of set: [[taskid, name, beam], ...]}
+    where every value can be used as cal_list for apercc
     """
     #query atdb
-    allscans = atdbquery('imaging')
+    if client is not None:
+        allscans = client.imaging()
+    else:
+        from atdbquery import atdbquery
+        allscans = atdbquery('imaging')
     #set up lists to hold taskids and names
     scanlist=[]
     namelist=[]
@@ -33,7 +42,7 @@ def get_cal_scan_dict(centfreq,maxint=7,nskip=1,nswitch=30):
         endtime = scan['endtime']
         try:
             s1 = datetime.strptime(starttime,'%Y-%m-%dT%H:%M:%SZ')
-            s2 = = datetime.strptime(endtime,'%Y-%m-%dT%H:%M:%SZ')
+            s2 = datetime.strptime(endtime,'%Y-%m-%dT%H:%M:%SZ')
             length = s2-s1
         except TypeError:
             continue #restart loop if time is not string
@@ -55,5 +64,57 @@ def get_cal_scan_dict(centfreq,maxint=7,nskip=1,nswitch=30):
         #break name down
         name_split = name.split('_')
         #check for name structure and skip if not right:
-        if len(name_split) == 2:
-            
+        if len(name_split) != 2:
+            continue
+        try:
+            beam = int(name_split[1])
+        except ValueError:
+            continue
+        #a set continues if the source is the same
+        #and at most nskip scans are missing since the previous one
+        if (len(tmpscanlist) > 0 and
+                name_split[0] == tmpnamelist[-1].split('_')[0] and
+                int(scan) - int(tmpscanlist[-1]) <= nskip + 1):
+            tmpscanlist.append(scan)
+            tmpnamelist.append(name)
+            tmpobslist.append([int(scan), name, beam])
+        else:
+            #close the previous set, keep it if it is (most of) a full set
+            if len(tmpobslist) >= nswitch:
+                switching_scan_dict[int(tmpscanlist[0])] = tmpobslist
+            tmpscanlist = [scan]
+            tmpnamelist = [name]
+            tmpobslist = [[int(scan), name, beam]]
+
+    #and the last set
+    if len(tmpobslist) >= nswitch:
+        switching_scan_dict[int(tmpscanlist[0])] = tmpobslist
+
+    return switching_scan_dict
+
+
+def get_task_metadata(task_ids,client=None):
+    """Look up the calibrator name, beam, times and frequency of many tasks
+    concurrently in ATDB
+
+    Returns a dictionary {taskid: {'name', 'beam', 'starttime', 'endtime',
+    'central_frequency'}}, the beam is None if the name has no beam suffix
+    and tasks that ATDB does not know are left out
+    """
+    from .atdb import AtdbClient
+
+    if client is None:
+        client = AtdbClient()
+    metadata = {}
+    for taskid, obs in client.observations(task_ids).items():
+        name_split = str(obs.get('name', '')).split('_')
+        try:
+            beam = int(name_split[1]) if len(name_split) == 2 else None
+        except ValueError:
+            beam = None
+        metadata[taskid] = {'name': obs.get('name'),
+                            'beam': beam,
+                            'starttime': obs.get('starttime'),
+                            'endtime': obs.get('endtime'),
+                            'central_frequency': obs.get('central_frequency')}
+    return metadata
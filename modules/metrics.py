@@ -0,0 +1,281 @@
+# aperCC: stability metrics derived from cross-calibration solutions
+
+"""
+Functions to reduce bandpass and gain solutions to a handful of
+stability metrics per antenna and correlation.
+
+The metrics are computed relative to a reference solution
+(usually beam 00 of the same task) and are the numbers that end up in
+the metric store (see metricstore.py) for trending.
+"""
+
+import os
+import logging
+import warnings
+
+import numpy as np
+
+from .Sols import BPSols, GainSols
+from .cube import BandpassCube
+from .stats import circular_std, find_outliers
+
+logger = logging.getLogger(__name__)
+
+# names of the correlations for 2 and 4 polarisation products
+CORR_NAMES = {1: ['XX'],
+              2: ['XX', 'YY'],
+              4: ['XX', 'XY', 'YX', 'YY']}
+
+
+def corr_names(npol):
+    """Return the correlation labels for a given number of polarisations"""
+    return CORR_NAMES.get(npol, ['P{}'.format(p) for p in range(npol)])
+
+
+def _records(names, ants, corrs, values):
+    """Flatten {metric: [ant, corr] array} into (metric, ant, corr, value) tuples"""
+    records = []
+    for name, arr in zip(names, values):
+        for a, ant in enumerate(ants):
+            for c, corr in enumerate(corrs):
+                val = arr[a, c]
+                if np.isfinite(val):
+                    records.append((name, ant, corr, float(val)))
+    return records
+
+
+def bandpass_metrics(bp, ref):
+    """
+    Stability metrics of a bandpass normalized by a reference bandpass
+
+    Args:
+        bp (BPSols): bandpass solutions
+        ref (BPSols): reference bandpass solutions, e.g. beam 00
+
+    Returns:
+        list: (metric, ant, corr, value) tuples with the RMS of the
+            normalized amplitude ('bp_amp_rms') and phase ('bp_phase_rms')
+    """
+    # the channels may differ, the reference is regridded by normalize
+    if bp.amp.shape[::2] != ref.amp.shape[::2]:
+        logger.warning("Cannot compute bandpass metrics for shapes {} and {}".format(
+            bp.amp.shape, ref.amp.shape))
+        return []
+    amp_norm, phase_norm = bp.normalize(ref)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        amp_rms = np.nanstd(amp_norm, axis=1)
+    # circular, so phase differences around +/-180 degrees do not count as scatter
+    phase_rms = circular_std(phase_norm, axis=1)
+    return _records(['bp_amp_rms', 'bp_phase_rms'], bp.ants,
+                    corr_names(amp_norm.shape[-1]), [amp_rms, phase_rms])
+
+
+def gain_metrics(g, ref, align='start'):
+    """
+    Stability metrics of gains normalized by reference gains
+
+    Args:
+        g (GainSols): gain solutions
+        ref (GainSols): reference gain solutions, e.g. beam 00
+        align (str): alignment of the solution times, 'start', 'hourangle'
+            or 'lst', see GainSols.normalize
+
+    Returns:
+        list: (metric, ant, corr, value) tuples with the scatter of the
+            gain amplitude ratio ('gain_amp_scatter') and of the phase
+            difference ('gain_phase_scatter')
+    """
+    if g.amp.shape[0] != ref.amp.shape[0]:
+        logger.warning("Cannot compute gain metrics for shapes {} and {}".format(
+            g.amp.shape, ref.amp.shape))
+        return []
+    t, amp_norm, phase_norm = g.normalize(ref, align=align)
+    amp_norm = np.asarray(amp_norm, dtype=float)
+    phase_norm = np.asarray(phase_norm, dtype=float)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        amp_scatter = np.nanstd(amp_norm, axis=1)
+    phase_scatter = circular_std(phase_norm, axis=1)
+    return _records(['gain_amp_scatter', 'gain_phase_scatter'], g.ants,
+                    corr_names(amp_norm.shape[-1]), [amp_scatter, phase_scatter])
+
+
+def compare_beams(scandata, kind='bpass', ref_beam=0, store=None, cube=None):
+    """
+    Compute the stability metrics of all beams of a task relative to a reference beam
+
+    Args:
+        scandata (ScanData): data of the task
+        kind (str): 'bpass' for bandpass or 'gain' for gain solutions
+        ref_beam (int): beam used as reference, default 00
+        store (MetricStore): if given, the metrics are appended to it
+        cube (BandpassCube): bandpass solutions of the task if already read
+
+    Returns:
+        dict: {beam: list of (metric, ant, corr, value)}
+    """
+    if kind == 'bpass':
+        # all beams are read at once into a single cube
+        if cube is None:
+            cube = BandpassCube.from_scandata(scandata)
+        if not cube.present.any() or ref_beam not in cube.beams:
+            logger.warning("No bpass solutions to compare for task {0}".format(
+                scandata.task_id))
+            return dict()
+        ref = BPSols.from_cube(cube, ref_beam)
+        sols = [(beam, BPSols.from_cube(cube, beam))
+                for beam in cube.beams[cube.present].tolist()]
+        metric_func = bandpass_metrics
+    elif kind == 'gain':
+        ref_table, tables = scandata.get_gaintable(ref_beam), scandata.get_gaintable()
+        if ref_table == -1 or tables == -1:
+            logger.warning("No gain solutions to compare for task {0}".format(
+                scandata.task_id))
+            return dict()
+        ref = GainSols(ref_table)
+        sols = [(int(os.path.basename(os.path.dirname(os.path.dirname(table)))), g)
+                for table, g in zip(tables, GainSols.from_tables(tables))]
+        metric_func = gain_metrics
+    else:
+        raise ValueError("Unknown solution kind {}".format(kind))
+
+    res = dict()
+    for beam, sol in sols:
+        records = metric_func(sol, ref)
+        res[beam] = records
+        if store is not None:
+            store.append(records, scandata.task_id, scandata.source_name,
+                         beam, sol.time[0])
+    return res
+
+
+def compare_observations(scandata, ref_scandata, kind='bpass', store=None, align='start'):
+    """
+    Compute the stability metrics of every beam of a task relative to
+    the same beam of a reference task
+
+    The metric names get the prefix 'obs_' to keep them apart from the
+    comparisons between beams of one task.
+
+    Args:
+        scandata (ScanData): data of the task
+        ref_scandata (ScanData): data of the reference task
+        kind (str): 'bpass' for bandpass or 'gain' for gain solutions
+        store (MetricStore): if given, the metrics are appended to it
+        align (str): alignment of the gain solutions, 'start' for the time
+            since the first solution, 'hourangle' or 'lst' to compare the
+            gains at the same position of the calibrator on the sky
+
+    Returns:
+        dict: {beam: list of (metric, ant, corr, value)}
+    """
+    if kind == 'bpass':
+        cube = BandpassCube.from_scandata(scandata)
+        ref_cube = BandpassCube.from_scandata(ref_scandata)
+        beams = sorted(set(cube.beams[cube.present].tolist()) &
+                       set(ref_cube.beams[ref_cube.present].tolist()))
+        pairs = [(beam, BPSols.from_cube(cube, beam), BPSols.from_cube(ref_cube, beam))
+                 for beam in beams]
+        metric_func = bandpass_metrics
+    elif kind == 'gain':
+        pairs = []
+        for beam in scandata.beam_list:
+            table = scandata.get_gaintable(int(beam))
+            ref_table = ref_scandata.get_gaintable(int(beam))
+            if table != -1 and ref_table != -1:
+                pairs.append((int(beam), GainSols(table), GainSols(ref_table)))
+        metric_func = lambda sol, ref: gain_metrics(sol, ref, align=align)
+    else:
+        raise ValueError("Unknown solution kind {}".format(kind))
+
+    res = dict()
+    for beam, sol, ref in pairs:
+        records = [('obs_' + metric, ant, corr, value)
+                   for metric, ant, corr, value in metric_func(sol, ref)]
+        res[beam] = records
+        if store is not None:
+            store.append(records, scandata.task_id, scandata.source_name,
+                         beam, sol.time[0])
+    return res
+
+
+def bandpass_outliers(scandata, ref_beam=0, threshold=5., cube=None):
+    """
+    Find the beams, antennas and channels of a task whose bandpass
+    (normalized by a reference beam) deviates from the others
+
+    The outliers are logged as warnings, which makes this cheap enough
+    to check every apercc run.
+
+    Args:
+        scandata (ScanData): data of the task
+        ref_beam (int): beam used as reference, default 00
+        threshold (float): minimum outlier score (robust standard deviations)
+        cube (BandpassCube): bandpass solutions of the task if already read
+
+    Returns:
+        dict: {'beam'|'ant'|'chan': ranked outliers}, see stats.find_outliers
+    """
+    if cube is None:
+        cube = BandpassCube.from_scandata(scandata)
+    if not cube.present.any() or ref_beam not in cube.beams:
+        logger.warning("No bpass solutions to check for task {0}".format(
+            scandata.task_id))
+        return dict()
+    amp_norm, phase_norm = cube.normalize(ref_beam)
+    present = cube.present
+    labels = {'beam': cube.beams[present].tolist(), 'ant': list(cube.ants),
+              'chan': ['{:.4f} GHz'.format(f) for f in cube.freq]}
+    outliers = find_outliers(amp_norm[present], phase_norm[present],
+                             labels=labels, threshold=threshold)
+    for name, found in sorted(outliers.items()):
+        for outlier in found:
+            logger.warning("Task {0}: bandpass of {axis} {label} is an outlier in "
+                           "{statistic} (score {score:.1f})".format(
+                               scandata.task_id, **outlier))
+    return outliers
+
+
+def beam_similarity(scandata, store=None, min_corr=0.5, threshold=5., cube=None):
+    """
+    Group the beams of a task with similar bandpass deviations, per antenna,
+    and find the beams whose bandpass deviates much more than the others
+
+    The groups and outliers are logged, the similarities and outliers are
+    appended to the metric store if one is given (see
+    similarity.BeamSimilarity.records).
+
+    Args:
+        scandata (ScanData): data of the task
+        store (MetricStore): store to append the similarities to, optional
+        min_corr (float): minimum average correlation of the beams of a group
+        threshold (float): minimum outlier score (robust standard deviations)
+        cube (BandpassCube): bandpass solutions of the task if already read
+
+    Returns:
+        tuple: BeamSimilarity of the amplitude and of the phase, or None
+    """
+    from .similarity import BeamSimilarity, store_similarity
+
+    if cube is None:
+        cube = BandpassCube.from_scandata(scandata)
+    if cube.present.sum() < 3:
+        logger.warning("Too few bpass solutions to compare beams for task {0}".format(
+            scandata.task_id))
+        return None
+    kwargs = dict(min_corr=min_corr, threshold=threshold)
+    if store is not None:
+        sims = store_similarity(cube, scandata.task_id, scandata.source_name, store, **kwargs)
+    else:
+        sims = tuple(BeamSimilarity(cube, kind=kind, **kwargs) for kind in ['amp', 'phase'])
+    for sim in sims:
+        for a, ant in enumerate(sim.ants):
+            groups = sim.group_members(ant)
+            if len(groups) > 1:
+                logger.info("Task {0}: {1} bandpass {2} of the beams falls into groups {3}".format(
+                    scandata.task_id, ant, sim.kind, groups))
+            for beam in sim.beams[sim.outliers[a]]:
+                logger.warning("Task {0}: {1} bandpass {2} of beam {3:02d} deviates from "
+                               "the other beams".format(scandata.task_id, ant, sim.kind, beam))
+    return sims
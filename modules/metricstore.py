@@ -0,0 +1,306 @@
+# aperCC: store for derived stability metrics
+
+"""
+Time-series store for the stability metrics of cross-calibration solutions
+
+Metrics (see metrics.py) are appended per task, beam, antenna and
+correlation. Samples are partitioned by month into separate sqlite
+databases below a root directory and indexed by
+(metric, source, beam, antenna, correlation, time), so a query only
+touches the partitions overlapping the requested time range.
+Daily and weekly aggregates (count, sum, sum of squares, min, max) are
+updated on every append and kept in a separate database, so trends over
+months can be read without touching the samples at all. The aggregate
+database is attached to every partition, so the samples and their
+aggregates are committed in one transaction; rebuild_aggregates
+recomputes all aggregates from the samples.
+
+Example:
+    store = MetricStore('/data/apertif/crosscal/metrics')
+    store.query('gain_phase_scatter', ant='RT3', beam=12,
+                start=datetime.now() - timedelta(days=183))
+"""
+
+import os
+import glob
+import sqlite3
+import logging
+from datetime import datetime, timedelta, date
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# casacore TIME columns are in seconds since this epoch
+MJD_EPOCH = datetime(1858, 11, 17)
+
+SAMPLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    time REAL, day TEXT, task_id TEXT, source TEXT, beam INTEGER,
+    ant TEXT, corr TEXT, metric TEXT, value REAL,
+    UNIQUE (task_id, source, beam, ant, corr, metric));
+CREATE INDEX IF NOT EXISTS samples_key
+    ON samples (metric, ant, beam, corr, source, time);
+"""
+
+AGGREGATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {0} (
+    period TEXT, source TEXT, beam INTEGER, ant TEXT, corr TEXT,
+    metric TEXT, n INTEGER, sum REAL, sumsq REAL, min REAL, max REAL,
+    PRIMARY KEY (metric, ant, beam, corr, source, period));
+"""
+
+SAMPLE_DTYPE = [('time', float), ('task_id', 'U16'), ('source', 'U16'),
+                ('beam', int), ('ant', 'U8'), ('corr', 'U4'), ('value', float)]
+
+AGGREGATE_DTYPE = [('period', 'U10'), ('source', 'U16'), ('beam', int),
+                   ('ant', 'U8'), ('corr', 'U4'), ('n', int), ('mean', float),
+                   ('std', float), ('min', float), ('max', float)]
+
+
+def mjd_to_datetime(mjd_seconds):
+    """Convert a casacore TIME value (MJD seconds) to a datetime"""
+    return MJD_EPOCH + timedelta(seconds=float(mjd_seconds))
+
+
+def datetime_to_mjd(value):
+    """
+    Convert a datetime, date or 'YYYY-MM-DD' string to MJD seconds
+
+    Numbers are assumed to be MJD seconds already and returned unchanged.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], '%Y-%m-%d')
+    if isinstance(value, datetime):
+        return (value - MJD_EPOCH).total_seconds()
+    if isinstance(value, date):
+        return (datetime(value.year, value.month, value.day) - MJD_EPOCH).total_seconds()
+    return float(value)
+
+
+def _week_start(day):
+    """Monday of the week containing day, as 'YYYY-MM-DD'"""
+    return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+
+class MetricStore(object):
+    """
+    Date-partitioned store of stability metrics
+
+    Args:
+        root (str): directory holding the partitions, created if needed
+    """
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._partitions = dict()
+        self._aggregates_path = os.path.join(root, 'aggregates.sqlite')
+        self._aggregates = sqlite3.connect(self._aggregates_path)
+        for period in ['daily', 'weekly']:
+            self._aggregates.executescript(AGGREGATE_SCHEMA.format(period))
+
+    def _partition(self, month, create=True):
+        """Return the connection to the partition for 'YYYY-MM'"""
+        if month not in self._partitions:
+            path = os.path.join(self.root, 'samples_{}.sqlite'.format(month))
+            if not create and not os.path.exists(path):
+                return None
+            conn = sqlite3.connect(path)
+            conn.executescript(SAMPLE_SCHEMA)
+            # the samples and their aggregates are updated in one transaction
+            conn.execute("ATTACH DATABASE ? AS agg", (self._aggregates_path,))
+            self._partitions[month] = conn
+        return self._partitions[month]
+
+    def _months(self, start, end):
+        """Existing partitions overlapping the range [start, end] (MJD seconds)"""
+        months = sorted(os.path.basename(p)[8:15] for p in
+                        glob.glob(os.path.join(self.root, 'samples_*.sqlite')))
+        if start is not None:
+            first = mjd_to_datetime(start).strftime('%Y-%m')
+            months = [m for m in months if m >= first]
+        if end is not None:
+            last = mjd_to_datetime(end).strftime('%Y-%m')
+            months = [m for m in months if m <= last]
+        return months
+
+    def append(self, records, task_id, source, beam, time):
+        """
+        Append the metrics of one beam of a task
+
+        Samples already stored for the same task, source, beam, antenna,
+        correlation and metric are kept and not counted twice. The samples
+        and the aggregates are committed together, if either fails nothing
+        is stored.
+
+        Args:
+            records (list): (metric, ant, corr, value) tuples, e.g. from
+                metrics.bandpass_metrics or metrics.gain_metrics
+            task_id (int or str): task id of the observation
+            source (str): name of the calibrator
+            beam (int): beam number
+            time (float): start time of the observation in MJD seconds
+
+        Returns:
+            int: number of samples added
+        """
+        if not records:
+            return 0
+        time = float(time)
+        day = mjd_to_datetime(time)
+        daykey = day.strftime('%Y-%m-%d')
+        weekkey = _week_start(day)
+        conn = self._partition(day.strftime('%Y-%m'))
+
+        added = []
+        with conn:
+            for metric, ant, corr, value in records:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO samples VALUES (?,?,?,?,?,?,?,?,?)",
+                    (time, daykey, str(task_id), source, int(beam),
+                     ant, corr, metric, float(value)))
+                if cur.rowcount > 0:
+                    added.append((metric, ant, corr, float(value)))
+
+            for period, key in [('daily', daykey), ('weekly', weekkey)]:
+                for metric, ant, corr, value in added:
+                    ids = (key, source, int(beam), ant, corr, metric)
+                    self._accumulate(conn, period, ids, 1, value, value * value, value, value)
+
+        logger.debug("Added {0} samples for task {1} beam {2}".format(
+            len(added), task_id, beam))
+        return len(added)
+
+    @staticmethod
+    def _accumulate(conn, period, ids, n, total, sumsq, vmin, vmax):
+        """Add n samples to the aggregate of (period, source, beam, ant, corr, metric)"""
+        conn.execute(
+            "INSERT OR IGNORE INTO agg.{} VALUES (?,?,?,?,?,?,0,0,0,?,?)".format(period),
+            ids + (vmin, vmax))
+        conn.execute(
+            "UPDATE agg.{} SET n=n+?, sum=sum+?, sumsq=sumsq+?, "
+            "min=min(min,?), max=max(max,?) WHERE period=? AND "
+            "source=? AND beam=? AND ant=? AND corr=? AND metric=?".format(period),
+            (n, total, sumsq, vmin, vmax) + ids)
+
+    def rebuild_aggregates(self):
+        """
+        Recompute the daily and weekly aggregates from all samples, e.g.
+        for a store written before the samples and the aggregates were
+        committed together
+
+        Returns:
+            int: number of samples aggregated
+        """
+        with self._aggregates as agg:
+            for period in ['daily', 'weekly']:
+                agg.execute("DELETE FROM {}".format(period))
+        total = 0
+        for month in self._months(None, None):
+            conn = self._partition(month, create=False)
+            with conn:
+                rows = conn.execute(
+                    "SELECT day, source, beam, ant, corr, metric, count(*), sum(value), "
+                    "sum(value*value), min(value), max(value) FROM samples "
+                    "GROUP BY day, source, beam, ant, corr, metric").fetchall()
+                for row in rows:
+                    day = datetime.strptime(row[0], '%Y-%m-%d')
+                    for period, key in [('daily', row[0]), ('weekly', _week_start(day))]:
+                        self._accumulate(conn, period, (key,) + tuple(row[1:6]), *row[6:])
+                    total += row[6]
+        logger.info("Rebuilt the aggregates of {} samples".format(total))
+        return total
+
+    @staticmethod
+    def _where(metric, ant, beam, corr, source, column, start, end):
+        """Build the WHERE clause of a query"""
+        clauses = ['metric=?']
+        args = [metric]
+        for name, val in [('ant', ant), ('beam', beam), ('corr', corr),
+                          ('source', source)]:
+            if val is not None:
+                clauses.append('{}=?'.format(name))
+                args.append(int(val) if name == 'beam' else val)
+        if start is not None:
+            clauses.append('{}>=?'.format(column))
+            args.append(start)
+        if end is not None:
+            clauses.append('{}<=?'.format(column))
+            args.append(end)
+        return ' AND '.join(clauses), args
+
+    def query(self, metric, ant=None, beam=None, corr=None, source=None,
+              start=None, end=None):
+        """
+        Get the samples of a metric, sorted by time
+
+        Args:
+            metric (str): name of the metric, e.g. 'gain_phase_scatter'
+            ant (str): antenna name, default all
+            beam (int): beam number, default all
+            corr (str): correlation, e.g. 'XX', default all
+            source (str): calibrator name, default all
+            start, end (datetime, date, str or float): time range,
+                as datetime, 'YYYY-MM-DD' or MJD seconds
+
+        Returns:
+            numpy.ndarray: structured array with fields
+                time, task_id, source, beam, ant, corr, value
+        """
+        start = datetime_to_mjd(start)
+        end = datetime_to_mjd(end)
+        where, args = self._where(metric, ant, beam, corr, source, 'time', start, end)
+        rows = []
+        for month in self._months(start, end):
+            conn = self._partition(month, create=False)
+            rows.extend(conn.execute(
+                "SELECT time, task_id, source, beam, ant, corr, value "
+                "FROM samples WHERE {}".format(where), args).fetchall())
+        result = np.array(rows, dtype=SAMPLE_DTYPE)
+        result.sort(order='time')
+        return result
+
+    def aggregate(self, metric, period='daily', ant=None, beam=None,
+                  corr=None, source=None, start=None, end=None):
+        """
+        Get the precomputed daily or weekly aggregates of a metric
+
+        Args:
+            period (str): 'daily' or 'weekly'
+            other arguments as for query
+
+        Returns:
+            numpy.ndarray: structured array with fields period, source,
+                beam, ant, corr, n, mean, std, min, max sorted by period
+        """
+        if period not in ['daily', 'weekly']:
+            raise ValueError("period must be 'daily' or 'weekly', not {}".format(period))
+        start = datetime_to_mjd(start)
+        end = datetime_to_mjd(end)
+        start = None if start is None else mjd_to_datetime(start)
+        if start is not None and period == 'weekly':
+            start = datetime.strptime(_week_start(start), '%Y-%m-%d')
+        start = None if start is None else start.strftime('%Y-%m-%d')
+        end = None if end is None else mjd_to_datetime(end).strftime('%Y-%m-%d')
+        where, args = self._where(metric, ant, beam, corr, source, 'period', start, end)
+        rows = self._aggregates.execute(
+            "SELECT period, source, beam, ant, corr, n, sum, sumsq, min, max "
+            "FROM {0} WHERE {1} ORDER BY period".format(period, where), args).fetchall()
+
+        result = np.zeros(len(rows), dtype=AGGREGATE_DTYPE)
+        for i, (key, src, bm, an, cr, n, s, ss, vmin, vmax) in enumerate(rows):
+            mean = s / n
+            std = np.sqrt(max(ss / n - mean * mean, 0.))
+            result[i] = (key, src, bm, an, cr, n, mean, std, vmin, vmax)
+        return result
+
+    def close(self):
+        """Close all open partitions"""
+        for conn in self._partitions.values():
+            conn.close()
+        self._partitions = dict()
+        self._aggregates.close()
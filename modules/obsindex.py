@@ -0,0 +1,270 @@
+# aperCC: index of calibrator observations for cross-observation comparisons
+
+"""
+Find comparable calibrator observations
+
+Comparable observations are of the same calibrator, in the same beam
+and with the same frequency setup. The index keeps, for every (source,
+beam, setup) key, the observations sorted by time, so the nearest N
+observations to a time and all observations within a time window are
+found by binary search. New tasks are added incrementally: tables that
+are already in the index are read again only when their table_version
+(modification time) changed, and refresh drops tables that were deleted.
+
+An observation is a tuple (time, task_id, beam, table), with the start
+time in MJD seconds and the path of the bandpass table.
+
+Example:
+    index = ObservationIndex()
+    index.scan()
+    index.nearest('3C147', 0, setup, time, n=5)
+    index.comparable_tasks(190601001)
+"""
+
+import os
+import glob
+import bisect
+import pickle
+import logging
+import tempfile
+from collections import Counter
+
+from .tableio import open_table, get_frequencies, table_version
+from .scandata import get_data_roots
+
+logger = logging.getLogger(__name__)
+
+
+def source_name(name):
+    """Calibrator name without beam suffix, e.g. '3C147' for '3C147_36'"""
+    return str(name).upper().strip().split('_')[0]
+
+
+def frequency_setup(table):
+    """
+    Frequency setup of a solution table or measurement set
+
+    Returns:
+        tuple: (number of channels, first and last frequency in MHz, rounded to 1 kHz)
+    """
+    freq = get_frequencies(table)[0]
+    return (len(freq), round(float(freq[0]) * 1e3, 3), round(float(freq[-1]) * 1e3, 3))
+
+
+class ObservationIndex(object):
+    """
+    Index of the bandpass solutions below the data roots
+
+    Args:
+        roots (list): data directories, default the ones ScanData searches
+        suffix (str): suffix of the solution tables to index
+        search_all_nodes (bool): index the data directories of all nodes
+    """
+
+    def __init__(self, roots=None, suffix='Bscan', search_all_nodes=False):
+        if roots is None:
+            roots = get_data_roots(search_all_nodes=search_all_nodes)
+        self.roots = roots
+        self.suffix = suffix
+        self._times = dict()
+        self._obs = dict()
+        self._tables = dict()
+        self._tasks = dict()
+        self._versions = dict()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def keys(self):
+        """The (source, beam, setup) keys of the index"""
+        return sorted(self._obs)
+
+    def add(self, source, beam, setup, time, task_id, table):
+        """Add an observation, keeping the observations of its key sorted by time"""
+        key = (source_name(source), int(beam), tuple(setup))
+        times = self._times.setdefault(key, [])
+        i = bisect.bisect_right(times, time)
+        times.insert(i, time)
+        obs = (time, int(task_id), int(beam), table)
+        self._obs.setdefault(key, []).insert(i, obs)
+        self._tables[table] = key
+        self._tasks.setdefault(int(task_id), dict())[int(beam)] = obs
+
+    def remove(self, table):
+        """Remove the observation of a table from the index"""
+        key = self._tables.pop(table)
+        self._versions.pop(table, None)
+        obs = self._obs[key]
+        i = [o[3] for o in obs].index(table)
+        time, task_id, beam, _ = obs.pop(i)
+        self._times[key].pop(i)
+        if not obs:
+            del self._obs[key], self._times[key]
+        beams = self._tasks.get(task_id, dict())
+        if beams.get(beam, (None,) * 4)[3] == table:
+            del beams[beam]
+            if not beams:
+                del self._tasks[task_id]
+
+    def add_table(self, table):
+        """
+        Add the solution table <root>/<task_id>/<beam>/raw/<source>.<suffix>,
+        unless it is already in the index and did not change
+
+        Returns:
+            bool: True if the table was (re)read
+        """
+        version = table_version(table)
+        if table in self._tables:
+            if self._versions.setdefault(table, version) == version:
+                return False
+            self.remove(table)
+        raw_dir = os.path.dirname(table)
+        beam = int(os.path.basename(os.path.dirname(raw_dir)))
+        task_id = int(os.path.basename(os.path.dirname(os.path.dirname(raw_dir))))
+        source = os.path.splitext(os.path.basename(table))[0]
+        t = open_table(table)
+        if t.nrows() == 0:
+            logger.warning("Not indexing empty table {}".format(table))
+            return False
+        self.add(source, beam, frequency_setup(table), float(t.getcell('TIME', 0)),
+                 task_id, table)
+        self._versions[table] = version
+        return True
+
+    def refresh(self):
+        """
+        Drop the tables that no longer exist and read the ones that were
+        written again, without searching for new tables
+
+        Returns:
+            tuple: number of tables dropped and read again
+        """
+        dropped = updated = 0
+        for table in sorted(self._tables):
+            version = table_version(table)
+            if version is None:
+                self.remove(table)
+                dropped += 1
+            elif self._versions.get(table, version) != version:
+                try:
+                    updated += self.add_table(table)
+                except Exception as e:
+                    logger.warning("Could not index {}".format(table))
+                    logger.exception(e)
+        if dropped or updated:
+            logger.info("Dropped {0} and updated {1} indexed tables".format(dropped, updated))
+        return dropped, updated
+
+    def scan(self, task_ids=None):
+        """
+        Add the solution tables below the data roots that are not indexed yet
+
+        Args:
+            task_ids (list): only look in the directories of these tasks
+
+        Returns:
+            int: number of tables added
+        """
+        patterns = ['*'] if task_ids is None else [str(task_id) for task_id in task_ids]
+        added = 0
+        for root in self.roots:
+            for pattern in patterns:
+                for table in sorted(glob.glob(os.path.join(
+                        root, pattern, '[0-3][0-9]', 'raw', '*.{}'.format(self.suffix)))):
+                    try:
+                        added += self.add_table(table)
+                    except Exception as e:
+                        logger.warning("Could not index {}".format(table))
+                        logger.exception(e)
+        logger.info("Indexed {0} new tables, {1} in total".format(added, len(self)))
+        return added
+
+    def window(self, source, beam, setup, start, end):
+        """All comparable observations with start <= time <= end, sorted by time"""
+        key = (source_name(source), int(beam), tuple(setup))
+        times = self._times.get(key, [])
+        return self._obs.get(key, [])[bisect.bisect_left(times, start):
+                                      bisect.bisect_right(times, end)]
+
+    def nearest(self, source, beam, setup, time, n=1, exclude_task=None):
+        """
+        The n comparable observations nearest in time
+
+        Args:
+            source, beam, setup: key of the observations
+            time (float): time in MJD seconds
+            n (int): number of observations
+            exclude_task (int): task to leave out, e.g. the task itself
+
+        Returns:
+            list: observations, nearest first
+        """
+        key = (source_name(source), int(beam), tuple(setup))
+        times = self._times.get(key, [])
+        obs = self._obs.get(key, [])
+        # walk outwards from the insertion point
+        lo = bisect.bisect_left(times, time) - 1
+        hi = lo + 1
+        res = []
+        while len(res) < n and (lo >= 0 or hi < len(times)):
+            if hi >= len(times) or (lo >= 0 and time - times[lo] <= times[hi] - time):
+                i, lo = lo, lo - 1
+            else:
+                i, hi = hi, hi + 1
+            if exclude_task is None or obs[i][1] != exclude_task:
+                res.append(obs[i])
+        return res
+
+    def task_observations(self, task_id):
+        """All observations of a task, by beam"""
+        return dict(self._tasks.get(int(task_id), dict()))
+
+    def comparable_tasks(self, task_id, n=1):
+        """
+        Tasks comparable to a task: for every beam of the task the n nearest
+        comparable observations are found, and their tasks are ranked by the
+        number of beams they match and then by the distance in time
+
+        Returns:
+            list: task ids, best match first
+        """
+        counts = Counter()
+        distance = dict()
+        for beam, (time, _, _, table) in self.task_observations(task_id).items():
+            key = self._tables[table]
+            for obs in self.nearest(key[0], key[1], key[2], time, n=n, exclude_task=task_id):
+                counts[obs[1]] += 1
+                distance[obs[1]] = min(distance.get(obs[1], float('inf')), abs(obs[0] - time))
+        return sorted(counts, key=lambda task: (-counts[task], distance[task]))
+
+    def save(self, filename):
+        """
+        Save the index to a file
+
+        The index is written to a temporary file that replaces the file,
+        so processes saving at the same time never leave a partial index.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.apercc_index_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.roots, self.suffix, self._times, self._obs, self._tables,
+                             self._tasks, self._versions), f)
+            os.rename(tmp, filename)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved with save, it can be updated with scan"""
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+        roots, suffix, times, obs, tables, tasks = saved[:6]
+        index = cls(roots=roots, suffix=suffix)
+        index._times, index._obs, index._tables, index._tasks = times, obs, tables, tasks
+        # indexes saved without versions take the tables as they are now
+        index._versions = saved[6] if len(saved) > 6 else dict()
+        return index
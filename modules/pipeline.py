@@ -0,0 +1,283 @@
+# aperCC: pipelined driver for a range of dates
+
+"""
+Run the aperCC workflow for all calibrator sets of a date range
+
+The stages run in separate processes connected by bounded queues:
+
+    scan discovery -> data fetch -> flag/calibrate -> compare
+
+so the first calibrator sets are compared while later ones are still
+being fetched. Separate processes (rather than threads) are used because
+the Apercal steps change the working directory.
+
+The first calibrator set (or the reference set, if given) is the
+reference the other sets are compared to.
+"""
+
+import os
+import logging
+import multiprocessing
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .apercc import apercc
+from .applycal import apply_reference
+from .get_data import get_cal_scan_dict
+from .atdb import AtdbClient
+from .metrics import compare_observations
+from .metricstore import MetricStore
+from .plan import plan_task
+from .scandata import ScanData
+from .visstats import beam_vis_stats
+from . import throttle
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the stream of calibrator sets
+DONE = 'DONE'
+
+# seconds between checks that all stages are still running
+STAGE_POLL = 10.
+
+
+def select_sets(cal_sets, date1, date2, reference=None, newest_first=False):
+    """
+    Select the calibrator sets in a range of dates
+
+    Args:
+        cal_sets (dict): {task id: cal_list} from get_cal_scan_dict
+        date1, date2 (str): first and last date, 'YYYY-MM-DD'
+        reference (int): task id of the reference set, which is put first
+        newest_first (bool): sort the sets newest first instead of oldest first
+
+    Returns:
+        list: (task id, cal_list) sorted by task id, reference first
+    """
+    first = datetime.strptime(date1, '%Y-%m-%d').strftime('%y%m%d')
+    last = datetime.strptime(date2, '%Y-%m-%d').strftime('%y%m%d')
+    task_ids = throttle.newest_first(cal_sets) if newest_first else sorted(cal_sets)
+    selected = [(task_id, cal_sets[task_id]) for task_id in task_ids
+                if first <= str(task_id)[:6] <= last]
+    if reference is not None:
+        reference = int(reference)
+        if reference not in cal_sets:
+            raise ValueError("Reference {} is not a calibrator set".format(reference))
+        selected = [(reference, cal_sets[reference])] + \
+            [item for item in selected if item[0] != reference]
+    return selected
+
+
+def _govern(settings, low_priority):
+    """Apply the resource limits in a stage process"""
+    if settings:
+        throttle.configure(**settings)
+    if low_priority:
+        throttle.lower_priority()
+
+
+def _atdb_client(atdb_url):
+    """Pooled ATDB client for a URL, None to use atdbquery"""
+    return AtdbClient(url=atdb_url) if atdb_url is not None else None
+
+
+def _discover(outq, date1, date2, centfreq, reference, low_priority, atdb_url=None):
+    """Stage: find the calibrator sets and feed them to the pipeline"""
+    try:
+        cal_sets = get_cal_scan_dict(centfreq, client=_atdb_client(atdb_url))
+        selected = select_sets(cal_sets, date1, date2, reference=reference,
+                               newest_first=low_priority)
+        logger.info("Found {0} calibrator sets between {1} and {2}".format(
+            len(selected), date1, date2))
+        for item in selected:
+            outq.put(item)
+    except Exception as e:
+        logger.warning("Scan discovery failed")
+        logger.exception(e)
+    outq.put(DONE)
+
+
+def _run_stage(name, steps, inq, outq, base_dir, settings, low_priority):
+    """Stage: run apercc steps on every calibrator set from the input queue"""
+    _govern(settings, low_priority)
+    while True:
+        item = inq.get()
+        if item == DONE:
+            break
+        task_id, cal_list = item
+        logger.info("{0}: task {1}".format(name, task_id))
+        try:
+            apercc(cal_list=cal_list, task_id=task_id, steps=list(steps),
+                   base_dir=os.path.join(base_dir, str(task_id)))
+        except Exception as e:
+            logger.warning("{0} failed for task {1}".format(name, task_id))
+            logger.exception(e)
+        outq.put(item)
+    outq.put(DONE)
+
+
+def _apply_ref(scan_data, ref, store, processes):
+    """Apply the reference solutions to a calibrator set and summarize the visibilities"""
+    applied = apply_reference(ref, scan_data, processes=processes)
+    ms_list = scan_data.get_ms()
+    ms_list = [ms for ms in (ms_list if ms_list != -1 else [])
+               if int(os.path.basename(os.path.dirname(os.path.dirname(ms)))) in applied]
+    vis_stats = beam_vis_stats(ms_list, source=scan_data.source_name, processes=processes)
+    res = dict()
+    for beam, stats in vis_stats.items():
+        res[beam] = stats.records()
+        if store is not None:
+            store.append(res[beam], scan_data.task_id, scan_data.source_name, beam, stats.time)
+    return res
+
+
+def _compare(inq, resq, base_dir, metric_store, settings, low_priority,
+             apply_ref=False, processes=1):
+    """Stage: compare every calibrator set to the first (reference) one"""
+    _govern(settings, low_priority)
+    store = None
+    if metric_store is not None:
+        try:
+            store = MetricStore(metric_store)
+        except Exception as e:
+            logger.warning("Cannot open the metric store {}, metrics are not stored".format(
+                metric_store))
+            logger.exception(e)
+    ref = None
+    while True:
+        item = inq.get()
+        if item == DONE:
+            break
+        task_id, cal_list = item
+        res = {'task_id': task_id}
+        scan_data = None
+        try:
+            source = str(cal_list[0][1]).upper().strip().split('_')[0]
+            res['source'] = source
+            scan_data = ScanData(task_id, source, base_dir=base_dir)
+            for kind in ['bpass', 'gain']:
+                if ref is None:
+                    res[kind] = dict()
+                else:
+                    res[kind] = compare_observations(scan_data, ref, kind=kind, store=store)
+            if apply_ref and ref is not None:
+                res['vis'] = _apply_ref(scan_data, ref, store, processes)
+        except Exception as e:
+            logger.warning("Comparison failed for task {}".format(task_id))
+            logger.exception(e)
+        if ref is None and scan_data is not None:
+            logger.info("Using task {} as reference".format(task_id))
+            ref = scan_data
+        resq.put(res)
+    if store is not None:
+        store.close()
+    resq.put(DONE)
+
+
+def run_pipeline(date1, date2, centfreq, reference=None,
+                 base_dir='/data/apertif/crosscal/', queue_size=2,
+                 metric_store=None, throttle_settings=None, low_priority=False,
+                 apply_ref=False, processes=1, atdb_url=None):
+    """
+    Run scan discovery, data fetch, flag/calibrate and compare as a pipeline
+
+    Args:
+        date1, date2 (str): first and last date of the calibrator sets, 'YYYY-MM-DD'
+        centfreq (float): central frequency of the observations
+        reference (int): task id of the reference set, default first set
+        base_dir (str): directory under which every set gets a <task_id> directory
+        queue_size (int): maximum number of calibrator sets waiting between two stages
+        metric_store (str): directory of the MetricStore to append the metrics to
+        throttle_settings (dict): read limits for throttle.configure, shared by
+            all stages and their worker processes together
+        low_priority (bool): run the stages with the lowest CPU and I/O priority
+            and process the newest calibrator sets first
+        apply_ref (bool): apply the solutions of the reference to the other
+            calibrator sets and get the statistics of the corrected visibilities
+        processes (int): number of beams corrected and summarized at the same time
+        atdb_url (str): query ATDB at this URL with the pooled AtdbClient
+            instead of with atdbquery
+
+    Returns:
+        list: per calibrator set a dictionary with task_id, source and the
+            'bpass' and 'gain' metrics {beam: records} relative to the reference
+            (and the 'vis' metrics with apply_ref)
+    """
+    queues = [multiprocessing.Queue(maxsize=queue_size) for _ in range(3)]
+    resq = multiprocessing.Queue()
+    if throttle_settings:
+        # one read rate and one set of read slots for all stages, not one per stage
+        throttle_settings = throttle.shared_settings(**throttle_settings)
+
+    stages = [
+        multiprocessing.Process(
+            name='discover', target=_discover,
+            args=(queues[0], date1, date2, centfreq, reference, low_priority, atdb_url)),
+        multiprocessing.Process(
+            name='fetch', target=_run_stage,
+            args=('fetch', ['prepare'], queues[0], queues[1], base_dir,
+                  throttle_settings, low_priority)),
+        multiprocessing.Process(
+            name='calibrate', target=_run_stage,
+            args=('calibrate', ['preflag', 'crosscal'], queues[1], queues[2], base_dir,
+                  throttle_settings, low_priority)),
+        multiprocessing.Process(
+            name='compare', target=_compare,
+            args=(queues[2], resq, base_dir, metric_store, throttle_settings, low_priority,
+                  apply_ref, processes)),
+    ]
+    for stage in stages:
+        stage.start()
+
+    results = []
+    while True:
+        try:
+            res = resq.get(timeout=STAGE_POLL)
+        except queue.Empty:
+            failed = [(stage.name, stage.exitcode) for stage in stages
+                      if stage.exitcode not in (None, 0)]
+            if not failed and stages[-1].is_alive():
+                continue
+            # a stage died (e.g. killed for memory), the rest would wait forever
+            logger.error("Pipeline stages {0} stopped, aborting with {1} compared "
+                         "sets".format(failed or [(stages[-1].name, stages[-1].exitcode)],
+                                       len(results)))
+            for stage in stages:
+                if stage.is_alive():
+                    stage.terminate()
+            break
+        if res == DONE:
+            break
+        logger.info("Compared task {}".format(res['task_id']))
+        results.append(res)
+
+    for stage in stages:
+        stage.join()
+
+    return results
+
+
+def plan_pipeline(date1, date2, centfreq, reference=None,
+                  base_dir='/data/apertif/crosscal/', apply_ref=False, atdb_url=None):
+    """
+    Plan the pipeline without fetching or reading any data
+
+    Args:
+        as for run_pipeline
+
+    Returns:
+        list: plan of every calibrator set, see plan.plan_task
+    """
+    steps = ['prepare', 'preflag', 'crosscal', 'bpass_compare_obs', 'gain_compare_obs']
+    if apply_ref:
+        steps.append('vis_stats')
+    cal_sets = get_cal_scan_dict(centfreq, client=_atdb_client(atdb_url))
+    plans = []
+    for task_id, cal_list in select_sets(cal_sets, date1, date2, reference=reference):
+        plans.append(plan_task(task_id, cal_list[0][1], os.path.join(base_dir, str(task_id)),
+                               steps, beams=[cal[2] for cal in cal_list]))
+    return plans
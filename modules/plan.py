@@ -0,0 +1,314 @@
+# aperCC: dry-run plans with I/O and runtime estimates
+
+"""
+Plan an apercc run without reading any data
+
+The inputs of every step are resolved through ScanData and only their
+sizes on disk are summed, per step and beam. Inputs that do not exist
+yet (e.g. the measurement sets that prepare will fetch) get the typical
+size of earlier runs. The wall time of a step is its input size divided
+by the throughput of the step, learned from earlier runs (see
+Throughput), and its peak memory follows from how the step reads its
+inputs: all beams at once, one beam at a time, or in chunks.
+
+Example:
+    plan = plan_task(190601001, '3C147', '/data/apertif/190601001/',
+                     ['bpass_compare', 'gain_compare'])
+    print(format_plan(plan))
+"""
+
+import os
+import json
+import fcntl
+import logging
+import tempfile
+
+from .scandata import ScanData
+from .visstats import MAX_CHUNK_BYTES
+
+logger = logging.getLogger(__name__)
+
+# file with the learned throughputs, can be changed with this environment variable
+THROUGHPUT_ENV = 'APERCC_THROUGHPUT'
+THROUGHPUT_FILE = os.path.join(os.path.expanduser('~'), '.apercc_throughput.json')
+
+# input of every step, how it is held in memory and how many tasks it reads
+# 'all': all beams at once, 'beam': one beam at a time, 'chunk': in chunks of rows
+STEPS = {
+    'prepare': ('ms', 'beam', 1),
+    'preflag': ('ms', 'beam', 1),
+    'crosscal': ('ms', 'beam', 1),
+    'bpass_compare': ('bpass', 'all', 1),
+    'gain_compare': ('gain', 'all', 1),
+    'vis_stats': ('ms', 'chunk', 1),
+    'bpass_compare_obs': ('bpass', 'all', 2),
+    'gain_compare_obs': ('gain', 'all', 2),
+}
+
+# suffix of the input of every kind
+SUFFIXES = {'ms': 'MS', 'bpass': 'Bscan', 'gain': 'G1ap'}
+
+# bytes per second used until a step has been timed
+DEFAULT_RATES = {'prepare': 50e6, 'preflag': 100e6, 'crosscal': 100e6,
+                 'bpass_compare': 50e6, 'gain_compare': 50e6, 'vis_stats': 200e6,
+                 'bpass_compare_obs': 50e6, 'gain_compare_obs': 50e6}
+
+# size of one beam of every kind used until sizes have been seen
+DEFAULT_SIZES = {'ms': 4e9, 'bpass': 1e6, 'gain': 1e5}
+
+# memory of a step relative to the data it holds at once
+MEMORY_FACTOR = 3.
+
+
+def path_size(path):
+    """Total size of the files below a directory (or of a file), 0 if it does not exist"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class Throughput(object):
+    """
+    Throughput of the apercc steps and typical input sizes, learned from earlier runs
+
+    Runs on several nodes or in several processes can share the file:
+    save adds the runs recorded since loading to the figures in the file,
+    holding a lock on <filename>.lock, and replaces the file at once.
+
+    Args:
+        filename (str): JSON file to keep the figures in, default from the
+            environment variable APERCC_THROUGHPUT or ~/.apercc_throughput.json
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.environ.get(THROUGHPUT_ENV, THROUGHPUT_FILE)
+        self.filename = filename
+        self.steps, self.sizes = self._read()
+        # runs and sizes recorded since the file was read, added to it by save
+        self._new_steps = dict()
+        self._new_sizes = dict()
+
+    def _read(self):
+        """Step and size figures in the file, empty if there is none"""
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    figures = json.load(f)
+                return figures.get('steps', dict()), figures.get('sizes', dict())
+            except (IOError, ValueError) as e:
+                logger.warning("Could not read throughputs from {0}: {1}".format(self.filename, e))
+        return dict(), dict()
+
+    def rate(self, step):
+        """Bytes per second of a step"""
+        known = self.steps.get(step)
+        if known and known['seconds'] > 0 and known['bytes'] > 0:
+            return known['bytes'] / known['seconds']
+        return DEFAULT_RATES.get(step, 100e6)
+
+    def typical_size(self, kind):
+        """Typical size of the input of one beam of a kind"""
+        known = self.sizes.get(kind)
+        if known and known['count'] > 0:
+            return known['bytes'] / float(known['count'])
+        return DEFAULT_SIZES[kind]
+
+    @staticmethod
+    def _add_step(steps, step, nbytes, seconds, runs=1):
+        known = steps.setdefault(step, {'bytes': 0, 'seconds': 0., 'runs': 0})
+        known['bytes'] += int(nbytes)
+        known['seconds'] += float(seconds)
+        known['runs'] += runs
+
+    @staticmethod
+    def _add_sizes(sizes, kind, nbytes, count):
+        known = sizes.setdefault(kind, {'bytes': 0, 'count': 0})
+        known['bytes'] += int(nbytes)
+        known['count'] += count
+
+    def record(self, step, nbytes, seconds):
+        """Add a timed run of a step"""
+        for steps in [self.steps, self._new_steps]:
+            self._add_step(steps, step, nbytes, seconds)
+
+    def record_sizes(self, kind, sizes):
+        """Add the sizes of existing inputs of a kind"""
+        sizes = [size for size in sizes if size > 0]
+        for known in [self.sizes, self._new_sizes]:
+            self._add_sizes(known, kind, sum(sizes), len(sizes))
+
+    def save(self):
+        """Add the runs recorded since loading to the figures in the file"""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                steps, sizes = self._read()
+                for step, new in self._new_steps.items():
+                    self._add_step(steps, step, new['bytes'], new['seconds'], new['runs'])
+                for kind, new in self._new_sizes.items():
+                    self._add_sizes(sizes, kind, new['bytes'], new['count'])
+                fd, tmp = tempfile.mkstemp(dir=directory, prefix='.apercc_throughput_')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump({'steps': steps, 'sizes': sizes}, f, indent=1, sort_keys=True)
+                    os.rename(tmp, self.filename)
+                except Exception:
+                    os.remove(tmp)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.steps, self.sizes = steps, sizes
+        self._new_steps = dict()
+        self._new_sizes = dict()
+
+
+def input_sizes(scan_data, kind, beams=None):
+    """
+    Sizes of the inputs of a kind per beam
+
+    Args:
+        scan_data (ScanData): data of the task
+        kind (str): 'ms', 'bpass' or 'gain'
+        beams (list): beams to include, default the beam directories of the task
+
+    Returns:
+        dict: {beam: size in bytes, or None if the input does not exist}
+    """
+    dirs = dict((int(beam), single_dir) for beam, single_dir in
+                zip(scan_data.beam_list, scan_data.dir_list))
+    if beams is None:
+        beams = sorted(dirs)
+    sizes = dict()
+    for beam in beams:
+        path = None
+        if int(beam) in dirs:
+            path = "{0}/raw/{1}.{2}".format(dirs[int(beam)], scan_data.source_name,
+                                            SUFFIXES[kind])
+        sizes[int(beam)] = path_size(path) if path and os.path.exists(path) else None
+    return sizes
+
+
+def plan_task(task_id, source, base_dir, steps, beams=None, search_all_nodes=False,
+              throughput=None, after_run=False):
+    """
+    Plan the steps of an apercc run
+
+    Args:
+        task_id (int): task id
+        source (str): name of the calibrator
+        base_dir (str): directory of the task (<data root>/<task_id>/)
+        steps (list): apercc steps
+        beams (list): beams of the task, default the existing beam directories
+        search_all_nodes (bool): look on all nodes for the beam directories
+        throughput (Throughput): learned figures, default read from the file
+        after_run (bool): the steps have run, so the data that prepare
+            fetched exists and its size is used
+
+    Returns:
+        dict: task_id, source and per step the bytes per beam ('beams'),
+            'bytes', 'seconds', 'peak_memory' and the number of inputs that
+            were estimated ('estimated'), the totals, and the sizes on disk
+            of the inputs of the steps ('input_sizes', {kind: {beam: size or
+            None}}), so every input is measured once
+    """
+    if throughput is None:
+        throughput = Throughput()
+    scan_data = ScanData(task_id, str(source).upper().strip().split('_')[0],
+                         base_dir=os.path.dirname(base_dir.rstrip('/')),
+                         search_all_nodes=search_all_nodes)
+    plan = {'task_id': task_id, 'source': scan_data.source_name, 'steps': [],
+            'input_sizes': dict()}
+    for step in steps:
+        if step not in STEPS:
+            logger.warning("No cost model for step {}".format(step))
+            continue
+        kind, memory, ntasks = STEPS[step]
+        if kind not in plan['input_sizes']:
+            plan['input_sizes'][kind] = input_sizes(scan_data, kind, beams)
+        sizes = plan['input_sizes'][kind]
+        # prepare fetches the data, so before the run it does not exist yet
+        # (or only partly, from an earlier attempt)
+        estimated = [beam for beam, size in sizes.items()
+                     if size is None or (step == 'prepare' and not after_run)]
+        per_beam = dict((beam, int(throughput.typical_size(kind) if beam in estimated else size))
+                        for beam, size in sizes.items())
+        nbytes = ntasks * sum(per_beam.values())
+        largest = max(per_beam.values()) if per_beam else 0
+        peak = {'all': nbytes, 'beam': largest,
+                'chunk': min(largest, MAX_CHUNK_BYTES)}[memory] * MEMORY_FACTOR
+        plan['steps'].append({'step': step, 'beams': per_beam, 'bytes': nbytes,
+                              'seconds': nbytes / throughput.rate(step),
+                              'peak_memory': int(peak), 'estimated': len(estimated)})
+    plan['bytes'] = sum(s['bytes'] for s in plan['steps'])
+    plan['seconds'] = sum(s['seconds'] for s in plan['steps'])
+    plan['peak_memory'] = max([s['peak_memory'] for s in plan['steps']] or [0])
+    return plan
+
+
+def learn(task_id, source, base_dir, step_times, search_all_nodes=False, throughput=None):
+    """
+    Update the throughputs with the timed steps of a finished run
+
+    The typical input sizes are updated with the inputs of the steps that
+    ran, as measured for the plan, so the data of the task is not walked
+    again.
+
+    Args:
+        step_times (dict): {step: wall time in seconds}
+        other arguments as for plan_task
+    """
+    if throughput is None:
+        throughput = Throughput()
+    plan = plan_task(task_id, source, base_dir, list(step_times),
+                     search_all_nodes=search_all_nodes, throughput=throughput, after_run=True)
+    for step in plan['steps']:
+        # only steps whose inputs all existed after the run give a throughput
+        if step['estimated'] == 0 and step['bytes'] > 0:
+            throughput.record(step['step'], step['bytes'], step_times[step['step']])
+    for kind, sizes in plan['input_sizes'].items():
+        throughput.record_sizes(kind, [size for size in sizes.values() if size is not None])
+    try:
+        throughput.save()
+    except (IOError, OSError) as e:
+        logger.warning("Could not save throughputs to {0}: {1}".format(throughput.filename, e))
+
+
+def _human(nbytes):
+    """Bytes as a readable string"""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nbytes) < 1000.:
+            return "{0:.1f} {1}".format(nbytes, unit)
+        nbytes /= 1000.
+    return "{0:.1f} TB".format(nbytes)
+
+
+def format_plan(plans):
+    """
+    Format one plan or a list of plans as a table
+
+    Returns:
+        str: one line per step with the bytes read, wall time and peak memory
+    """
+    if isinstance(plans, dict):
+        plans = [plans]
+    lines = ["{0:>10} {1:<8} {2:<18} {3:>6} {4:>10} {5:>9} {6:>10}".format(
+        'task', 'source', 'step', 'beams', 'read', 'time', 'memory')]
+    for plan in plans:
+        for step in plan['steps']:
+            lines.append("{0:>10} {1:<8} {2:<18} {3:>6} {4:>10} {5:>8.0f}s {6:>10}".format(
+                plan['task_id'], plan['source'], step['step'], len(step['beams']),
+                _human(step['bytes']), step['seconds'], _human(step['peak_memory'])))
+    lines.append("{0:>10} {1:<8} {2:<18} {3:>6} {4:>10} {5:>8.0f}s {6:>10}".format(
+        'total', '', '', '', _human(sum(p['bytes'] for p in plans)),
+        sum(p['seconds'] for p in plans),
+        _human(max([p['peak_memory'] for p in plans] or [0]))))
+    return '\n'.join(lines)
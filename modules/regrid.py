@@ -0,0 +1,196 @@
+# aperCC: map bandpasses onto a common frequency grid
+
+"""
+Regrid spectra between frequency grids
+
+Observations with a different centre frequency, channelisation or
+subband selection are compared on a common grid. Every target channel
+is the average of the source channels it overlaps, weighted by the
+overlap in frequency, so the resampling conserves the mean and averages
+down noise when going to coarser channels. The weights form a
+[target chan, source chan] matrix, which is cached per pair of grids,
+and all antennas, correlations (and beams) are regridded with one
+matrix product. Flagged (NaN) channels get zero weight; target channels
+that are covered for less than min_coverage by valid source channels
+are NaN.
+
+Every target channel overlaps only a few neighbouring source channels,
+so the weights are kept as a sparse list of (target, source, weight)
+overlaps, found with searchsorted on the channel edges, and applied
+with np.add.reduceat. A small LRU cache keeps the weights of the most
+recent pairs of grids.
+
+Example:
+    amp = regrid(other.freq[0], other.amp, self.freq[0])
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# number of pairs of grids whose weights are kept
+WEIGHT_CACHE_SIZE = 16
+
+_weight_cache = OrderedDict()
+_weight_lock = threading.Lock()
+
+
+def channel_edges(freq):
+    """
+    Edges of channels given their centre frequencies
+
+    The edges are halfway between the centres, the outer channels are
+    as wide as their neighbours.
+
+    Returns:
+        numpy.ndarray: [chan + 1] edges, increasing if freq is increasing
+    """
+    freq = np.asarray(freq, dtype=float)
+    if len(freq) == 1:
+        raise ValueError("Cannot derive the channel width of a single channel")
+    mid = 0.5 * (freq[1:] + freq[:-1])
+    return np.concatenate([[2. * freq[0] - mid[0]], mid, [2. * freq[-1] - mid[-1]]])
+
+
+class OverlapWeights(object):
+    """
+    Sparse [dst chan, src chan] overlap weights
+
+    rows, cols and values are the target channel, source channel and
+    fraction of the target channel covered by the source channel of
+    every overlapping pair, sorted by target channel.
+    """
+
+    def __init__(self, rows, cols, values, shape):
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+        self.shape = shape
+        # start of the pairs of every target channel that has any
+        self._nonempty, self._starts = np.unique(rows, return_index=True)
+
+    def apply(self, x):
+        """Weighted sums over the last (source channel) axis of x"""
+        x = np.asarray(x)
+        res = np.zeros(x.shape[:-1] + (self.shape[0],),
+                       dtype=np.result_type(x.dtype, self.values.dtype))
+        if len(self.rows):
+            res[..., self._nonempty] = np.add.reduceat(x[..., self.cols] * self.values,
+                                                       self._starts, axis=-1)
+        return res
+
+    def toarray(self):
+        """Dense [dst chan, src chan] matrix, for small grids"""
+        dense = np.zeros(self.shape)
+        dense[self.rows, self.cols] = self.values
+        return dense
+
+
+def weight_matrix(src_freq, dst_freq):
+    """
+    Overlap weights from a source to a target frequency grid
+
+    Args:
+        src_freq (numpy.ndarray): [src chan] centre frequencies of the source grid
+        dst_freq (numpy.ndarray): [dst chan] centre frequencies of the target grid
+
+    Returns:
+        OverlapWeights: sparse fractions of every target channel covered
+            by the source channels
+    """
+    src_freq = np.ravel(np.asarray(src_freq, dtype=float))
+    dst_freq = np.ravel(np.asarray(dst_freq, dtype=float))
+    key = (src_freq.tobytes(), dst_freq.tobytes())
+    with _weight_lock:
+        if key in _weight_cache:
+            _weight_cache[key] = _weight_cache.pop(key)
+            return _weight_cache[key]
+
+    nsrc, ndst = len(src_freq), len(dst_freq)
+    src = np.sort(channel_edges(src_freq))
+    dst = np.sort(channel_edges(dst_freq))
+    # source channels first and last overlapping every target channel
+    first = np.clip(np.searchsorted(src, dst[:-1], side='right') - 1, 0, nsrc - 1)
+    last = np.clip(np.searchsorted(src, dst[1:], side='left') - 1, 0, nsrc - 1)
+    count = np.maximum(last - first + 1, 0)
+    rows = np.repeat(np.arange(ndst), count)
+    cols = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + \
+        np.repeat(first, count)
+    overlap = np.minimum(dst[rows + 1], src[cols + 1]) - np.maximum(dst[rows], src[cols])
+    values = overlap / np.diff(dst)[rows]
+    keep = values > 0
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+    # the edges were sorted, put the channels back in their order
+    if src_freq[0] > src_freq[-1]:
+        cols = nsrc - 1 - cols
+    if dst_freq[0] > dst_freq[-1]:
+        rows = ndst - 1 - rows
+    order = np.argsort(rows, kind='stable')
+    weights = OverlapWeights(rows[order], cols[order], values[order], (ndst, nsrc))
+    logger.debug("Regridding weights for {0} to {1} channels".format(nsrc, ndst))
+
+    with _weight_lock:
+        _weight_cache[key] = weights
+        while len(_weight_cache) > WEIGHT_CACHE_SIZE:
+            _weight_cache.popitem(last=False)
+    return weights
+
+
+def regrid(src_freq, data, dst_freq, axis=-2, min_coverage=0.5):
+    """
+    Regrid spectra onto another frequency grid
+
+    Args:
+        src_freq (numpy.ndarray): [chan] frequencies of the data
+        data (numpy.ndarray): real or complex spectra, NaN where flagged
+        dst_freq (numpy.ndarray): frequencies of the target grid
+        axis (int): channel axis of data, default -2 as in [..., chan, pol]
+        min_coverage (float): minimum fraction of a target channel that
+            has to be covered by valid data
+
+    Returns:
+        numpy.ndarray: data with the channel axis on the target grid
+    """
+    src_freq = np.ravel(src_freq)
+    dst_freq = np.ravel(dst_freq)
+    if np.array_equal(src_freq, dst_freq):
+        return np.array(data)
+    weights = weight_matrix(src_freq, dst_freq)
+    x = np.moveaxis(np.asarray(data), axis, -1)
+    valid = np.isfinite(x)
+    total = weights.apply(np.where(valid, x, 0.))
+    coverage = weights.apply(valid.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = total / coverage
+    res[~(coverage >= min_coverage)] = np.nan
+    return np.moveaxis(res, -1, axis)
+
+
+def regrid_phase(src_freq, phase, dst_freq, axis=-2, min_coverage=0.5):
+    """
+    Regrid phases in degrees, averaging them as unit vectors so phase
+    wraps do not bias the result
+    """
+    phasor = np.exp(1j * np.radians(phase))
+    return np.degrees(np.angle(regrid(src_freq, phasor, dst_freq, axis=axis,
+                                      min_coverage=min_coverage)))
+
+
+def common_grid(*freqs):
+    """
+    Grid covering the overlap of several grids with the widest channel width
+
+    Returns:
+        numpy.ndarray: increasing centre frequencies, empty if the grids do not overlap
+    """
+    lo = max(np.min(channel_edges(np.ravel(f))) for f in freqs)
+    hi = min(np.max(channel_edges(np.ravel(f))) for f in freqs)
+    width = max(np.max(np.abs(np.diff(np.ravel(f)))) for f in freqs)
+    nchan = int(np.floor((hi - lo) / width + 1e-6))
+    if nchan <= 0:
+        return np.array([])
+    return lo + width * (np.arange(nchan) + 0.5)
@@ -8,7 +8,8 @@ Define object classes for holding data related to calibrator scans
 for cross calibration evaluation
 
 It needs the scan number name of the fluxcal (for cross-cal solutions)
-Want to add functionality for pol-cal for pol solutions (secondary)
+The solution tables of all types (including the polarisation tables of
+a pol-cal) are found with get_solution_tables
 This specifies the location of all data, assuming setup of automatic pipeline
 (/data/apertif, distributed across happili nodes)
 """
@@ -27,6 +28,25 @@ This specifies the location of all data, assuming setup of automatic pipeline
 #     return '/data/apertif/{scan}/qa/'.format(scan=scan)
 
 
+def get_data_roots(base_dir=None, search_all_nodes=False):
+    """
+    Get the data directories that hold task directories
+
+    Args:
+        base_dir (str): name of data directory, default /data/apertif/
+        search_all_nodes (bool): Use data directories from all nodes, only affective on happili-01
+
+    Returns:
+        list: data directories, the same that ScanData searches
+    """
+    if base_dir is None:
+        base_dir = '/data/apertif/'
+    if os.uname()[1] == 'happili-01' and search_all_nodes:
+        return [_ for _ in glob.glob(base_dir.replace("/data/", "/data*/"))
+                if not _.startswith('/data5')]
+    return [base_dir]
+
+
 class ScanData(object):
     def __init__(self, task_id, source_name, base_dir=None, search_all_nodes=False):
         """
@@ -92,6 +112,12 @@ class ScanData(object):
         # suffix used for the name of the bandpass
         self.bpass_suffix = 'Bscan'
 
+        # suffixes of all solution tables, see soltable.TABLE_TYPES
+        self.solution_suffixes = ['Bscan', 'G0ph', 'G1ap', 'K', 'Kcross', 'Df', 'Xf']
+
+        # {suffix: {beam: table}}, filled by get_solution_tables
+        self._solution_tables = None
+
         # for path in paths:
         #     allfiles = os.listdir(path)
         #     for f in allfiles:
@@ -228,6 +254,95 @@ class ScanData(object):
                     "Could not find bandpass table {}".format(bpass))
                 return -1
 
+    def get_solution_tables(self, suffix=None):
+        """
+        Function to return the solution tables of all beams.
+
+        The raw directory of every beam is listed only once for all
+        types of solution tables, later calls use the result.
+
+        Args:
+            suffix (str): type of the tables, e.g. 'Df', default all types
+
+        Returns:
+            dict: {beam: table} for one type, or {suffix: {beam: table}}
+        """
+        if self._solution_tables is None:
+            names = dict(("{0}.{1}".format(self.source_name, sfx), sfx)
+                         for sfx in self.solution_suffixes)
+            self._solution_tables = dict((sfx, dict()) for sfx in self.solution_suffixes)
+            for single_dir, beam in zip(self.dir_list, self.beam_list):
+                raw_dir = os.path.join(single_dir, 'raw')
+                try:
+                    entries = os.listdir(raw_dir)
+                except OSError:
+                    logging.warning("Could not list {}".format(raw_dir))
+                    continue
+                for entry in entries:
+                    if entry in names:
+                        self._solution_tables[names[entry]][int(beam)] = \
+                            os.path.join(raw_dir, entry)
+            for sfx in self.solution_suffixes:
+                logging.info("Found {0} {1} tables".format(
+                    len(self._solution_tables[sfx]), sfx))
+
+        if suffix is None:
+            return self._solution_tables
+        return self._solution_tables.get(suffix, dict())
+
+    def get_ms(self, beam_nr=None):
+        """
+        Function to return the measurement set of the calibrator if it exists.
+
+        It is possible to specify a beam number. If a beam is not given,
+        then a list of all measurement sets will be returned
+
+        Args:
+            beam_nr (int): Number of beam, default looks for all beams
+        """
+
+        # if no beam is specified, return a list of measurement sets
+        if beam_nr is None:
+            logging.info("Getting a list of measurement sets")
+
+            ms_list = []
+            for single_dir in self.dir_list:
+                msfile = "{0}/raw/{1}.MS".format(single_dir, self.source_name)
+                if os.path.isdir(msfile):
+                    logging.info("Found measurement set {}".format(msfile))
+                    ms_list.append(msfile)
+                else:
+                    logging.warning(
+                        "Could not find measurement set {}".format(msfile))
+
+            if len(ms_list) == 0:
+                logging.warning("No measurement sets found")
+                return -1
+            else:
+                return ms_list
+
+        else:
+            # get the directory corresponding to the beam:
+            data_dir = self.dir_list[np.where(
+                self.beam_list == '{0:02d}'.format(beam_nr))]
+
+            if len(data_dir) == 0:
+                logging.warning(
+                    "Could not find measurement set for beam {0:02d}".format(beam_nr))
+                return -1
+            else:
+                data_dir = data_dir[0]
+
+            msfile = "{0}/raw/{1}.MS".format(data_dir, self.source_name)
+
+            if os.path.isdir(msfile):
+                logging.info("Found measurement set {}".format(msfile))
+                return msfile
+            else:
+                logging.warning(
+                    "Could not find measurement set {}".format(msfile))
+                return -1
+
     # def get_default_imagepath(self, scan):
     #     """
     #     Wrapper around get_default_imagepath, this can be overridden in scal, ccal with a suffix
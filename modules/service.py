@@ -0,0 +1,364 @@
+# aperCC: resident analysis service with warm caches
+
+"""
+Long-running local service that answers small stability queries
+
+Every apercc or stability.py run is a new Python process that imports
+casacore, finds the beam directories and reads the solution tables
+again, which takes much longer than the query itself. The service keeps
+all of that in memory: the imports, a ScanData index per task and
+source (looked up again after index_ttl seconds), the bandpass cube and
+gain solutions of every task that was queried, and the open table
+handles of tableio. The decoded solutions are read again only when one
+of their tables changed on disk, so repeated queries return in
+milliseconds.
+
+Requests are single lines of JSON over a Unix socket, e.g.
+{"cmd": "bandpass_metrics", "task_id": 190601001, "source": "3C147"},
+answered by a line {"ok": true, "result": ...} or {"ok": false,
+"error": "..."}. The client side only needs the standard library, so
+the client CLI (apercc_service.py) starts in a fraction of a second.
+
+Example:
+    AnalysisService(base_dir='/data/apertif/').serve_forever()
+
+    client = ServiceClient()
+    client.request('bandpass_metrics', task_id=190601001, source='3C147', beam=5)
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+logger = logging.getLogger(__name__)
+
+# default socket, can be overridden by the environment
+DEFAULT_SOCKET = os.environ.get('APERCC_SOCKET',
+                                os.path.join(os.path.expanduser('~'), '.apercc.sock'))
+
+# longest request line that is accepted
+MAX_REQUEST = 1 << 20
+
+
+class ServiceError(IOError):
+    """Error reported by the service or failure to reach it"""
+
+
+def _to_json(obj):
+    """Convert numpy scalars and arrays for json.dumps"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("{0} is not JSON serializable".format(type(obj).__name__))
+
+
+def _encode(obj):
+    return (json.dumps(obj, default=_to_json) + '\n').encode('utf-8')
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Answer the requests of one connection, one JSON line each"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST)
+            if not line:
+                return
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = {'ok': True, 'result': self.server.service.handle(request)}
+            except Exception as e:
+                logger.warning("Request {0!r} failed: {1}".format(line[:200], e))
+                response = {'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+            self.wfile.write(_encode(response))
+            self.wfile.flush()
+            if self.server.service.stopping:
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AnalysisService(object):
+    """
+    Service that keeps the ScanData index and the decoded solutions warm
+
+    Args:
+        socket_path (str): path of the Unix socket, default APERCC_SOCKET
+            or ~/.apercc.sock
+        base_dir (str): default data directory of the tasks
+        search_all_nodes (bool): default for searching the data of all nodes
+        index_ttl (float): seconds after which the beam directories of a
+            task are searched again
+        max_tasks (int): number of tasks whose index and solutions are kept
+    """
+
+    def __init__(self, socket_path=None, base_dir=None, search_all_nodes=False,
+                 index_ttl=300., max_tasks=64):
+        self.socket_path = socket_path or DEFAULT_SOCKET
+        self.base_dir = base_dir
+        self.search_all_nodes = search_all_nodes
+        self.index_ttl = index_ttl
+        self.max_tasks = max_tasks
+        self.started = time.time()
+        self.requests = 0
+        self.stopping = False
+        self._index = dict()
+        self._solutions = dict()
+        self._hits = {'index': 0, 'solutions': 0}
+        self._misses = {'index': 0, 'solutions': 0}
+        # casacore is not thread safe, so queries are answered one at a time
+        self._lock = threading.Lock()
+        self._server = None
+
+    def warm_up(self):
+        """Import the analysis modules and casacore before the first request"""
+        import casacore.tables  # noqa: F401
+        from . import metrics, cube, Sols, scandata  # noqa: F401
+
+    def serve_forever(self):
+        """Listen on the socket until a 'shutdown' request"""
+        self.warm_up()
+        if os.path.exists(self.socket_path):
+            if ping(self.socket_path):
+                raise ServiceError("A service is already listening on {}".format(self.socket_path))
+            os.remove(self.socket_path)
+        # only the owner can connect, also in the moment between bind and chmod
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.socket_path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.service = self
+        os.chmod(self.socket_path, 0o600)
+        logger.info("Listening on {}".format(self.socket_path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            logger.info("Service stopped after {} requests".format(self.requests))
+
+    def handle(self, request):
+        """
+        Answer one request
+
+        Args:
+            request (dict): 'cmd' and the arguments of the command
+
+        Returns:
+            the result, anything that can be converted to JSON
+        """
+        request = dict(request)
+        cmd = request.pop('cmd', None)
+        func = getattr(self, 'do_' + str(cmd), None)
+        if func is None:
+            raise ValueError("Unknown command {}".format(cmd))
+        start = time.time()
+        with self._lock:
+            self.requests += 1
+            result = func(**request)
+        logger.debug("{0} took {1:.1f} ms".format(cmd, 1e3 * (time.time() - start)))
+        return result
+
+    def _scandata(self, task_id, source, base_dir=None, search_all_nodes=None):
+        """ScanData of a task, searched again after index_ttl seconds"""
+        from .scandata import ScanData
+
+        base_dir = base_dir or self.base_dir
+        if search_all_nodes is None:
+            search_all_nodes = self.search_all_nodes
+        key = (int(task_id), source, base_dir, bool(search_all_nodes))
+        found = self._index.get(key)
+        if found is not None and time.time() - found[0] < self.index_ttl:
+            self._hits['index'] += 1
+            return found[1]
+        self._misses['index'] += 1
+        scan_data = ScanData(int(task_id), source, base_dir=base_dir,
+                             search_all_nodes=search_all_nodes)
+        self._index.pop(key, None)
+        while len(self._index) >= self.max_tasks:
+            # the task that was searched first is forgotten first
+            self._index.pop(min(self._index, key=lambda k: self._index[k][0]))
+        self._index[key] = (time.time(), scan_data)
+        return scan_data
+
+    def _solutions_of(self, kind, scan_data):
+        """
+        BandpassCube ('bpass') or {beam: GainSols} ('gain') of a task, read
+        again only if one of its tables changed
+        """
+        from .tableio import table_version
+
+        suffix = scan_data.bpass_suffix if kind == 'bpass' else scan_data.gaintable_suffix
+        tables = scan_data.get_solution_tables(suffix)
+        key = (kind, scan_data.task_id, scan_data.source_name, scan_data.base_dir)
+        versions = sorted((beam, path, table_version(path)) for beam, path in tables.items())
+        cached = self._solutions.get(key)
+        if cached is not None and cached[0] == versions:
+            self._hits['solutions'] += 1
+            return cached[1]
+        self._misses['solutions'] += 1
+        if kind == 'bpass':
+            from .cube import BandpassCube
+            sols = BandpassCube(dict(tables))
+        else:
+            from .Sols import GainSols
+            beams = sorted(tables)
+            sols = dict(zip(beams, GainSols.from_tables([tables[beam] for beam in beams])))
+        self._solutions.pop(key, None)
+        while len(self._solutions) >= self.max_tasks:
+            # the task that was read first is forgotten first
+            self._solutions.pop(min(self._solutions, key=lambda k: self._solutions[k][2]))
+        self._solutions[key] = (versions, sols, time.time())
+        return sols
+
+    @staticmethod
+    def _beams(beam, available):
+        if beam is None:
+            return sorted(available)
+        if int(beam) not in available:
+            raise ValueError("No solutions for beam {0:02d}".format(int(beam)))
+        return [int(beam)]
+
+    def do_ping(self):
+        """Process id, uptime and number of requests"""
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started,
+                'requests': self.requests}
+
+    def do_beams(self, task_id, source, **kwargs):
+        """{suffix: [beams]} of the solution tables of a task"""
+        scan_data = self._scandata(task_id, source, **kwargs)
+        return dict((suffix, sorted(tables))
+                    for suffix, tables in scan_data.get_solution_tables().items())
+
+    def do_bandpass_metrics(self, task_id, source, beam=None, ref_beam=0, **kwargs):
+        """{beam: (metric, ant, corr, value) records} relative to ref_beam, see metrics.bandpass_metrics"""
+        from .Sols import BPSols
+        from .metrics import bandpass_metrics
+
+        cube = self._solutions_of('bpass', self._scandata(task_id, source, **kwargs))
+        present = cube.beams[cube.present].tolist()
+        if int(ref_beam) not in present:
+            raise ValueError("No bandpass solutions for reference beam {0:02d}".format(int(ref_beam)))
+        ref = BPSols.from_cube(cube, int(ref_beam))
+        return dict(('{0:02d}'.format(b), bandpass_metrics(BPSols.from_cube(cube, b), ref))
+                    for b in self._beams(beam, present))
+
+    def do_gain_metrics(self, task_id, source, beam=None, ref_beam=0, align='start', **kwargs):
+        """{beam: (metric, ant, corr, value) records} relative to ref_beam, see metrics.gain_metrics"""
+        from .metrics import gain_metrics
+
+        sols = self._solutions_of('gain', self._scandata(task_id, source, **kwargs))
+        if int(ref_beam) not in sols:
+            raise ValueError("No gain solutions for reference beam {0:02d}".format(int(ref_beam)))
+        ref = sols[int(ref_beam)]
+        return dict(('{0:02d}'.format(b), gain_metrics(sols[b], ref, align=align))
+                    for b in self._beams(beam, sols))
+
+    def do_cache_info(self):
+        """Hits and misses of the caches and the cached tasks"""
+        return {'hits': self._hits, 'misses': self._misses,
+                'tasks': sorted(set('{0} {1}'.format(k[1], k[2]) for k in self._solutions))}
+
+    def do_invalidate(self):
+        """Forget all cached indexes and solutions"""
+        from .tableio import close_tables
+
+        self._index.clear()
+        self._solutions.clear()
+        close_tables()
+        return True
+
+    def do_shutdown(self):
+        """Stop the service after answering"""
+        self.stopping = True
+        threading.Thread(target=self._server.shutdown).start()
+        return True
+
+
+class ServiceClient(object):
+    """
+    Client of an AnalysisService, keeps its connection for repeated requests
+
+    Args:
+        socket_path (str): path of the Unix socket, default APERCC_SOCKET
+            or ~/.apercc.sock
+        timeout (float): seconds to wait for an answer
+    """
+
+    def __init__(self, socket_path=None, timeout=300.):
+        self.socket_path = socket_path or DEFAULT_SOCKET
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            sock.close()
+            raise ServiceError("Cannot reach the service at {0}: {1}".format(self.socket_path, e))
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def request(self, cmd, **kwargs):
+        """
+        Send a request and wait for the answer
+
+        Returns:
+            the result of the command
+
+        Raises:
+            ServiceError: if the service cannot be reached or the request failed
+        """
+        if self._sock is None:
+            self._connect()
+        kwargs['cmd'] = cmd
+        try:
+            self._sock.sendall(_encode(kwargs))
+            line = self._file.readline()
+        except socket.error as e:
+            self.close()
+            raise ServiceError("Lost the connection to the service: {}".format(e))
+        if not line:
+            self.close()
+            raise ServiceError("The service closed the connection")
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise ServiceError(response.get('error'))
+        return response['result']
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = None
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def ping(socket_path=None, timeout=2.):
+    """True if a service answers on the socket"""
+    try:
+        with ServiceClient(socket_path, timeout=timeout) as client:
+            client.request('ping')
+        return True
+    except (ServiceError, socket.error, ValueError):
+        return False
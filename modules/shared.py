@@ -0,0 +1,290 @@
+# aperCC: solution cubes in shared memory for process pools
+
+"""
+Publish solution arrays in shared memory for worker processes
+
+A published array lives in a multiprocessing.shared_memory segment and
+is described by a small SharedArray descriptor (segment name, shape,
+dtype and axis labels). Only the descriptor is pickled to the workers,
+which attach to the segment and get a numpy view of it without copying.
+With pool_map the workers attach once, when they start, and not once per
+task, and share the table read limits of the parent (see throttle).
+
+The process that publishes an array owns its segment. The segment is
+unlinked by release, when the process exits (atexit), or, if the process
+is killed, by the resource tracker of multiprocessing. Workers only
+attach and never unlink.
+
+Without multiprocessing.shared_memory (Python < 3.8) the descriptor
+carries a copy of the array instead, so the same code still works.
+
+Example:
+    shared = cube.share()
+    try:
+        results = pool_map(beam_outliers, range(len(cube.beams)), shared, processes=8)
+    finally:
+        shared.release()
+
+    def beam_outliers(cube, b):
+        ...  # cube is a BandpassCube attached to the shared segments
+"""
+
+import os
+import atexit
+import logging
+import multiprocessing
+
+import numpy as np
+
+from . import throttle
+
+logger = logging.getLogger(__name__)
+
+# segments created by this process, by name, with the id of the process
+# (forked workers inherit the dictionary but do not own the segments)
+_owned = dict()
+# segments attached by this process, by name
+_attached = dict()
+# what the workers of pool_map attached to
+_worker_shared = None
+
+
+class SharedArray(object):
+    """
+    Descriptor of an array in shared memory
+
+    Args:
+        name (str): name of the shared memory segment, None if the
+            descriptor carries the array itself
+        shape (tuple): shape of the array
+        dtype (str): dtype of the array
+        labels (tuple): names of the axes, e.g. ('beam', 'ant', 'chan', 'pol')
+        array (numpy.ndarray): the array, only without shared memory
+    """
+
+    def __init__(self, name, shape, dtype, labels=None, array=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = str(dtype)
+        self.labels = tuple(labels) if labels is not None else None
+        self.array = array
+
+    def __repr__(self):
+        return "SharedArray({0}, shape={1}, dtype={2}, labels={3})".format(
+            self.name, self.shape, self.dtype, self.labels)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def attach(self, writeable=False):
+        """
+        View of the shared array, without copying
+
+        Args:
+            writeable (bool): allow writing to the array, which changes it
+                for every process
+
+        Returns:
+            numpy.ndarray: the array
+        """
+        if self.name is None:
+            return self.array
+        if self.name in _owned:
+            shm = _owned[self.name][0]
+        elif self.name in _attached:
+            shm = _attached[self.name]
+        else:
+            from multiprocessing import shared_memory
+
+            shm = shared_memory.SharedMemory(name=self.name)
+            _attached[self.name] = shm
+        array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        array.flags.writeable = writeable
+        return array
+
+    def release(self):
+        """Unlink the segment if this process owns it"""
+        if self.name is not None and _owns(self.name):
+            _unlink(self.name)
+
+
+def share_array(array, labels=None):
+    """
+    Copy an array to a new shared memory segment
+
+    Args:
+        array (numpy.ndarray): array to publish
+        labels (tuple): names of the axes
+
+    Returns:
+        SharedArray: descriptor to pass to the workers
+    """
+    array = np.ascontiguousarray(array)
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        logger.debug("No shared memory, the descriptor carries the array")
+        return SharedArray(None, array.shape, array.dtype, labels, array=array)
+    # a segment cannot be empty
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    _owned[shm.name] = (shm, os.getpid())
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    logger.debug("Published {0} bytes in {1}".format(array.nbytes, shm.name))
+    return SharedArray(shm.name, array.shape, array.dtype, labels)
+
+
+def _owns(name):
+    return name in _owned and _owned[name][1] == os.getpid()
+
+
+def _unlink(name):
+    shm = _owned.pop(name)[0]
+    shm.close()
+    try:
+        shm.unlink()
+    except OSError:
+        pass
+
+
+def _close_attached():
+    for name in list(_attached):
+        try:
+            _attached.pop(name).close()
+        except BufferError:
+            # a view of the segment is still in use, it is closed on exit
+            pass
+
+
+def release_all():
+    """Unlink all segments owned by this process and detach from all others"""
+    for name in list(_owned):
+        if _owns(name):
+            _unlink(name)
+    _close_attached()
+
+
+atexit.register(release_all)
+
+
+def share_arrays(arrays, labels=None):
+    """
+    Publish the arrays of a dictionary, e.g. the result of bpbeam
+
+    Args:
+        arrays (dict): values that are numpy arrays are published, other
+            values are kept as they are
+        labels (dict): {key: axis labels}
+
+    Returns:
+        dict: the dictionary with descriptors instead of arrays
+    """
+    labels = labels or dict()
+    return dict((key, share_array(value, labels.get(key)) if isinstance(value, np.ndarray)
+                 else value) for key, value in arrays.items())
+
+
+def attach_arrays(shared):
+    """The dictionary of share_arrays with views of the arrays"""
+    return dict((key, value.attach() if isinstance(value, SharedArray) else value)
+                for key, value in shared.items())
+
+
+def release_arrays(shared):
+    """Unlink the arrays of share_arrays"""
+    for value in shared.values():
+        if isinstance(value, SharedArray):
+            value.release()
+
+
+class SharedCube(object):
+    """
+    A BandpassCube in shared memory
+
+    The complex solutions and the packed flags are published, the small
+    arrays (beams, antennas, frequencies, times) are kept in the
+    descriptor.
+
+    Args:
+        cube (BandpassCube): cube to publish
+    """
+
+    labels = ('beam', 'ant', 'chan', 'pol')
+
+    def __init__(self, cube):
+        self.data = share_array(cube.data, self.labels)
+        self.flags = share_array(cube.flags.packed)
+        self.flags_shape = cube.flags.shape
+        self.flags_axis = cube.flags.axis
+        self.meta = dict(tables=cube.tables, beams=cube.beams, present=cube.present,
+                         time=cube.time, ants=cube.ants, freq=cube.freq)
+
+    def attach(self):
+        """
+        The cube with read-only views of the shared arrays
+
+        Returns:
+            BandpassCube: the cube, without reading any table
+        """
+        from .cube import BandpassCube
+        from .flags import PackedFlags
+
+        cube = BandpassCube.__new__(BandpassCube)
+        for key, value in self.meta.items():
+            setattr(cube, key, value)
+        cube.data = self.data.attach()
+        cube.flags = PackedFlags._from_packed(self.flags.attach(), self.flags_shape,
+                                              self.flags_axis)
+        cube._amp = None
+        cube._phase = None
+        return cube
+
+    def release(self):
+        """Unlink the segments if this process owns them"""
+        self.data.release()
+        self.flags.release()
+
+
+def _attach(shared):
+    if isinstance(shared, dict):
+        return attach_arrays(shared)
+    return shared.attach() if shared is not None else None
+
+
+def _init_worker(shared, settings):
+    """Apply the read limits of the parent and attach the shared arrays once in every worker"""
+    global _worker_shared
+    throttle.init_worker(settings)
+    _worker_shared = _attach(shared)
+
+
+def _call(args):
+    func, item = args
+    return func(_worker_shared, item)
+
+
+def pool_map(func, items, shared=None, processes=1):
+    """
+    Map a function over items in a process pool that shares arrays
+
+    Args:
+        func (callable): module-level function func(attached, item), with
+            attached the attached arrays (the result of attach of shared)
+        items (list): items to map over, e.g. beam or antenna indices
+        shared: SharedCube, SharedArray or dictionary of share_arrays
+        processes (int): number of worker processes
+
+    Returns:
+        list: results in the order of the items
+    """
+    items = list(items)
+    if processes <= 1:
+        attached = _attach(shared)
+        return [func(attached, item) for item in items]
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(shared, throttle.settings()))
+    try:
+        return pool.map(_call, [(func, item) for item in items])
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,286 @@
+# aperCC: hour angle and sidereal time of solution times
+
+"""
+Convert solution times to local sidereal time or hour angle and
+resample gains onto a common hour-angle grid
+
+Gains of a calibrator observed on different days are only comparable
+at the same position on the sky: elevation-dependent effects repeat
+with hour angle, not with the time since the start of the scan. The
+sidereal times are computed for whole TIME arrays at once with the
+IAU 1982 expression of the Greenwich mean sidereal time, instead of a
+measures call per sample. UT1 - UTC (below a second) and the equation
+of the equinoxes (about a second) are ignored, which is far below the
+sampling of the gains.
+
+The resampling is linear interpolation of all [beam, ant, pol] series
+in one batched operation: the interpolation indices and weights are
+computed once per beam and applied to all antennas and polarisations.
+Points outside the samples of a beam, next to a flagged sample or in
+gaps larger than max_gap are NaN.
+
+Example:
+    grid, amp, phase = align_cubes([cube1, cube2], mode='hourangle')
+    amp[1] / amp[0]  # [beam, ant, hour angle, pol] ratio of two days
+"""
+
+import logging
+
+import numpy as np
+
+from .tableio import get_phase_dir
+
+logger = logging.getLogger(__name__)
+
+# longitude of the WSRT in degrees east
+WSRT_LONGITUDE = 6.604167
+
+SECONDS_PER_DAY = 86400.
+
+# units of the alignment modes
+MODES = {'start': 'min', 'lst': 'h', 'hourangle': 'h'}
+
+
+def gmst(time):
+    """
+    Greenwich mean sidereal time
+
+    Args:
+        time (numpy.ndarray): times in MJD seconds (UTC), NaN allowed
+
+    Returns:
+        numpy.ndarray: sidereal times in hours in [0, 24)
+    """
+    mjd = np.asarray(time, dtype=float) / SECONDS_PER_DAY
+    # mean sidereal time at 0h UT plus the sidereal time elapsed since then
+    midnight = np.floor(mjd)
+    cent = (midnight - 51544.5) / 36525.  # centuries since J2000.0
+    seconds = 24110.54841 + cent * (8640184.812866 + cent * (0.093104 - 6.2e-6 * cent)) + \
+        1.00273790935 * (mjd - midnight) * SECONDS_PER_DAY
+    return np.mod(seconds / 3600., 24.)
+
+
+def lst(time, longitude=WSRT_LONGITUDE):
+    """
+    Local mean sidereal time
+
+    Args:
+        time (numpy.ndarray): times in MJD seconds (UTC)
+        longitude (float): longitude in degrees east, default the WSRT
+
+    Returns:
+        numpy.ndarray: sidereal times in hours in [0, 24)
+    """
+    return np.mod(gmst(time) + longitude / 15., 24.)
+
+
+def hour_angle(time, ra, longitude=WSRT_LONGITUDE):
+    """
+    Hour angle of a source
+
+    Args:
+        time (numpy.ndarray): times in MJD seconds (UTC)
+        ra (float or numpy.ndarray): right ascension in radians, broadcast with time
+        longitude (float): longitude in degrees east, default the WSRT
+
+    Returns:
+        numpy.ndarray: hour angles in hours in [-12, 12)
+    """
+    return np.mod(lst(time, longitude) - np.degrees(ra) / 15. + 12., 24.) - 12.
+
+
+def unwrap_hours(hours):
+    """
+    Remove the jumps of 24 hours between consecutive samples, so every
+    series increases monotonically
+
+    Args:
+        hours (numpy.ndarray): [..., time] hours, NaN for padding
+
+    Returns:
+        numpy.ndarray: continuous hours starting in the range of the first sample
+    """
+    hours = np.array(hours, dtype=float)
+    with np.errstate(invalid='ignore'):
+        step = np.diff(hours, axis=-1)
+        jump = np.where(step < -12., 24., 0.) - np.where(step > 12., 24., 0.)
+    hours[..., 1:] += np.cumsum(jump, axis=-1)
+    return hours
+
+
+def solution_coordinate(time, mode='hourangle', ra=np.nan, longitude=WSRT_LONGITUDE):
+    """
+    Coordinate to align solutions on
+
+    Args:
+        time (numpy.ndarray): [..., time] times in MJD seconds
+        mode (str): 'start' for minutes since the first sample of every
+            series, 'lst' for sidereal time and 'hourangle' for the hour
+            angle (hours)
+        ra (float or numpy.ndarray): right ascension in radians, broadcast
+            with time[..., :1], only needed for 'hourangle'
+
+    Returns:
+        numpy.ndarray: [..., time] coordinates, see MODES for the units
+    """
+    time = np.asarray(time, dtype=float)
+    if mode == 'start':
+        with np.errstate(invalid='ignore'):
+            return (time - time[..., :1]) / 60.
+    if mode == 'lst':
+        return unwrap_hours(lst(time, longitude))
+    if mode == 'hourangle':
+        return unwrap_hours(hour_angle(time, ra, longitude))
+    raise ValueError("Unknown alignment mode {}".format(mode))
+
+
+def common_grid(coords, step=None):
+    """
+    Regular grid covering the samples of several series
+
+    Args:
+        coords (list): arrays of coordinates, NaN for padding
+        step (float): grid step, default the median sampling interval
+
+    Returns:
+        numpy.ndarray: increasing grid, empty if there are no samples
+    """
+    values = np.concatenate([np.ravel(c) for c in coords]) if len(coords) else np.zeros(0)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.zeros(0)
+    if step is None:
+        steps = np.concatenate([np.diff(np.asarray(c, dtype=float), axis=-1).ravel()
+                                for c in coords])
+        steps = steps[np.isfinite(steps) & (steps > 0)]
+        if steps.size == 0:
+            return np.array([values.min()])
+        step = np.median(steps)
+    lo, hi = values.min(), values.max()
+    return lo + step * np.arange(int(np.floor((hi - lo) / step + 1e-6)) + 1)
+
+
+def interp_weights(x, grid, max_gap=None):
+    """
+    Indices and weights of the linear interpolation of many series onto one grid
+
+    Args:
+        x (numpy.ndarray): [..., n] increasing sample coordinates, NaN padded at the end
+        grid (numpy.ndarray): [m] target coordinates
+        max_gap (float): largest distance between samples to interpolate over
+
+    Returns:
+        tuple: [..., m] index of the sample below, weight of the sample
+            above and mask of the grid points that can be interpolated
+    """
+    x = np.asarray(x, dtype=float)
+    grid = np.asarray(grid, dtype=float)
+    valid = np.isfinite(x)
+    n = valid.sum(axis=-1)[..., None]
+    with np.errstate(invalid='ignore'):
+        # number of samples at or below every grid point, for all series at once
+        below = (np.where(valid, x, np.inf)[..., None, :] <= grid[:, None]).sum(axis=-1)
+    lo = np.clip(below - 1, 0, np.maximum(n - 2, 0))
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    xlo = np.take_along_axis(x, lo, axis=-1)
+    xhi = np.take_along_axis(x, hi, axis=-1)
+    width = xhi - xlo
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(width > 0, (grid - xlo) / width, 0.)
+        inside = (grid >= xlo) & (grid <= xhi) & (n >= 1)
+        if max_gap is not None:
+            inside &= width <= max_gap
+    return lo, w, inside
+
+
+def resample(x, y, grid, axis=-2, max_gap=None):
+    """
+    Linear interpolation of many series onto one grid in one operation
+
+    Args:
+        x (numpy.ndarray): [lead..., n] sample coordinates of every series,
+            increasing and NaN padded at the end
+        y (numpy.ndarray): values, NaN where flagged; the leading dimensions
+            match those of x and axis is the sample axis, e.g.
+            [beam, ant, time, pol] with x of shape [beam, time] and axis 2
+        grid (numpy.ndarray): [m] target coordinates
+        axis (int): sample axis of y
+        max_gap (float): largest distance between samples to interpolate over
+
+    Returns:
+        numpy.ndarray: y with the sample axis on the grid
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y)
+    axis = axis % y.ndim
+    lo, w, inside = interp_weights(x, grid, max_gap=max_gap)
+    lead = x.ndim - 1
+    # [lead..., sample, other...] so the indices broadcast over the other axes
+    ys = np.moveaxis(y, axis, lead)
+    expand = (Ellipsis,) + (None,) * (ys.ndim - lead - 1)
+    ylo = np.take_along_axis(ys, lo[expand], axis=lead)
+    yhi = np.take_along_axis(ys, np.minimum(lo + 1, ys.shape[lead] - 1)[expand], axis=lead)
+    wx = w[expand]
+    res = ylo * (1 - wx) + yhi * wx
+    # exact hits of a sample do not depend on the next one
+    res = np.where(wx == 0, ylo, res)
+    res = np.where(inside[expand], res, np.nan)
+    return np.moveaxis(res, lead, axis)
+
+
+def resample_phase(x, phase, grid, axis=-2, max_gap=None):
+    """
+    Resample phases in degrees, interpolating them as unit vectors so
+    phase wraps do not bias the result
+    """
+    phasor = np.exp(1j * np.radians(phase))
+    return np.degrees(np.angle(resample(x, phasor, grid, axis=axis, max_gap=max_gap)))
+
+
+def table_ra(table):
+    """Right ascension of the first field of a table in radians, NaN if unknown"""
+    try:
+        return float(get_phase_dir(table)[0, 0])
+    except Exception as e:
+        logger.warning("Could not read the phase centre of {0}: {1}".format(table, e))
+        return np.nan
+
+
+def cube_coordinate(cube, mode='hourangle'):
+    """
+    [beam, time] coordinates of the solutions of a GainCube, see solution_coordinate
+    """
+    ra = np.array([table_ra(cube.tables[beam]) if cube.present[b] else np.nan
+                   for b, beam in enumerate(cube.beams)])
+    return solution_coordinate(cube.time, mode, ra=ra[:, None])
+
+
+def align_cubes(cubes, mode='hourangle', grid=None, step=None, max_gap=None):
+    """
+    Resample the gains of several GainCubes (e.g. the same calibrator on
+    different days) onto one grid of hour angle, sidereal time or time
+    since the start
+
+    Args:
+        cubes (list): GainCubes
+        mode (str): 'hourangle', 'lst' or 'start', see solution_coordinate
+        grid (numpy.ndarray): target grid, default a common_grid of all cubes
+        step (float): step of the default grid, default the median sampling
+        max_gap (float): largest distance between samples to interpolate
+            over, default three steps of the grid
+
+    Returns:
+        tuple: grid, and lists of [beam, ant, grid, pol] amplitude and
+            phase (degrees) per cube
+    """
+    coords = [cube_coordinate(cube, mode) for cube in cubes]
+    if grid is None:
+        grid = common_grid(coords, step)
+    grid = np.asarray(grid, dtype=float)
+    if max_gap is None and len(grid) > 1:
+        max_gap = 3 * np.median(np.diff(grid))
+    amps, phases = [], []
+    for cube, x in zip(cubes, coords):
+        amps.append(resample(x, cube.amp, grid, axis=2, max_gap=max_gap))
+        phases.append(resample_phase(x, cube.phase, grid, axis=2, max_gap=max_gap))
+    return grid, amps, phases
@@ -0,0 +1,213 @@
+# aperCC: similarity and grouping of beams
+
+"""
+Which beams of a task have similar bandpasses
+
+Every beam is compared to every other beam, instead of only to beam 00.
+For every antenna and correlation the bandpasses of all beams are
+divided by their median over the beams (amplitude) or referred to their
+circular mean over the beams (phase). What is left are the deviations
+that are specific to a beam. The weighted Pearson correlation of these
+residual spectra is computed for all pairs of beams at once with three
+matrix products. Flagged channels get zero weight, so every pair is
+compared over the channels where both beams are unflagged.
+
+Beams are then grouped per antenna by average-linkage clustering of the
+correlation matrix (averaged over the correlations): groups are merged
+while their average correlation is at least min_corr. Beams whose
+residuals are much larger than those of the other beams (robust z-score
+above threshold) are outliers.
+
+Example:
+    sim = BeamSimilarity(BandpassCube.from_scandata(scandata))
+    sim.matrix  # [ant, pol, beam, beam] correlations
+    sim.groups  # [ant, beam] group labels, -1 for beams in no group
+    sim.outliers  # [ant, beam] True for outlier beams
+"""
+
+import logging
+import warnings
+
+import numpy as np
+
+from .stats import nanmedian, circular_mean, wrap_phase, robust_zscore
+from .metrics import corr_names
+
+logger = logging.getLogger(__name__)
+
+
+def correlation_matrix(x):
+    """
+    Weighted correlation of all pairs of rows, ignoring NaNs
+
+    Args:
+        x (numpy.ndarray): [..., row, chan] spectra, NaN where flagged
+
+    Returns:
+        numpy.ndarray: [..., row, row] Pearson correlation over the channels
+            where both rows are valid (with the mean of every row over all its
+            valid channels), NaN for pairs with fewer than 3 of them
+    """
+    x = np.asarray(x, dtype=float)
+    w = np.isfinite(x).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(w > 0, x, 0.).sum(axis=-1, keepdims=True) / w.sum(axis=-1, keepdims=True)
+    xc = np.where(w > 0, x - mean, 0.)
+    wt = np.swapaxes(w, -1, -2)
+    cross = np.matmul(xc, np.swapaxes(xc, -1, -2))
+    # sum of the squares of row i over the channels where row j is valid
+    norm = np.matmul(xc ** 2, wt)
+    n = np.matmul(w, wt)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = cross / np.sqrt(norm * np.swapaxes(norm, -1, -2))
+    corr[n < 3] = np.nan
+    return corr
+
+
+def cluster(corr, min_corr=0.5):
+    """
+    Average-linkage clustering of a correlation matrix
+
+    Args:
+        corr (numpy.ndarray): [row, row] correlations, NaN rows are not clustered
+        min_corr (float): minimum average correlation of two groups to merge them
+
+    Returns:
+        numpy.ndarray: [row] group labels, numbered from the largest group,
+            -1 for rows in no group (alone or NaN)
+    """
+    n = len(corr)
+    valid = np.where(np.isfinite(np.diag(corr)))[0]
+    finite = np.isfinite(corr)
+    # sums and counts of the correlations between the groups
+    sums = np.where(finite, corr, 0.)[np.ix_(valid, valid)]
+    counts = finite[np.ix_(valid, valid)].astype(float)
+    members = [[i] for i in valid]
+    active = np.ones(len(valid), dtype=bool)
+    np.fill_diagonal(counts, 0.)
+    while active.sum() > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            link = np.where(counts > 0, sums / counts, -np.inf)
+        link[~active] = -np.inf
+        link[:, ~active] = -np.inf
+        np.fill_diagonal(link, -np.inf)
+        i, j = np.unravel_index(np.argmax(link), link.shape)
+        if link[i, j] < min_corr:
+            break
+        # merge group j into group i
+        sums[i] += sums[j]
+        sums[:, i] += sums[:, j]
+        counts[i] += counts[j]
+        counts[:, i] += counts[:, j]
+        counts[i, i] = 0.
+        members[i] += members[j]
+        active[j] = False
+
+    labels = np.full(n, -1, dtype=int)
+    groups = sorted([members[k] for k in np.where(active)[0] if len(members[k]) > 1],
+                    key=lambda group: (-len(group), min(group)))
+    for label, group in enumerate(groups):
+        labels[group] = label
+    return labels
+
+
+def residuals(amp, phase):
+    """
+    Deviations of every beam from the other beams
+
+    Args:
+        amp, phase (numpy.ndarray): [beam, ant, chan, pol] amplitude and phase (degrees)
+
+    Returns:
+        tuple: [beam, ant, chan, pol] amplitude relative to the median over
+            the beams minus one, and phase relative to the circular mean
+            over the beams
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amp_res = amp / nanmedian(amp, axis=0)[None] - 1.
+        phase_res = wrap_phase(phase - circular_mean(phase, axis=0)[None])
+    return amp_res, phase_res
+
+
+class BeamSimilarity(object):
+    """
+    Similarity of the bandpasses of all beams of a BandpassCube
+
+    Args:
+        cube (BandpassCube): bandpass solutions
+        kind (str): 'amp' or 'phase', the residuals that are correlated
+        min_corr (float): minimum average correlation of the beams of a group
+        threshold (float): minimum robust z-score of the residual rms of an outlier
+
+    beams are the beams present in the cube, matrix the [ant, pol, beam,
+    beam] correlations of the residuals, rms the [ant, beam] rms of the
+    residuals, groups the [ant, beam] group labels (-1 for no group),
+    outliers the [ant, beam] outlier mask and mean_similarity the [ant,
+    beam] mean correlation with the other beams.
+    """
+
+    def __init__(self, cube, kind='amp', min_corr=0.5, threshold=5.):
+        present = cube.present
+        self.beams = cube.beams[present]
+        self.ants = cube.ants
+        self.time = cube.time[present]
+        self.kind = kind
+        amp_res, phase_res = residuals(cube.amp[present], cube.phase[present])
+        res = {'amp': amp_res, 'phase': phase_res}[kind]
+
+        # [ant, pol, beam, chan]
+        spectra = np.transpose(res, (1, 3, 0, 2))
+        self.corrs = corr_names(spectra.shape[1])
+        self.matrix = correlation_matrix(spectra)
+
+        nbeam = len(self.beams)
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            # antennas or beams without unflagged solutions give all-NaN slices
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self.rms = np.sqrt(np.nanmean(res ** 2, axis=(2, 3))).T if res.size else \
+                np.full((len(self.ants), nbeam), np.nan)
+            # [ant, beam, beam] averaged over the correlations
+            mean_corr = np.nanmean(self.matrix, axis=1)
+            others = np.where(np.eye(nbeam, dtype=bool), np.nan, mean_corr)
+            self.mean_similarity = np.nanmean(others, axis=-1) if nbeam > 1 else \
+                np.full((len(self.ants), nbeam), np.nan)
+            self.outliers = robust_zscore(self.rms, axis=1, floor=1e-3) > threshold
+        self.groups = np.array([cluster(m, min_corr) for m in mean_corr]).reshape(
+            len(self.ants), nbeam)
+
+    def group_members(self, ant):
+        """The groups of beams of an antenna, largest first"""
+        a = list(self.ants).index(ant)
+        return [self.beams[self.groups[a] == label].tolist()
+                for label in range(self.groups[a].max() + 1)] if len(self.beams) else []
+
+    def records(self, b):
+        """
+        Mean similarity and outlier flag of one beam index as
+        (metric, ant, corr, value) tuples for the metric store
+
+        The group labels are not stored: they are only meaningful within
+        one task, the same label means nothing between tasks.
+        """
+        records = []
+        for a, ant in enumerate(self.ants):
+            for metric, value in [('beam_similarity_' + self.kind, self.mean_similarity[a, b]),
+                                  ('beam_outlier_' + self.kind, self.outliers[a, b])]:
+                if np.isfinite(value):
+                    records.append((metric, ant, 'all', float(value)))
+        return records
+
+
+def store_similarity(cube, task_id, source, store, **kwargs):
+    """
+    Compute the amplitude and phase similarity of the beams of a cube and
+    append them to a MetricStore, see BeamSimilarity.records
+
+    Returns:
+        tuple: BeamSimilarity of the amplitude and of the phase
+    """
+    sims = tuple(BeamSimilarity(cube, kind=kind, **kwargs) for kind in ['amp', 'phase'])
+    for b, beam in enumerate(sims[0].beams):
+        store.append(sims[0].records(b) + sims[1].records(b), task_id, source, beam,
+                     sims[0].time[b])
+    return sims
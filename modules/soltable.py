@@ -0,0 +1,254 @@
+# aperCC: generic reader of calibration solution tables
+
+"""
+Read any of the solution tables that crosscal writes
+
+    Bscan   bandpass                 CPARAM per channel
+    G0ph    gain phase               CPARAM per time
+    G1ap    gain amplitude/phase     CPARAM per time
+    K       delay (ns)               FPARAM per time
+    Kcross  cross-hand delay (ns)    FPARAM per time
+    Df      leakage                  CPARAM per channel
+    Xf      cross-hand phase         CPARAM per channel
+
+The type of a table follows from its suffix, or else from its VisCal
+keyword. All types share one loading path: the rows of any number of
+tables are read with one concatenated query per cell shape (see
+tableio.concat_query), only the columns that are needed are read, and
+the rows are sorted into [ant, time|chan, pol] arrays by antenna and
+time in one vectorized step. Antenna names and frequencies come from the shared metadata cache
+of tableio. Flagged solutions are NaN and the flags are kept bit-packed.
+
+Tables with solutions per channel normally have a single solution time.
+If one has more, the time to use has to be selected with time_index,
+otherwise reading it raises a ValueError.
+
+Example:
+    sols = read_tables(scandata.get_solution_tables('Df').values(), 'Df')
+    sols[0].amp  # [ant, chan, pol] leakage amplitude
+"""
+
+import os
+import logging
+
+import numpy as np
+
+from .tableio import open_table, concat_query, get_antennas, get_frequencies
+from .flags import PackedFlags
+
+logger = logging.getLogger(__name__)
+
+# suffix: (kind, parameter column, axis of the solutions)
+TABLE_TYPES = {
+    'Bscan': ('bandpass', 'CPARAM', 'chan'),
+    'G0ph': ('gain', 'CPARAM', 'time'),
+    'G1ap': ('gain', 'CPARAM', 'time'),
+    'K': ('delay', 'FPARAM', 'time'),
+    'Kcross': ('crossdelay', 'FPARAM', 'time'),
+    'Df': ('leakage', 'CPARAM', 'chan'),
+    'Xf': ('crossphase', 'CPARAM', 'chan'),
+}
+
+# suffix of the tables of every VisCal keyword
+VISCAL = {'B JONES': 'Bscan', 'G JONES': 'G1ap', 'K JONES': 'K', 'KCROSS JONES': 'Kcross',
+          'DF JONES': 'Df', 'XF JONES': 'Xf'}
+
+# antennas of the placeholders of missing tables
+DEFAULT_ANTS = ['RT2', 'RT3', 'RT4', 'RT5', 'RT6', 'RT7', 'RT8', 'RT9', 'RTA', 'RTB', 'RTC', 'RTD']
+
+
+def table_suffix(table):
+    """Suffix of the type of a solution table, from its name or its VisCal keyword"""
+    suffix = os.path.splitext(table.rstrip('/'))[1].lstrip('.')
+    if suffix in TABLE_TYPES:
+        return suffix
+    if not os.path.isdir(table):
+        raise ValueError("Cannot tell the type of table {0}, which does not exist".format(table))
+    viscal = str(open_table(table).getkeyword('VisCal')).upper()
+    if viscal not in VISCAL:
+        raise ValueError("Unknown type of solution table {0} ({1})".format(table, viscal))
+    return VISCAL[viscal]
+
+
+def sort_solutions(time_col, ant_col, param, flags, nant, axis, time_index=None):
+    """
+    Sort the rows of a solution table by antenna and time
+
+    Args:
+        time_col, ant_col (numpy.ndarray): [row] TIME and ANTENNA1
+        param, flags (numpy.ndarray): [row, chan, pol] solutions and flags
+        nant (int): number of antennas
+        axis (str): 'time' for solutions per time (one channel), 'chan'
+            for solutions per channel (of one solution time)
+        time_index (int): solution time to use for solutions per channel,
+            only needed if there is more than one, e.g. -1 for the last
+
+    Returns:
+        tuple: [time] unique times (the selected time for solutions per
+            channel) and [ant, time|chan, pol] solutions (NaN where flagged
+            or missing) and flags
+
+    Raises:
+        ValueError: if solutions per channel have several times and no
+            time_index is given
+    """
+    times, time_pos = np.unique(time_col, return_inverse=True)
+    if axis == 'time':
+        param, flags = param[:, 0, :], flags[:, 0, :]
+        shape = (nant, len(times), param.shape[-1])
+        index = (ant_col, time_pos)
+    else:
+        if len(times) > 1 or time_index is not None:
+            if time_index is None:
+                raise ValueError("{} solution times in solutions per channel, select one "
+                                 "with time_index".format(len(times)))
+            selected = np.arange(len(times))[time_index]
+            logger.debug("Using solution time {0} of {1}".format(selected, len(times)))
+            rows = time_pos == selected
+            ant_col, param, flags = ant_col[rows], param[rows], flags[rows]
+            times = times[[selected]]
+        shape = (nant,) + param.shape[1:]
+        index = ant_col
+    values = np.full(shape, np.nan, dtype=param.dtype if param.dtype.kind == 'c' else float)
+    sorted_flags = np.ones(shape, dtype=bool)
+    values[index] = param
+    sorted_flags[index] = flags
+    values[sorted_flags] = np.nan
+    return times, values, sorted_flags
+
+
+class SolTable(object):
+    """
+    Solutions of one calibration table
+
+    Args:
+        table (str): path of the table
+        suffix (str): type of the table (see TABLE_TYPES), default from the table
+        time_index (int): solution time to use for solutions per channel,
+            see sort_solutions
+
+    kind is the kind of solutions (e.g. 'leakage'), axis 'time' or 'chan',
+    time the solution times (MJD seconds), freq the [spw, chan] frequencies
+    (GHz), values the [ant, time|chan, pol] solutions (complex, or delays in
+    ns), NaN where flagged, and flags the bit-packed flags. Missing tables
+    give a placeholder of NaN with the default antennas.
+    """
+
+    def __init__(self, table, suffix=None, time_index=None):
+        sol = read_tables([table], suffix, time_index=time_index)[0]
+        self.__dict__.update(sol.__dict__)
+
+    @classmethod
+    def _new(cls, table, suffix):
+        sol = cls.__new__(cls)
+        sol.table = table
+        sol.suffix = suffix
+        sol.kind, sol.column, sol.axis = TABLE_TYPES[suffix]
+        sol.present = False
+        return sol
+
+    @classmethod
+    def from_rows(cls, table, suffix, time_col, ant_col, param, flags, time_index=None):
+        """Create the solutions from the TIME, ANTENNA1, parameter and FLAG columns"""
+        sol = cls._new(table, suffix)
+        sol.ants = get_antennas(table)
+        sol.freq = get_frequencies(table)
+        try:
+            sol.time, sol.values, flags = sort_solutions(time_col, ant_col, param, flags,
+                                                         len(sol.ants), sol.axis, time_index)
+        except ValueError as e:
+            raise ValueError("{0}: {1}".format(table, e))
+        sol.flags = PackedFlags(flags, axis=1)
+        sol.present = True
+        return sol
+
+    @classmethod
+    def placeholder(cls, table, suffix, shape=(12, 2, 2)):
+        """NaN solutions for a missing table"""
+        sol = cls._new(table, suffix)
+        sol.ants = list(DEFAULT_ANTS)
+        sol.freq = np.full((2, 2), np.nan)
+        sol.time = np.full(2 if sol.axis == 'time' else 1, np.nan)
+        dtype = complex if sol.column == 'CPARAM' else float
+        sol.values = np.full(shape, np.nan, dtype=dtype)
+        sol.flags = PackedFlags(np.ones(shape, dtype=bool), axis=1)
+        return sol
+
+    @property
+    def amp(self):
+        """[ant, time|chan, pol] amplitude (absolute value of the delays)"""
+        return np.abs(self.values)
+
+    @property
+    def phase(self):
+        """[ant, time|chan, pol] phase in degrees, NaN for delays"""
+        if self.column != 'CPARAM':
+            return np.full(self.values.shape, np.nan)
+        return np.angle(self.values, deg=True)
+
+
+def _cell_shape(table, column):
+    """Shape of the cells of a column as a string, e.g. '[64, 2]', None for an empty table"""
+    t = open_table(table)
+    if t.nrows() == 0:
+        return None
+    return t.getcolshapestring(column, 0, 1)[0]
+
+
+def read_tables(tables, suffix=None, time_index=None):
+    """
+    Read several solution tables of the same type with one concatenated query
+
+    Args:
+        tables (list): paths of the tables, e.g. of all beams of a task
+        suffix (str): type of the tables, default from the name of the first
+            table or else from the first existing table
+        time_index (int): solution time to use for solutions per channel,
+            see sort_solutions
+
+    Returns:
+        list: SolTable per table, placeholders for tables that do not exist
+    """
+    tables = list(tables)
+    if not tables:
+        return []
+    present = [table for table in tables if os.path.isdir(table)]
+    if suffix is None:
+        suffix = table_suffix((present or tables)[0])
+    column = TABLE_TYPES[suffix][1]
+    res = dict()
+    # tables are concatenated only with tables of the same cell shape
+    groups = dict()
+    for table in present:
+        groups.setdefault(_cell_shape(table, column), []).append(table)
+    if len(groups) > 1:
+        logger.warning("{0} tables with {1} different shapes, reading them in {1} queries".format(
+            suffix, len(groups)))
+    columns = ['TIME', 'ANTENNA1', column, 'FLAG']
+    for group in groups.values():
+        t, row_ranges = concat_query(group, columns)
+        data = [t.getcol(col) for col in columns]
+        for table, (start, end) in zip(group, row_ranges):
+            res[table] = SolTable.from_rows(table, suffix, *[col[start:end] for col in data],
+                                            time_index=time_index)
+    for table in tables:
+        if table not in res:
+            logger.info("{0} table {1} not present, filling with NaNs".format(suffix, table))
+    return [res[table] if table in res else SolTable.placeholder(table, suffix)
+            for table in tables]
+
+
+def read_beams(tables, suffix=None, time_index=None):
+    """
+    Read the tables of many beams, e.g. from ScanData.get_solution_tables
+
+    Args:
+        tables (dict): {beam: path}
+        suffix, time_index: see read_tables
+
+    Returns:
+        dict: {beam: SolTable} of the tables that exist
+    """
+    beams = sorted(tables)
+    sols = read_tables([tables[beam] for beam in beams], suffix, time_index=time_index)
+    return dict((beam, sol) for beam, sol in zip(beams, sols) if sol.present)
@@ -0,0 +1,240 @@
+# aperCC: power spectra of gain fluctuations
+
+"""
+Power spectra of the gain amplitude and phase of all beams and antennas
+
+The gain solutions of a calibrator scan are short time series with gaps
+where solutions are flagged, and every beam is observed at different
+times. The spectra are therefore Lomb-Scargle periodograms, which do not
+need evenly sampled data, computed for all [beam, ant, pol] series of a
+GainCube in one vectorized pass over a common frequency grid. Flagged
+(NaN) solutions are left out and every series is detrended (mean or
+linear fit of the unflagged solutions) before the periodogram is taken;
+phases are first referred to their circular mean.
+
+The periodograms are scaled to one-sided power spectral densities
+(amplitude^2/Hz and deg^2/Hz), so the power integrated over a band is
+the variance of the fluctuations on the timescales of that band.
+
+Example:
+    spectra = GainCube.from_scandata(scandata).spectra()
+    spectra.amp_power  # [beam, ant, band, pol] variance per band
+"""
+
+import logging
+
+import numpy as np
+
+from .stats import circular_mean, wrap_phase, nanmedian
+from .metrics import corr_names
+
+logger = logging.getLogger(__name__)
+
+# bands for the trends: (name, lowest and highest frequency in Hz),
+# fluctuations with periods shorter and longer than a minute
+BANDS = (('fast', 1. / 60, np.inf), ('slow', 0., 1. / 60))
+
+
+def detrend(t, y, order=1):
+    """
+    Remove the mean (order 0) or a linear fit (order 1) of the unflagged values
+
+    Args:
+        t (numpy.ndarray): [..., time] times, NaN where missing
+        y (numpy.ndarray): [..., time] values, NaN where flagged
+        order (int): 0 or 1
+
+    Returns:
+        numpy.ndarray: detrended values, NaN where flagged and for series
+            with fewer than order + 2 unflagged values
+    """
+    t, y = np.broadcast_arrays(np.asarray(t, dtype=float), np.asarray(y, dtype=float))
+    valid = np.isfinite(t) & np.isfinite(y)
+    w = valid.astype(float)
+    n = w.sum(axis=-1)[..., None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tm = np.where(valid, t, 0.).sum(axis=-1)[..., None] / n
+        ym = np.where(valid, y, 0.).sum(axis=-1)[..., None] / n
+        res = y - ym
+        if order == 1:
+            dt = np.where(valid, t - tm, 0.)
+            slope = (dt * np.where(valid, res, 0.)).sum(axis=-1)[..., None] / \
+                (dt ** 2).sum(axis=-1)[..., None]
+            res = res - slope * (t - tm)
+        elif order != 0:
+            raise ValueError("Detrending of order {} is not supported".format(order))
+    res[~valid | (n < order + 2)] = np.nan
+    return res
+
+
+def lomb_scargle(t, y, freq):
+    """
+    Lomb-Scargle periodograms of many series at once
+
+    Args:
+        t (numpy.ndarray): [..., time] times in seconds, NaN where missing
+        y (numpy.ndarray): [..., time] values, NaN where flagged, broadcast with t
+        freq (numpy.ndarray): [freq] frequencies in Hz
+
+    Returns:
+        numpy.ndarray: [..., freq] periodograms (classical normalization,
+            which equals |DFT|^2 / N for evenly sampled data)
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = np.isfinite(t) & np.isfinite(y)
+    w = valid.astype(float)
+    yw = np.where(valid, y, 0.)
+    # [..., time, freq] phases of the trial frequencies, only for the shape of t
+    arg = 2 * np.pi * np.where(np.isfinite(t), t, 0.)[..., :, None] * \
+        np.asarray(freq, dtype=float)
+
+    def tsum(x, trig):
+        # sum over time of x * trig(arg), broadcast without [..., freq, time] temporaries
+        return np.matmul(x[..., None, :], trig)[..., 0, :]
+
+    c2, s2 = tsum(w, np.cos(2 * arg)), tsum(w, np.sin(2 * arg))
+    yc, ys = tsum(yw, np.cos(arg)), tsum(yw, np.sin(arg))
+    n = w.sum(axis=-1)[..., None]
+    cc, ss, cs = 0.5 * (n + c2), 0.5 * (n - c2), 0.5 * s2
+    # time offset that makes the sine and cosine terms orthogonal
+    tau2 = np.arctan2(s2, c2)
+    ct, st = np.cos(0.5 * tau2), np.sin(0.5 * tau2)
+    cnorm = ct ** 2 * cc + 2 * ct * st * cs + st ** 2 * ss
+    snorm = st ** 2 * cc - 2 * ct * st * cs + ct ** 2 * ss
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # a term vanishes if its trial function is zero at all samples,
+        # e.g. the sine at the Nyquist frequency of evenly sampled data
+        power = 0.5 * (np.where(cnorm > 1e-10 * n, (ct * yc + st * ys) ** 2 / cnorm, 0.) +
+                       np.where(snorm > 1e-10 * n, (ct * ys - st * yc) ** 2 / snorm, 0.))
+    power[n[..., 0] < 3] = np.nan
+    return power
+
+
+def frequency_grid(t, oversample=2):
+    """
+    Frequencies from the longest span to the Nyquist frequency of the typical sampling
+
+    Args:
+        t (numpy.ndarray): [..., time] times in seconds, NaN where missing
+        oversample (int): number of frequencies per independent frequency
+
+    Returns:
+        numpy.ndarray: frequencies in Hz
+    """
+    t = np.asarray(t, dtype=float)
+    with np.errstate(invalid='ignore'):
+        span = np.nanmax(t, axis=-1) - np.nanmin(t, axis=-1)
+        steps = np.diff(np.sort(t, axis=-1), axis=-1)
+    steps = steps[np.isfinite(steps) & (steps > 0)]
+    span = np.nanmax(span) if np.isfinite(span).any() else 0.
+    if span <= 0 or steps.size == 0:
+        return np.zeros(0)
+    df = 1. / (oversample * span)
+    return np.arange(1, int(0.5 / np.median(steps) / df) + 1) * df
+
+
+def band_powers(freq, psd, bands=BANDS):
+    """
+    Integrate power spectral densities over frequency bands
+
+    Args:
+        freq (numpy.ndarray): [freq] frequencies in Hz
+        psd (numpy.ndarray): [..., freq] power spectral densities
+        bands (tuple): (name, lowest, highest frequency) of every band
+
+    Returns:
+        numpy.ndarray: [..., band] power, NaN for bands without frequencies
+    """
+    df = np.gradient(freq) if len(freq) > 1 else np.ones(len(freq))
+    res = np.full(psd.shape[:-1] + (len(bands),), np.nan)
+    for i, (_, low, high) in enumerate(bands):
+        inband = (freq >= low) & (freq < high)
+        if inband.any():
+            res[..., i] = (psd[..., inband] * df[inband]).sum(axis=-1)
+    return res
+
+
+class GainSpectra(object):
+    """
+    Power spectra of the gain fluctuations of a GainCube
+
+    Args:
+        cube (GainCube): gain solutions
+        freq (numpy.ndarray): frequencies in Hz, default from the solution times
+        oversample (int): oversampling of the default frequencies
+        order (int): detrending, 0 for the mean and 1 for a linear fit
+        bands (tuple): (name, lowest, highest frequency) of the band powers
+
+    freq are the frequencies (Hz), amp and phase the [beam, ant, freq, pol]
+    power spectral densities (1/Hz and deg^2/Hz) and amp_power and
+    phase_power the [beam, ant, band, pol] band powers (variances).
+    """
+
+    def __init__(self, cube, freq=None, oversample=2, order=1, bands=BANDS):
+        self.beams = cube.beams
+        self.present = cube.present
+        self.ants = cube.ants
+        self.bands = bands
+        self.band_names = [band[0] for band in bands]
+        self.start = np.array([np.nanmin(t) if np.isfinite(t).any() else np.nan
+                               for t in cube.time])
+        # seconds since the start of every beam, [beam, 1, 1, time]
+        t = (cube.time - self.start[:, None])[:, None, None, :]
+        self.freq = frequency_grid(t, oversample) if freq is None else np.asarray(freq)
+
+        amp = np.moveaxis(cube.amp, 2, -1)
+        phase = np.moveaxis(cube.phase, 2, -1)
+        with np.errstate(invalid='ignore'):
+            phase = wrap_phase(phase - circular_mean(phase, axis=-1)[..., None])
+        self.amp = self._psd(t, detrend(t, amp, order))
+        self.phase = self._psd(t, detrend(t, phase, order))
+        self.amp_power = np.moveaxis(band_powers(self.freq, self.amp, bands), -1, 2)
+        self.phase_power = np.moveaxis(band_powers(self.freq, self.phase, bands), -1, 2)
+        self.amp = np.moveaxis(self.amp, -1, 2)
+        self.phase = np.moveaxis(self.phase, -1, 2)
+
+    def _psd(self, t, y):
+        """
+        One-sided power spectral density of the periodogram, scaled with
+        the sampling interval (the median step between unflagged samples,
+        so flagged gaps do not count as longer sampling)
+        """
+        valid = np.isfinite(t) & np.isfinite(y)
+        with np.errstate(invalid='ignore'):
+            steps = np.diff(np.sort(np.where(valid, t, np.nan), axis=-1), axis=-1)
+        dt = nanmedian(steps, axis=-1) if steps.shape[-1] else np.full(steps.shape[:-1], np.nan)
+        return 2 * lomb_scargle(t, y, self.freq) * dt[..., None]
+
+    def records(self, b):
+        """Band powers of one beam index as (metric, ant, corr, value) tuples for the metric store"""
+        corrs = corr_names(self.amp_power.shape[-1])
+        records = []
+        for kind, power in [('amp', self.amp_power), ('phase', self.phase_power)]:
+            for i, band in enumerate(self.band_names):
+                metric = 'gain_{0}_power_{1}'.format(kind, band)
+                for a, ant in enumerate(self.ants):
+                    for c, corr in enumerate(corrs):
+                        if np.isfinite(power[b, a, i, c]):
+                            records.append((metric, ant, corr, float(power[b, a, i, c])))
+        return records
+
+
+def gain_spectra(cube, **kwargs):
+    """Power spectra of the gain fluctuations of a GainCube, see GainSpectra"""
+    return GainSpectra(cube, **kwargs)
+
+
+def store_gain_spectra(cube, task_id, source, store, **kwargs):
+    """
+    Compute the gain spectra of all beams of a GainCube and append the band
+    powers to a MetricStore as metrics 'gain_<amp|phase>_power_<band>'
+
+    Returns:
+        GainSpectra: the spectra
+    """
+    spectra = GainSpectra(cube, **kwargs)
+    for b, beam in enumerate(cube.beams):
+        if cube.present[b]:
+            store.append(spectra.records(b), task_id, source, beam, spectra.start[b])
+    return spectra
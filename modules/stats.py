@@ -0,0 +1,209 @@
+# aperCC: robust statistics of solution cubes
+
+"""
+NaN-aware robust statistics for outlier detection
+
+The functions work on normalized [beam, ant, chan|time, pol] cubes
+(or any other array) along any axis, with NaN for flagged data:
+median and median absolute deviation, circular mean and standard
+deviation of phases in degrees, and flagged fractions.
+
+find_outliers summarizes the cube per beam, antenna and channel (the
+median amplitude, its MAD, the circular phase scatter and the flagged
+fraction of every index), scores every index by how far these are from
+the other indices in robust standard deviations, and returns ranked
+outlier lists. All of it is vectorized, so it runs on a full task in
+a fraction of a second and can check every apercc run.
+
+Example:
+    amp_norm, phase_norm = cube.normalize()
+    outliers = find_outliers(amp_norm, phase_norm,
+                             labels={'beam': cube.beams, 'ant': cube.ants})
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# scale of the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+
+AXES = ('beam', 'ant', 'chan', 'pol')
+
+# smallest scale of the summary statistics when ranking outliers, so
+# indices that agree to within these are never outliers
+SCALE_FLOORS = {'amp_median': 1e-3, 'amp_mad': 1e-3, 'flagged': 0.01,
+                'phase_mean': 0.1, 'phase_std': 0.1}
+
+# statistics for which only high values indicate a problem
+ONE_SIDED = ('amp_mad', 'flagged', 'phase_std')
+
+
+def wrap_phase(phase):
+    """Wrap phases in degrees into [-180, 180)"""
+    return (np.asarray(phase) + 180.) % 360. - 180.
+
+
+def nanmedian(x, axis=None):
+    """
+    Median ignoring NaNs and infinities, NaN where no value is finite
+
+    Sorts once instead of per spectrum, which is much faster than
+    numpy.nanmedian for arrays with many NaNs.
+    """
+    x = np.asarray(x, dtype=float)
+    if axis is None:
+        x, axis = x.ravel(), 0
+    # infinities are masked like NaNs, which are sorted to the end
+    x = np.sort(np.where(np.isfinite(x), x, np.nan), axis=axis)
+    n = np.isfinite(x).sum(axis=axis, keepdims=True)
+    lo = np.take_along_axis(x, np.maximum((n - 1) // 2, 0), axis=axis)
+    hi = np.take_along_axis(x, n // 2, axis=axis)
+    med = np.where(n > 0, 0.5 * (lo + hi), np.nan)
+    return np.squeeze(med, axis=axis)
+
+
+def mad(x, axis=None, scale=MAD_SCALE):
+    """Median absolute deviation ignoring NaNs, scaled to a standard deviation"""
+    x = np.asarray(x, dtype=float)
+    med = nanmedian(x, axis=axis)
+    if axis is not None:
+        med = np.expand_dims(med, axis)
+    return scale * nanmedian(np.abs(x - med), axis=axis)
+
+
+def _resultant(phase, axis):
+    """Mean resultant vector of phases in degrees, and the number of valid phases"""
+    rad = np.radians(np.asarray(phase, dtype=float))
+    valid = np.isfinite(rad)
+    n = valid.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c = np.where(valid, np.cos(rad), 0.).sum(axis=axis) / n
+        s = np.where(valid, np.sin(rad), 0.).sum(axis=axis) / n
+    return c, s
+
+
+def circular_mean(phase, axis=None):
+    """Circular mean of phases in degrees ignoring NaNs, in [-180, 180]"""
+    c, s = _resultant(phase, axis)
+    return np.degrees(np.arctan2(s, c))
+
+
+def circular_std(phase, axis=None):
+    """Circular standard deviation of phases in degrees ignoring NaNs"""
+    c, s = _resultant(phase, axis)
+    r = np.clip(np.hypot(c, s), 1e-300, 1.)
+    return np.degrees(np.sqrt(-2. * np.log(r)))
+
+
+def flagged_fraction(x, axis=None):
+    """Fraction of NaN (flagged) values"""
+    return np.mean(~np.isfinite(x), axis=axis)
+
+
+def robust_zscore(x, axis=None, floor=0.):
+    """Deviation from the median in units of the MAD (at least floor)"""
+    x = np.asarray(x, dtype=float)
+    med = nanmedian(x, axis=axis)
+    scale = mad(x, axis=axis)
+    if axis is not None:
+        med = np.expand_dims(med, axis)
+        scale = np.expand_dims(scale, axis)
+    # the floor keeps identical values from giving infinite scores
+    scale = np.maximum(scale, max(floor, 1e-12))
+    return (x - med) / scale
+
+
+def summarize(amp, phase=None, axis=0):
+    """
+    Statistics per index of one axis over all other axes
+
+    Args:
+        amp (numpy.ndarray): normalized amplitudes, NaN where flagged
+        phase (numpy.ndarray): phase differences in degrees, optional
+        axis (int): axis to summarize along
+
+    Returns:
+        dict: arrays with one value per index of the axis: 'amp_median',
+            'amp_mad', 'flagged' and (with phases) 'phase_mean' and 'phase_std'
+    """
+    amp = np.moveaxis(np.asarray(amp, dtype=float), axis, 0)
+    amp = amp.reshape(len(amp), -1)
+    res = {'amp_median': nanmedian(amp, axis=1),
+           'amp_mad': mad(amp, axis=1),
+           'flagged': flagged_fraction(amp, axis=1)}
+    if phase is not None:
+        phase = np.moveaxis(np.asarray(phase, dtype=float), axis, 0)
+        phase = phase.reshape(len(phase), -1)
+        res['phase_mean'] = circular_mean(phase, axis=1)
+        res['phase_std'] = circular_std(phase, axis=1)
+    return res
+
+
+def rank_outliers(amp, phase=None, axis=0, labels=None, threshold=5., name=None):
+    """
+    Rank the indices of one axis by how much they deviate from the others
+
+    The score of an index is the largest robust z-score of its summary
+    statistics (see summarize) among all indices of the axis. Scatter
+    and flagged fraction only count when they are high, so e.g. the
+    reference beam of a normalized cube is no outlier.
+
+    Args:
+        amp, phase (numpy.ndarray): normalized amplitudes and phase differences
+        axis (int): axis to rank
+        labels (list): names of the indices, e.g. beam numbers or antenna names
+        threshold (float): minimum score of an outlier
+        name (str): name of the axis in the results
+
+    Returns:
+        list: dictionaries with axis, index, label, score, the statistic
+            that deviates most and the summary statistics, highest score first
+    """
+    summary = summarize(amp, phase, axis=axis)
+    keys = sorted(summary)
+    scores = dict()
+    for key in keys:
+        values = summary[key]
+        if key == 'phase_mean':
+            values = wrap_phase(values - circular_mean(values))
+        z = robust_zscore(values, floor=SCALE_FLOORS.get(key, 0.))
+        scores[key] = z if key in ONE_SIDED else np.abs(z)
+    table = np.array([scores[key] for key in keys])
+    table[~np.isfinite(table)] = -1.
+    worst = np.argmax(table, axis=0)
+    score = table[worst, np.arange(table.shape[1])]
+
+    outliers = []
+    for i in np.argsort(-score, kind='stable'):
+        if score[i] < threshold:
+            break
+        outlier = {'axis': name if name is not None else axis, 'index': int(i),
+                   'label': labels[i] if labels is not None else int(i),
+                   'score': float(score[i]), 'statistic': keys[worst[i]]}
+        outlier.update((key, float(summary[key][i])) for key in keys)
+        outliers.append(outlier)
+    return outliers
+
+
+def find_outliers(amp, phase=None, labels=None, axes=('beam', 'ant', 'chan'),
+                  threshold=5.):
+    """
+    Ranked outlier lists of a normalized [beam, ant, chan|time, pol] cube
+
+    Args:
+        amp, phase (numpy.ndarray): normalized amplitudes and phase differences
+        labels (dict): {axis name: labels of the indices}
+        axes (tuple): names of the axes to rank, see AXES
+        threshold (float): minimum score of an outlier
+
+    Returns:
+        dict: {axis name: list of outliers} as returned by rank_outliers
+    """
+    labels = labels or dict()
+    return {name: rank_outliers(amp, phase, axis=AXES.index(name),
+                                labels=labels.get(name), threshold=threshold,
+                                name=name)
+            for name in axes}
@@ -0,0 +1,498 @@
+# aperCC: casacore table access with optional I/O profiling
+
+"""
+All table reads of aperCC go through the functions in this module.
+
+When profiling is enabled (by setting the environment variable
+APERCC_PROFILE_IO=1 or by calling enable_profiling), every query or
+opened table is recorded with the query text, the table path, the
+number of rows, the bytes of the columns read from it and the wall time
+spent in the query and the reads. profile_summary gives the slowest
+queries and the tables with most time spent on them; with the
+environment variable set, the summary is logged at the end of the run.
+
+Tables opened with open_table are kept open read-only in a bounded
+pool (least recently used handles are closed first), so repeated reads
+of the same table do not reopen it. The ANTENNA names and frequencies
+of solution tables are cached by a fingerprint of the subtable
+contents, so all beams of a task share one antenna tuple and one
+frequency array.
+
+All queries and reads respect the bandwidth and concurrency limits set
+in throttle.
+
+concat_query and concat_getcol read the same columns of many tables
+(e.g. all beams of a task) with one query over the concatenated tables
+and split the result by the row ranges of the tables.
+
+Example:
+    enable_profiling()
+    BPSols(table)
+    log_profile_summary()
+"""
+
+import os
+import re
+import atexit
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+from . import throttle
+
+logger = logging.getLogger(__name__)
+
+# name of the environment variable that switches on profiling
+PROFILE_ENV = 'APERCC_PROFILE_IO'
+
+# maximum number of table handles kept open
+POOL_SIZE = 64
+
+# maximum number of (sub)table fingerprints kept
+FINGERPRINTS_SIZE = 4096
+
+_records = None
+_lock = threading.Lock()
+
+
+def enable_profiling():
+    """Start recording table access, discarding earlier records"""
+    global _records
+    with _lock:
+        _records = []
+
+
+def disable_profiling():
+    """Stop recording table access"""
+    global _records
+    with _lock:
+        _records = None
+
+
+def profiling_enabled():
+    """Return True if table access is recorded"""
+    return _records is not None
+
+
+def table_path(query):
+    """Return the path of the (main) table a TaQL query reads from"""
+    match = re.search(r'\bFROM\s+\[([^\]]*)\]', query, re.IGNORECASE)
+    if match is not None:
+        # concatenated tables
+        tables = match.group(1).split(',')
+        return '[{0}, ... ({1} tables)]'.format(tables[0].strip(), len(tables))
+    match = re.search(r'\bFROM\s+(\S+)', query, re.IGNORECASE)
+    if match is None:
+        return None
+    return match.group(1).split('::')[0]
+
+
+class ProfiledTable(object):
+    """
+    Wrapper around a casacore table adding the column reads to a profile
+    record (if profiling) and applying the read limits of throttle
+
+    All other attributes are passed on to the table.
+    """
+
+    def __init__(self, table, record=None):
+        self._table = table
+        self._record = record
+
+    def __getattr__(self, name):
+        return getattr(self._table, name)
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def _read(self, func, *args, **kwargs):
+        start = time()
+        with throttle.table_slot():
+            res = func(*args, **kwargs)
+        if self._record is not None:
+            self._record['seconds'] += time() - start
+        return res
+
+    def _add_bytes(self, nbytes):
+        throttle.account(nbytes)
+        if self._record is not None:
+            self._record['bytes'] += nbytes
+
+    @staticmethod
+    def _nbytes(value):
+        # record cells come back as dictionaries, they are not counted
+        if isinstance(value, dict):
+            return 0
+        return np.asarray(value).nbytes
+
+    def getcol(self, *args, **kwargs):
+        res = self._read(self._table.getcol, *args, **kwargs)
+        self._add_bytes(self._nbytes(res))
+        return res
+
+    def getcell(self, *args, **kwargs):
+        res = self._read(self._table.getcell, *args, **kwargs)
+        self._add_bytes(self._nbytes(res))
+        return res
+
+    def getcolnp(self, columnname, nparray, *args, **kwargs):
+        res = self._read(self._table.getcolnp, columnname, nparray, *args, **kwargs)
+        self._add_bytes(nparray.nbytes)
+        return res
+
+
+def _record(query, table, start):
+    """Create a profile record for a query or opened table"""
+    rec = {'query': query, 'table': table, 'rows': 0, 'bytes': 0,
+           'seconds': time() - start}
+    with _lock:
+        if _records is not None:
+            _records.append(rec)
+    return rec
+
+
+def taql(query):
+    """
+    Run a TaQL query
+
+    Args:
+        query (str): TaQL command
+
+    Returns:
+        casacore table (wrapped in a ProfiledTable when profiling or throttling)
+    """
+    import casacore.tables as pt
+
+    start = time()
+    with throttle.table_slot():
+        t = pt.taql(query)
+    if not profiling_enabled() and not throttle.enabled():
+        return t
+    rec = None
+    if profiling_enabled():
+        rec = _record(query, table_path(query), start)
+        rec['rows'] = t.nrows()
+    return ProfiledTable(t, rec)
+
+
+def concat_query(tables, columns):
+    """
+    Run one TaQL query over the concatenation of several tables
+
+    Args:
+        tables (list): paths of tables with the same columns, e.g. the
+            solution tables of all beams of a task or of one beam in many tasks
+        columns (list): columns (or TaQL expressions) to select
+
+    Returns:
+        tuple: (table, row ranges), where row_ranges is a list of
+            (start, end) rows of every input table in the result
+    """
+    nrows = np.array([open_table(path).nrows() for path in tables], dtype=int)
+    ends = np.cumsum(nrows)
+    row_ranges = list(zip((ends - nrows).tolist(), ends.tolist()))
+    query = "SELECT {0} FROM [{1}]".format(', '.join(columns), ', '.join(tables))
+    return taql(query), row_ranges
+
+
+def concat_getcol(tables, columns):
+    """
+    Read columns from several tables in a single concatenated query
+
+    Args:
+        tables (list): paths of tables with the same columns
+        columns (list): names of the columns to read
+
+    Returns:
+        dict: {column: list of arrays, one per table}, the arrays are
+            views into one array holding the column of all tables
+    """
+    t, row_ranges = concat_query(tables, columns)
+    res = dict()
+    for col in columns:
+        data = t.getcol(col)
+        res[col] = [data[start:end] for start, end in row_ranges]
+    return res
+
+
+class TablePool(object):
+    """
+    Bounded pool of open read-only table handles
+
+    A handle is reopened if its table was changed on disk since it was
+    opened. The least recently used handle is closed when the pool is full.
+
+    Args:
+        maxsize (int): maximum number of open handles
+    """
+
+    def __init__(self, maxsize=POOL_SIZE):
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return an open handle for the table at path"""
+        import casacore.tables as pt
+
+        mtime = _mtime(path)
+        with self._lock:
+            if path in self._tables:
+                t, opened = self._tables.pop(path)
+                if opened == mtime:
+                    self._tables[path] = (t, opened)
+                    return t
+                t.close()
+            t = pt.table(path, ack=False)
+            self._tables[path] = (t, mtime)
+            while len(self._tables) > self.maxsize:
+                _, (old, _) = self._tables.popitem(last=False)
+                old.close()
+            return t
+
+    def discard(self, path):
+        """Close the handle of a table, e.g. before it is written to"""
+        with self._lock:
+            if path in self._tables:
+                t, _ = self._tables.pop(path)
+                t.close()
+
+    def close(self):
+        """Close all handles"""
+        with self._lock:
+            for t, _ in self._tables.values():
+                t.close()
+            self._tables = OrderedDict()
+
+
+def _mtime(path):
+    """Modification time of the table description of a table"""
+    try:
+        return os.path.getmtime(os.path.join(path, 'table.dat'))
+    except OSError:
+        return None
+
+
+_pool = TablePool()
+
+
+def table_version(path):
+    """
+    Version of a table for caches of its contents: the modification
+    time of its description, None if the table does not exist
+    """
+    return _mtime(path)
+
+
+def open_table(path):
+    """
+    Get a read-only handle for a table from the pool
+
+    The handle is shared and must not be closed by the caller.
+
+    Args:
+        path (str): path of the table
+
+    Returns:
+        casacore table (wrapped in a ProfiledTable when profiling or throttling)
+    """
+    # table keywords refer to subtables as 'Table: <path>'
+    if path.startswith('Table: '):
+        path = path[len('Table: '):]
+    start = time()
+    with throttle.table_slot():
+        t = _pool.get(path)
+    if not profiling_enabled() and not throttle.enabled():
+        return t
+    rec = None
+    if profiling_enabled():
+        rec = _record('OPEN {}'.format(path), path.split('::')[0], start)
+        rec['rows'] = t.nrows()
+    return ProfiledTable(t, rec)
+
+
+def update_table(path):
+    """
+    Open a table for writing, e.g. to write the CORRECTED_DATA column of
+    a measurement set
+
+    The handle is not pooled, the caller has to close it. A pooled
+    read-only handle of the table is closed, so later reads see the changes.
+
+    Args:
+        path (str): path of the table
+
+    Returns:
+        casacore table (wrapped in a ProfiledTable when profiling or throttling)
+    """
+    import casacore.tables as pt
+
+    _pool.discard(path)
+    start = time()
+    with throttle.table_slot():
+        t = pt.table(path, readonly=False, ack=False)
+    if not profiling_enabled() and not throttle.enabled():
+        return t
+    rec = None
+    if profiling_enabled():
+        rec = _record('UPDATE {}'.format(path), path, start)
+        rec['rows'] = t.nrows()
+    return ProfiledTable(t, rec)
+
+
+def close_tables():
+    """Close all pooled table handles"""
+    _pool.close()
+
+
+_fingerprints = OrderedDict()
+_fingerprints_lock = threading.Lock()
+_metadata = dict()
+_metadata_lock = threading.Lock()
+
+
+def fingerprint(path):
+    """
+    Fingerprint of the contents of a (sub)table directory
+
+    The fingerprint is computed again only if the table changed on disk.
+    The fingerprints of the FINGERPRINTS_SIZE most recently used tables
+    are kept.
+    """
+    mtime = _mtime(path)
+    with _fingerprints_lock:
+        known = _fingerprints.pop(path, None)
+        if known is not None and known[0] == mtime:
+            _fingerprints[path] = known
+            return known[1]
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isfile(full):
+            sha.update(name.encode())
+            with open(full, 'rb') as f:
+                sha.update(f.read())
+    fp = sha.hexdigest()
+    with _fingerprints_lock:
+        _fingerprints.pop(path, None)
+        _fingerprints[path] = (mtime, fp)
+        while len(_fingerprints) > FINGERPRINTS_SIZE:
+            _fingerprints.popitem(last=False)
+    return fp
+
+
+def _subtable_metadata(table, subtable, column, convert):
+    """Read a column of a subtable, cached by the subtable contents"""
+    path = os.path.join(table, subtable)
+    if not os.path.isdir(path):
+        return convert(taql("SELECT {0} FROM {1}::{2}".format(column, table, subtable)).getcol(column))
+    key = (subtable, column, fingerprint(path))
+    with _metadata_lock:
+        if key not in _metadata:
+            _metadata[key] = convert(open_table(path).getcol(column))
+        return _metadata[key]
+
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+def get_antennas(table):
+    """
+    Antenna names of a solution table
+
+    Returns:
+        tuple: antenna names, shared by all tables with the same ANTENNA subtable
+    """
+    return _subtable_metadata(table, 'ANTENNA', 'NAME', tuple)
+
+
+def get_frequencies(table):
+    """
+    Channel frequencies of a solution table in GHz
+
+    Returns:
+        numpy.ndarray: read-only [spw, chan] frequencies, shared by all
+            tables with the same SPECTRAL_WINDOW subtable
+    """
+    return _subtable_metadata(table, 'SPECTRAL_WINDOW', 'CHAN_FREQ',
+                              lambda freq: _readonly(freq / 1e9))
+
+
+def get_corr_types(table):
+    """
+    Correlation types (Stokes codes, e.g. 9, 10, 11, 12 for XX, XY, YX, YY)
+    of the first polarization setup of a measurement set
+
+    Returns:
+        tuple: correlation types
+    """
+    return _subtable_metadata(table, 'POLARIZATION', 'CORR_TYPE',
+                              lambda corr: tuple(int(c) for c in corr[0]))
+
+
+def get_phase_dir(table):
+    """
+    Phase centres of the fields of a solution table or measurement set
+
+    Returns:
+        numpy.ndarray: read-only [field, 2] right ascension and declination
+            in radians, shared by all tables with the same FIELD subtable
+    """
+    return _subtable_metadata(table, 'FIELD', 'PHASE_DIR',
+                              lambda direction: _readonly(np.array(direction[:, 0, :])))
+
+
+def profile_summary(n=10):
+    """
+    Summary of the recorded table access
+
+    Args:
+        n (int): number of queries and tables to list
+
+    Returns:
+        dict: 'slowest_queries' (list of records), 'hottest_tables' (list of
+            per-table totals with table, queries, rows, bytes and seconds),
+            and the overall 'queries', 'bytes' and 'seconds'
+    """
+    with _lock:
+        records = list(_records or [])
+
+    tables = dict()
+    for rec in records:
+        tot = tables.setdefault(rec['table'], {'table': rec['table'], 'queries': 0,
+                                               'rows': 0, 'bytes': 0, 'seconds': 0.})
+        tot['queries'] += 1
+        for key in ['rows', 'bytes', 'seconds']:
+            tot[key] += rec[key]
+
+    return {'slowest_queries': sorted(records, key=lambda r: -r['seconds'])[:n],
+            'hottest_tables': sorted(tables.values(), key=lambda r: -r['seconds'])[:n],
+            'queries': len(records),
+            'bytes': sum(rec['bytes'] for rec in records),
+            'seconds': sum(rec['seconds'] for rec in records)}
+
+
+def log_profile_summary(n=10):
+    """Log the summary of the recorded table access"""
+    summary = profile_summary(n=n)
+    logger.info("Table access: {0} queries, {1:.1f} MB, {2:.2f}s".format(
+        summary['queries'], summary['bytes'] / 1e6, summary['seconds']))
+    logger.info("Slowest queries:")
+    for rec in summary['slowest_queries']:
+        logger.info("  {0:8.3f}s {1:10d} B {2:6d} rows  {3}".format(
+            rec['seconds'], rec['bytes'], rec['rows'], rec['query']))
+    logger.info("Hottest tables:")
+    for tot in summary['hottest_tables']:
+        logger.info("  {0:8.3f}s {1:10d} B {2:4d} queries  {3}".format(
+            tot['seconds'], tot['bytes'], tot['queries'], tot['table']))
+
+
+if os.environ.get(PROFILE_ENV, '0') not in ['', '0']:
+    enable_profiling()
+    atexit.register(log_profile_summary)
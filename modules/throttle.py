@@ -0,0 +1,227 @@
+# aperCC: resource-governed execution alongside production processing
+
+"""
+Limit the resources aperCC takes from the happili nodes
+
+The table reads in tableio (and so all loaders in Sols.py and cube.py)
+are governed by the settings of this module:
+
+    read_bandwidth   maximum average read rate in bytes per second
+    max_open_tables  maximum number of table queries/reads running at the same time
+
+Batch drivers can in addition lower the CPU and I/O priority of their
+worker processes with lower_priority and process tasks newest first
+with newest_first.
+
+The settings can be given with configure or the environment variables
+APERCC_READ_BANDWIDTH (MB/s), APERCC_MAX_OPEN_TABLES and
+APERCC_LOW_PRIORITY (set to 1 to lower the priority at import). By
+themselves they apply per process. A batch driver that starts several
+processes gets the settings from shared_settings before starting them
+and passes them to configure in every process (e.g. with init_worker as
+the initializer of a multiprocessing.Pool): the read rate and the
+concurrent reads are then limited over all these processes together.
+
+Example:
+    configure(read_bandwidth=50e6, max_open_tables=2)
+    lower_priority()
+
+    limits = shared_settings(read_bandwidth=50e6, max_open_tables=2)
+    multiprocessing.Pool(4, initializer=init_worker, initargs=(limits,))
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_settings = {'read_bandwidth': None, 'max_open_tables': None, 'shared': None}
+_slots = None
+_bucket = None
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the average rate of bytes read
+
+    Args:
+        rate (float): bytes per second
+        burst (float): bytes that can be read at once without waiting,
+            default one second worth of reading
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else self.rate
+        self.tokens = self.burst
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Take nbytes from the bucket, sleeping if the rate is exceeded"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket whose state is shared by the processes it is passed to
+
+    Args:
+        rate (float): bytes per second for all processes together
+        burst (float): bytes that can be read at once without waiting,
+            default one second worth of reading
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else self.rate
+        self._state = multiprocessing.RawArray('d', [self.burst, time.time()])
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def tokens(self):
+        return self._state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self._state[0] = value
+
+    @property
+    def last(self):
+        return self._state[1]
+
+    @last.setter
+    def last(self, value):
+        self._state[1] = value
+
+
+class SharedLimits(object):
+    """
+    Token bucket and read slots shared by several processes, see shared_settings
+
+    Args:
+        read_bandwidth (float): maximum read rate of all processes together
+        max_open_tables (int): maximum number of concurrent reads of all processes together
+    """
+
+    def __init__(self, read_bandwidth=None, max_open_tables=None):
+        self.bucket = SharedTokenBucket(read_bandwidth) if read_bandwidth else None
+        self.slots = multiprocessing.BoundedSemaphore(max_open_tables) if max_open_tables else None
+
+
+def configure(read_bandwidth=None, max_open_tables=None, shared=None):
+    """
+    Set the resource limits for the table reads of this process
+
+    Args:
+        read_bandwidth (float): maximum read rate in bytes per second, None for no limit
+        max_open_tables (int): maximum number of concurrent table reads, None for no limit
+        shared (SharedLimits): limits shared with other processes, from
+            shared_settings, used instead of limits for this process only
+    """
+    global _slots, _bucket
+    _settings['read_bandwidth'] = read_bandwidth
+    _settings['max_open_tables'] = max_open_tables
+    _settings['shared'] = shared
+    if shared is not None:
+        _bucket = shared.bucket
+        _slots = shared.slots
+    else:
+        _bucket = TokenBucket(read_bandwidth) if read_bandwidth else None
+        _slots = threading.BoundedSemaphore(max_open_tables) if max_open_tables else None
+    if enabled():
+        logger.info("Throttling table reads: {0}".format(_settings))
+
+
+def shared_settings(read_bandwidth=None, max_open_tables=None, **kwargs):
+    """
+    Settings for configure in several processes that share one read rate
+    and one set of read slots; call before starting the processes
+
+    Args:
+        read_bandwidth (float): maximum read rate in bytes per second of
+            all processes together, None for no limit
+        max_open_tables (int): maximum number of concurrent table reads of
+            all processes together, None for no limit
+
+    Returns:
+        dict: keyword arguments for configure
+    """
+    return {'read_bandwidth': read_bandwidth, 'max_open_tables': max_open_tables,
+            'shared': SharedLimits(read_bandwidth, max_open_tables)}
+
+
+def init_worker(settings):
+    """Initializer of pool workers: apply the settings of the parent, see settings()"""
+    if settings:
+        configure(**settings)
+
+
+def settings():
+    """Return the current limits as a dictionary, e.g. to pass to configure in a worker"""
+    return dict(_settings)
+
+def enabled():
+    """Return True if table reads are limited"""
+    return _bucket is not None or _slots is not None
+
+
+@contextmanager
+def table_slot():
+    """Context in which one table query or read may run"""
+    if _slots is None:
+        yield
+    else:
+        with _slots:
+            yield
+
+
+def account(nbytes):
+    """Account bytes read, waiting if the read bandwidth is exceeded"""
+    if _bucket is not None and nbytes > 0:
+        _bucket.consume(nbytes)
+
+
+def lower_priority(niceness=19, ionice_class=3):
+    """
+    Lower the CPU and I/O priority of this process (and its children)
+
+    Args:
+        niceness (int): niceness to run at
+        ionice_class (int): I/O scheduling class for ionice,
+            3 (idle) only gets disk time when nobody else needs it
+    """
+    try:
+        os.nice(max(niceness - os.nice(0), 0))
+    except OSError as e:
+        logger.warning("Could not change niceness: {}".format(e))
+    try:
+        subprocess.check_call(['ionice', '-c', str(ionice_class), '-p', str(os.getpid())])
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not change I/O priority: {}".format(e))
+    logger.info("Running with niceness {0} and I/O class {1}".format(os.nice(0), ionice_class))
+
+
+def newest_first(task_ids):
+    """Sort task ids (which start with the date) newest first"""
+    return sorted(task_ids, key=lambda task_id: str(task_id), reverse=True)
+
+
+if os.environ.get('APERCC_READ_BANDWIDTH') or os.environ.get('APERCC_MAX_OPEN_TABLES'):
+    configure(read_bandwidth=float(os.environ.get('APERCC_READ_BANDWIDTH', 0)) * 1e6 or None,
+              max_open_tables=int(os.environ.get('APERCC_MAX_OPEN_TABLES', 0)) or None)
+
+if os.environ.get('APERCC_LOW_PRIORITY', '0') not in ['', '0']:
+    lower_priority()
@@ -0,0 +1,235 @@
+# aperCC: stability statistics of calibrated calibrator visibilities
+
+"""
+Summarize the calibrated visibilities of calibrator measurement sets
+
+The CORRECTED_DATA and FLAG columns are read in chunks of rows, so the
+memory used is bounded by max_bytes however large the measurement set
+is. Every chunk is divided by the model flux of the calibrator (Perley &
+Butler 2017) and reduced to per-baseline, per-channel-bin sums, from
+which the mean and scatter of the amplitude ratio, the circular mean
+and scatter of the phase and the flagged fraction are computed.
+Autocorrelations and cross-hand correlations are skipped.
+
+The measurement sets of several beams can be processed in parallel.
+
+Example:
+    stats = beam_vis_stats(scandata.get_ms(), processes=4)
+    stats[0].amp_mean  # [baseline, bin, corr] amplitude / model flux
+"""
+
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+
+from . import throttle
+from .tableio import open_table, get_antennas, get_frequencies
+from .metrics import corr_names
+
+logger = logging.getLogger(__name__)
+
+# Perley & Butler (2017, ApJS 230, 7) flux density scale:
+# log10(S / Jy) = sum_i a_i log10(nu / GHz)^i
+PERLEY_BUTLER_2017 = {
+    '3C48': [1.3253, -0.7553, -0.1914, 0.0498],
+    '3C138': [1.0088, -0.4981, -0.155, -0.010, 0.022],
+    '3C147': [1.4516, -0.6961, -0.2007, 0.0640, -0.0464, 0.0289],
+    '3C196': [1.2872, -0.8530, -0.1534, -0.0200, 0.0201],
+    '3C286': [1.2481, -0.4507, -0.1798, 0.0357],
+    '3C295': [1.4701, -0.7658, -0.2780, -0.0347, 0.0399],
+}
+
+# approximate maximum memory used for the chunks of visibilities
+MAX_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def model_flux(source, freq):
+    """
+    Flux density of a calibrator in Jy
+
+    Args:
+        source (str): name of the calibrator, e.g. '3C147' or '3C147_36'
+        freq (numpy.ndarray): frequencies in GHz
+
+    Returns:
+        numpy.ndarray: flux densities, or None for an unknown source
+    """
+    name = str(source).upper().strip().split('_')[0]
+    if name not in PERLEY_BUTLER_2017:
+        return None
+    logfreq = np.log10(np.asarray(freq, dtype=float))
+    return 10 ** np.polynomial.polynomial.polyval(logfreq, PERLEY_BUTLER_2017[name])
+
+
+class VisStats(object):
+    """
+    Per-baseline, per-channel-bin statistics of the calibrated visibilities of a calibrator
+
+    Args:
+        ms (str): path of the measurement set
+        source (str): name of the calibrator, default the name of the measurement set
+        nbins (int): number of channel bins
+        max_bytes (int): approximate maximum memory used per chunk of rows
+        column (str): data column to read
+
+    time is the start of the observation (MJD seconds), freq the centre
+    frequencies of the bins (GHz) and baselines the pairs of antenna names.
+    All statistics arrays have the shape [baseline, bin, corr]:
+        n: number of unflagged visibilities
+        flagged: flagged fraction
+        amp_mean, amp_std: mean and scatter of the amplitude divided by the model flux
+        phase_mean, phase_std: circular mean and scatter of the phase in degrees
+    """
+
+    def __init__(self, ms, source=None, nbins=16, max_bytes=MAX_CHUNK_BYTES,
+                 column='CORRECTED_DATA'):
+        self.ms = ms
+        if source is None:
+            source = os.path.splitext(os.path.basename(ms.rstrip('/')))[0]
+        self.source = source
+        self.column = column
+        self.read_data(nbins, max_bytes)
+
+    def read_data(self, nbins, max_bytes):
+        t = open_table(self.ms)
+        self.ants = get_antennas(self.ms)
+        freq = get_frequencies(self.ms)[0]
+        nrow = t.nrows()
+        self.time = float(t.getcell('TIME', 0)) if nrow else np.nan
+        nchan, ncorr = [int(_) for _ in
+                        t.getcolshapestring(self.column, 0, 1)[0].strip('[]').split(',')]
+        # only the parallel hands (XX and YY) have a model
+        corr_index = [0, ncorr - 1] if ncorr == 4 else list(range(ncorr))
+        self.corrs = corr_names(len(corr_index))
+
+        model = model_flux(self.source, freq)
+        if model is None:
+            logger.warning("No model for {0}, using 1 Jy".format(self.source))
+            model = np.ones(nchan)
+        starts = (np.arange(nbins) * nchan) // nbins
+        starts = np.unique(starts)
+        nbins = len(starts)
+        ends = np.append(starts[1:], nchan)
+        self.freq = np.array([freq[s:e].mean() for s, e in zip(starts, ends)])
+
+        nant = len(self.ants)
+        size = nant * nant * nbins * len(corr_index)
+        sums = dict((name, np.zeros(size)) for name in ['n', 'total', 'amp', 'amp2', 'cos', 'sin'])
+        offsets = np.arange(nbins * len(corr_index))
+
+        # the visibilities and flags read plus the arrays derived from them
+        # take about 64 bytes per value
+        chunk = max(1, int(max_bytes // (nchan * ncorr * 64)))
+        data = np.empty((min(chunk, nrow), nchan, ncorr), dtype=np.complex64)
+        flags = np.empty(data.shape, dtype=bool)
+        inv_model = (1. / model)[None, :, None].astype(np.float32)
+        logger.info("Reading {0} rows of {1} in chunks of {2}".format(nrow, self.ms, chunk))
+        for start in range(0, nrow, chunk):
+            n = min(chunk, nrow - start)
+            a1 = t.getcol('ANTENNA1', start, n)
+            a2 = t.getcol('ANTENNA2', start, n)
+            t.getcolnp(self.column, data[:n], start, n)
+            t.getcolnp('FLAG', flags[:n], start, n)
+            cross = a1 != a2
+            if not cross.any():
+                # e.g. the autocorrelation of the last antenna at the end
+                continue
+            vis = data[:n][cross][:, :, corr_index] * inv_model
+            valid = ~flags[:n][cross][:, :, corr_index] & np.isfinite(vis)
+            amp = np.where(valid, np.abs(vis), 0.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                phasor = np.where(valid & (amp > 0), vis / amp, 0.)
+
+            # sum over the channels of every bin, then over the rows of every baseline
+            index = ((a1[cross] * nant + a2[cross]) * len(offsets))[:, None] + offsets
+            for name, values in [('n', valid), ('total', np.ones(valid.shape)),
+                                 ('amp', amp), ('amp2', amp ** 2),
+                                 ('cos', phasor.real), ('sin', phasor.imag)]:
+                binned = np.add.reduceat(values.astype(float), starts, axis=1)
+                sums[name] += np.bincount(index.ravel(), binned.reshape(len(index), len(offsets)).ravel(),
+                                          minlength=size)
+
+        # keep the baselines that are in the measurement set
+        shape = (nant * nant, nbins, len(corr_index))
+        sums = dict((name, value.reshape(shape)) for name, value in sums.items())
+        present = np.where(sums['total'].sum(axis=(1, 2)) > 0)[0]
+        self.baselines = [(self.ants[bl // nant], self.ants[bl % nant]) for bl in present]
+        sums = dict((name, value[present]) for name, value in sums.items())
+
+        n = sums['n']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.n = n.astype(int)
+            self.flagged = 1. - n / sums['total']
+            self.amp_mean = sums['amp'] / n
+            self.amp_std = np.sqrt(np.maximum(sums['amp2'] / n - self.amp_mean ** 2, 0.))
+            c, s = sums['cos'] / n, sums['sin'] / n
+            self.phase_mean = np.degrees(np.arctan2(s, c))
+            r = np.clip(np.hypot(c, s), 1e-300, 1.)
+            self.phase_std = np.degrees(np.sqrt(-2. * np.log(r)))
+
+    def records(self):
+        """
+        Metrics per baseline and correlation averaged over the channel bins,
+        as (metric, baseline, corr, value) tuples for the metric store
+        """
+        records = []
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weights = self.n.astype(float)
+            total = weights.sum(axis=1)
+            # bins without unflagged data have NaN statistics and zero weight
+            values = [('vis_amp_ratio', np.nansum(self.amp_mean * weights, axis=1) / total),
+                      ('vis_amp_scatter', np.sqrt(np.nansum(self.amp_std ** 2 * weights, axis=1) / total)),
+                      ('vis_phase_scatter', np.sqrt(np.nansum(self.phase_std ** 2 * weights, axis=1) / total)),
+                      ('vis_flagged', self.flagged.mean(axis=1))]
+        for metric, arr in values:
+            for i, (ant1, ant2) in enumerate(self.baselines):
+                for c, corr in enumerate(self.corrs):
+                    if np.isfinite(arr[i, c]):
+                        records.append((metric, '{0}-{1}'.format(ant1, ant2), corr,
+                                        float(arr[i, c])))
+        return records
+
+
+def _vis_stats(args):
+    """Worker computing the statistics of one measurement set"""
+    ms, source, nbins, max_bytes = args
+    try:
+        return VisStats(ms, source=source, nbins=nbins, max_bytes=max_bytes)
+    except Exception as e:
+        logger.warning("Could not get visibility statistics of {}".format(ms))
+        logger.exception(e)
+        return None
+
+
+def beam_vis_stats(ms_list, source=None, nbins=16, max_bytes=MAX_CHUNK_BYTES, processes=1):
+    """
+    Visibility statistics of the measurement sets of many beams
+
+    Args:
+        ms_list (list): paths of measurement sets in <beam>/raw directories
+        source (str): name of the calibrator, default from the measurement set names
+        nbins (int): number of channel bins
+        max_bytes (int): approximate maximum memory used per chunk of rows per process
+        processes (int): number of measurement sets processed in parallel
+
+    Returns:
+        dict: {beam: VisStats}, beams that failed are left out
+    """
+    args = [(ms, source, nbins, max_bytes) for ms in ms_list]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=throttle.init_worker,
+                                    initargs=(throttle.settings(),))
+        try:
+            results = pool.map(_vis_stats, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_vis_stats(arg) for arg in args]
+    res = dict()
+    for ms, stats in zip(ms_list, results):
+        if stats is not None:
+            res[int(os.path.basename(os.path.dirname(os.path.dirname(ms.rstrip('/')))))] = stats
+    return res
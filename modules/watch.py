@@ -0,0 +1,309 @@
+# aperCC: watch for new calibrator solutions
+
+"""
+Long-running watcher that updates stability statistics as new
+bandpass (*.Bscan) and gain (*.G1ap) tables are written by the
+autopipeline.
+
+The data roots that ScanData searches are polled for new solution
+tables (on Linux, if the inotify_simple package is available, the
+watcher wakes up as soon as something changes instead of sleeping for
+the full interval). Tables that existed when the watcher started are
+never processed. Every new table is summarized per antenna and
+correlation and the summary is compared to running statistics of
+earlier solutions of the same source and beam before being added to
+them, so only the new data is read. The running statistics and the
+tables already seen are saved to a state file after every new table, so
+a restarted watcher continues with what it learned (and processes the
+tables that appeared while it was not running).
+
+Example:
+    watcher = SolutionWatcher(interval=300, threshold=5.)
+    watcher.run()
+"""
+
+import os
+import glob
+import time
+import pickle
+import logging
+import tempfile
+import warnings
+
+import numpy as np
+
+from .Sols import BPSols, GainSols
+from .metrics import corr_names
+from .scandata import get_data_roots
+
+logger = logging.getLogger(__name__)
+
+# suffixes of the tables that are watched, and their kind
+WATCHED_SUFFIXES = {'Bscan': 'bpass', 'G1ap': 'gain'}
+
+# file with the statistics of earlier solutions, kept between runs
+DEFAULT_STATE = os.environ.get('APERCC_WATCH_STATE',
+                               os.path.join(os.path.expanduser('~'), '.apercc_watch_state.pkl'))
+
+
+class RunningStats(object):
+    """
+    Online (Welford) mean and variance of arrays, elementwise
+
+    NaN values are skipped and counted per element.
+    """
+
+    def __init__(self):
+        self.n = None
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        """Add a sample (array of the same shape as earlier samples)"""
+        x = np.asarray(x, dtype=float)
+        if self.n is None:
+            self.n = np.zeros(x.shape, dtype=int)
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        valid = np.isfinite(x)
+        self.n += valid
+        delta = np.where(valid, x - self.mean, 0.)
+        self.mean += np.where(valid, delta / np.maximum(self.n, 1), 0.)
+        self.m2 += np.where(valid, delta * (np.where(valid, x, 0.) - self.mean), 0.)
+
+    @property
+    def std(self):
+        """Sample standard deviation, NaN for less than two samples"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+
+    def deviation(self, x):
+        """Deviation of a sample from the mean in units of the standard deviation"""
+        if self.n is None:
+            return np.full(np.shape(x), np.nan)
+        # the floor keeps rounding errors from counting when all samples are equal
+        std = np.maximum(self.std, 1e-6 * np.abs(self.mean))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (np.asarray(x, dtype=float) - self.mean) / std
+
+
+def solution_summary(sol, kind):
+    """
+    Summarize a solution per antenna and correlation
+
+    Args:
+        sol (BPSols or GainSols): solutions
+        kind (str): 'bpass' or 'gain'
+
+    Returns:
+        dict: {metric: [ant, corr] array} with the median amplitude, the
+            scatter of the phase and the flagged fraction
+    """
+    amp = np.asarray(sol.amp, dtype=float)
+    phase = np.asarray(sol.phase, dtype=float)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {kind + '_amp_median': np.nanmedian(amp, axis=1),
+                kind + '_phase_std': np.nanstd(phase, axis=1),
+                kind + '_flagged': sol.flags.occupancy(keep=(0, 2))}
+
+
+class SolutionWatcher(object):
+    """
+    Watch the data roots for new solution tables
+
+    Args:
+        roots (list): data directories to watch, default the ones ScanData searches
+        interval (float): seconds between polls
+        threshold (float): deviation (in standard deviations) that raises an alert
+        min_count (int): number of earlier solutions needed before alerting
+        callback (function): called with every alert (a dictionary),
+            alerts are always logged as warnings
+        search_all_nodes (bool): watch the data directories of all nodes
+        state_file (str): file to keep the statistics in between runs,
+            default APERCC_WATCH_STATE or ~/.apercc_watch_state.pkl, '' to
+            keep them in memory only
+    """
+
+    def __init__(self, roots=None, interval=60., threshold=5., min_count=5,
+                 callback=None, search_all_nodes=False, state_file=None):
+        if roots is None:
+            roots = get_data_roots(search_all_nodes=search_all_nodes)
+        self.roots = roots
+        self.interval = interval
+        self.threshold = threshold
+        self.min_count = min_count
+        self.callback = callback
+        self.state_file = DEFAULT_STATE if state_file is None else state_file
+        self.stats = dict()
+        # tables that are still being written, with their last size
+        self.pending = dict()
+        if not self.load_state():
+            # without earlier state, existing tables are history and are never processed
+            self.seen = set(self.find_tables())
+        logger.info("Watching {0} ({1} existing tables)".format(
+            ', '.join(self.roots), len(self.seen)))
+
+    def load_state(self):
+        """
+        Load the statistics and the tables seen by an earlier run
+
+        Returns:
+            bool: True if a state was loaded
+        """
+        if not self.state_file or not os.path.exists(self.state_file):
+            return False
+        try:
+            with open(self.state_file, 'rb') as f:
+                state = pickle.load(f)
+        except Exception as e:
+            logger.warning("Could not read the watcher state {0}: {1}".format(self.state_file, e))
+            return False
+        self.stats = state['stats']
+        self.seen = state['seen']
+        logger.info("Loaded the statistics of {0} metrics from {1}".format(
+            len(self.stats), self.state_file))
+        return True
+
+    def save_state(self):
+        """Save the statistics and the tables seen, replacing the state file at once"""
+        if not self.state_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.apercc_watch_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'stats': self.stats, 'seen': self.seen}, f, protocol=2)
+            os.rename(tmp, self.state_file)
+        except (OSError, IOError) as e:
+            logger.warning("Could not save the watcher state {0}: {1}".format(self.state_file, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def find_tables(self):
+        """Find all solution tables below the data roots"""
+        tables = []
+        for root in self.roots:
+            for suffix in WATCHED_SUFFIXES:
+                tables.extend(glob.glob(os.path.join(
+                    root, '*', '[0-3][0-9]', 'raw', '*.{}'.format(suffix))))
+        return tables
+
+    @staticmethod
+    def _size(table):
+        """Total size of the files of a table"""
+        return sum(os.path.getsize(os.path.join(table, name))
+                   for name in os.listdir(table)
+                   if os.path.isfile(os.path.join(table, name)))
+
+    def poll(self):
+        """
+        Process the tables that appeared since the last poll
+
+        A new table is processed once its size did not change between two polls.
+
+        Returns:
+            list: alerts raised for the new tables
+        """
+        alerts = []
+        for table in self.find_tables():
+            if table in self.seen:
+                continue
+            try:
+                size = self._size(table)
+            except OSError:
+                # removed since it was found, e.g. by a re-run of the pipeline
+                self.pending.pop(table, None)
+                continue
+            if self.pending.get(table) != size:
+                self.pending[table] = size
+                continue
+            del self.pending[table]
+            self.seen.add(table)
+            try:
+                alerts.extend(self.process(table))
+            except Exception as e:
+                logger.warning("Could not process {}".format(table))
+                logger.exception(e)
+            self.save_state()
+        return alerts
+
+    def process(self, table):
+        """
+        Update the statistics with a new solution table
+
+        Returns:
+            list: alerts for the antennas and correlations that deviate
+                more than the threshold from the earlier solutions
+        """
+        raw_dir = os.path.dirname(table)
+        beam = int(os.path.basename(os.path.dirname(raw_dir)))
+        task_id = os.path.basename(os.path.dirname(os.path.dirname(raw_dir)))
+        source, suffix = os.path.splitext(os.path.basename(table))
+        kind = WATCHED_SUFFIXES[suffix[1:]]
+        sol = BPSols(table) if kind == 'bpass' else GainSols(table)
+        corrs = corr_names(np.shape(sol.amp)[-1])
+        logger.info("New {0} solutions for task {1} beam {2:02d}".format(kind, task_id, beam))
+
+        alerts = []
+        for metric, values in solution_summary(sol, kind).items():
+            stats = self.stats.setdefault((source, beam, metric), RunningStats())
+            if stats.n is not None and stats.n.shape == values.shape:
+                deviation = stats.deviation(values)
+                enough = stats.n >= self.min_count
+                for a, c in zip(*np.where(enough & (np.abs(deviation) > self.threshold))):
+                    alert = {'table': table, 'task_id': task_id, 'source': source,
+                             'beam': beam, 'metric': metric, 'ant': sol.ants[a],
+                             'corr': corrs[c], 'value': float(values[a, c]),
+                             'mean': float(stats.mean[a, c]),
+                             'std': float(stats.std[a, c])}
+                    logger.warning(
+                        "{metric} of {ant} {corr} in task {task_id} beam {beam:02d} is "
+                        "{value:.3g}, expected {mean:.3g} +/- {std:.3g}".format(**alert))
+                    if self.callback is not None:
+                        self.callback(alert)
+                    alerts.append(alert)
+            elif stats.n is not None:
+                logger.warning("Shape of {0} changed, restarting its statistics".format(metric))
+                stats = self.stats[(source, beam, metric)] = RunningStats()
+            stats.update(values)
+        return alerts
+
+    def _waiter(self):
+        """Return a function that waits for changes in the data roots, or None"""
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return None
+        inotify = INotify()
+        mask = flags.CREATE | flags.MOVED_TO | flags.CLOSE_WRITE
+
+        def wait():
+            # watch the roots, tasks and raw directories known so far
+            for root in self.roots:
+                for path in [root] + glob.glob(os.path.join(root, '*')) + \
+                        glob.glob(os.path.join(root, '*', '[0-3][0-9]', 'raw')):
+                    try:
+                        inotify.add_watch(path, mask)
+                    except OSError:
+                        pass
+            inotify.read(timeout=int(self.interval * 1000))
+            # give the pipeline some time to finish writing
+            time.sleep(min(self.interval, 5.))
+        return wait
+
+    def run(self, max_polls=None):
+        """
+        Poll until interrupted (or for max_polls polls)
+
+        Uses inotify to wake up early if available, otherwise sleeps for the interval.
+        """
+        wait = self._waiter()
+        if wait is None:
+            def wait():
+                time.sleep(self.interval)
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            wait()
+            self.poll()
+            polls += 1
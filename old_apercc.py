@@ -23,23 +23,73 @@ Requirements:
 atdbquery in python path
 """
 
-# import argparse
-# #import numpy as np
-# #from modules.functions import *
-
-# #Argument parsing
-# parser = argparse.ArgumentParser(
-#          description='Look at cross-calibration solution stability')
-# parser.add_argument("date1",help='Starting date for calibration scans',
-#                     type=str)
-# parser.add_argument("date2",help='Ending data for calibrator scans',type=str)
-# parser.add_argument("centfreq",default=1370,
-#                     help='Central frequency of observations',type=float)
-# parser.add_argument('-r','--reference',default=None,type=str,
-#                     help=('Taskid for a reference observation.'
-#                           'Defaults to first calibrator observation'))
-# args = parser.parse_args()
-
-
-# Get the data
-# Find sets of 40 beam calibrator scans
+import argparse
+import logging
+
+from modules.pipeline import run_pipeline, plan_pipeline
+from modules.plan import format_plan
+
+#Argument parsing
+parser = argparse.ArgumentParser(
+         description='Look at cross-calibration solution stability')
+parser.add_argument("date1",help='Starting date for calibration scans',
+                    type=str)
+parser.add_argument("date2",help='Ending data for calibrator scans',type=str)
+parser.add_argument("centfreq",default=1370,
+                    help='Central frequency of observations',type=float)
+parser.add_argument('-r','--reference',default=None,type=str,
+                    help=('Taskid for a reference observation.'
+                          'Defaults to first calibrator observation'))
+parser.add_argument('-b','--base_dir',default='/data/apertif/crosscal/',
+                    help='Directory to store the data of the calibrator sets')
+parser.add_argument('-q','--queue_size',default=2,type=int,
+                    help='Maximum number of calibrator sets waiting between stages')
+parser.add_argument('-m','--metric_store',default=None,
+                    help='Directory of the metric store to append the metrics to')
+parser.add_argument('--read_bandwidth',default=None,type=float,
+                    help='Maximum read rate for solution tables of all stages together in MB/s')
+parser.add_argument('--max_open_tables',default=None,type=int,
+                    help='Maximum number of concurrent table reads of all stages together')
+parser.add_argument('--low_priority',action='store_true',
+                    help=('Run with lowest CPU and I/O priority, '
+                          'processing the newest calibrator sets first'))
+parser.add_argument('--apply_ref',action='store_true',
+                    help=('Apply the reference solutions to the other calibrator sets '
+                          'and get statistics of the corrected visibilities'))
+parser.add_argument('-p','--processes',default=1,type=int,
+                    help='Number of beams corrected at the same time')
+parser.add_argument('--atdb_url',default=None,
+                    help=('Query ATDB at this URL with the pooled client '
+                          'instead of with atdbquery'))
+parser.add_argument('--dry_run',action='store_true',
+                    help=('Only print the estimated bytes read, wall time and '
+                          'peak memory of every step and calibrator set'))
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+
+if args.dry_run:
+    print(format_plan(plan_pipeline(args.date1, args.date2, args.centfreq,
+                                    reference=args.reference, base_dir=args.base_dir,
+                                    apply_ref=args.apply_ref,
+                                    atdb_url=args.atdb_url)))
+    raise SystemExit(0)
+
+# Find sets of 40 beam calibrator scans, get the data,
+# calibrate them and compare them to the reference set,
+# all stages running at the same time
+results = run_pipeline(args.date1, args.date2, args.centfreq,
+                       reference=args.reference, base_dir=args.base_dir,
+                       queue_size=args.queue_size,
+                       metric_store=args.metric_store,
+                       throttle_settings={
+                           'read_bandwidth': (args.read_bandwidth * 1e6
+                                              if args.read_bandwidth else None),
+                           'max_open_tables': args.max_open_tables},
+                       low_priority=args.low_priority,
+                       apply_ref=args.apply_ref, processes=args.processes,
+                       atdb_url=args.atdb_url)
+
+for res in results:
+    print("{0} {1}: {2} beams compared".format(
+        res['task_id'], res['source'], len(res.get('bpass', {}))))
@@ -7,12 +7,21 @@ Created on Wed Jun 12 11:03:13 2019
 """
 
 from modules.Sols import BPSols, GainSols
+from modules.cube import BandpassCube, GainCube
 from modules.scandata import ScanData
+from modules.metrics import bandpass_metrics, gain_metrics
+from modules.metricstore import MetricStore
+from modules.delays import store_delays
+from modules.spectra import store_gain_spectra
+from modules.similarity import store_similarity
+from modules.shared import pool_map
+from modules.get_data import get_task_metadata
+from modules.atdb import AtdbError
+from modules import throttle
 
 import glob
 import os
 import re
-import matplotlib.pyplot as plt
 import pickle as pkl
 
 # def b2b(beams='all'):
@@ -32,6 +41,26 @@ def get_fluxcal(obsid):
     return src
 
 
+def get_fluxcals(tasks):
+    """
+    Flux calibrator of every task: from the bandpass table of beam 00, or
+    else from the names in ATDB, looked up for all remaining tasks at once
+    """
+    fluxcals = dict((task, get_fluxcal(task)) for task in tasks)
+    missing = [task for task in tasks if fluxcals[task] is None]
+    if missing:
+        try:
+            metadata = get_task_metadata(missing)
+        except (AtdbError, IOError) as e:
+            print 'Could not look up {} tasks in ATDB: {}'.format(len(missing), e)
+            metadata = {}
+        for task in missing:
+            name = metadata.get(int(task), {}).get('name')
+            if name:
+                fluxcals[task] = str(name).split('_')[0]
+    return fluxcals
+
+
 def get_beam_num(pathstring):
     """return a string defining the beam number from a path"""
     beamnum = re.findall('/(\d{2})/', pathstring)
@@ -41,22 +70,59 @@ def get_beam_num(pathstring):
         return None
 
 
-def bpbeam(taskid, src, ants='all', datapath=None, plots=True):
+def _plot_bp_ant(cube, item):
     """
-    Get the gains {beam: [taskid, starttime, src, gains_data]}, and
-    [plot] bandpass amplitude and phase per beam normalized by beam#00
+    Plot the bandpass amplitude and phase of one antenna for all beams,
+    normalized by beam#00 (a plot worker, the cube may be attached to
+    shared memory)
     """
-    SD = ScanData(taskid, src, base_dir=datapath, search_all_nodes=True)
-    # print SD.get_bpasstable(0)
-
-    BP0 = BPSols(SD.get_bpasstable(0))
-    bps = SD.get_bpasstable()
-    start_time = BP0.t0.isoformat()[:10] + ' ' + BP0.t0.isoformat()[11:16]
+    import matplotlib.pyplot as plt
 
+    taskid, src, ant, start_time = item
     nx = 8
     ny = 5
     xsize = nx*4
     ysize = ny*4
+    BP0 = BPSols.from_cube(cube, 0)
+    fig1 = plt.figure(figsize=(xsize,ysize))
+    fig2 = plt.figure(figsize=(xsize,ysize))
+    for beamnum in cube.beams[cube.present].tolist():
+        BP = BPSols.from_cube(cube, beamnum)
+        ax1 = fig1.add_subplot(ny, nx, beamnum+1)
+        ax2 = fig2.add_subplot(ny, nx, beamnum+1)
+        BP.plot_norm_amp(BP0, ax=ax1, ant=ant, imagepath='bp_norm_{:02d}'.format(beamnum))
+        BP.plot_norm_phase(BP0, ax=ax2, ant=ant, imagepath='bp_norm_{:02d}'.format(beamnum))
+        if beamnum == 0:
+            ax1.legend()
+            ax2.legend()
+        else:
+            ax1.text(0.85, 0.9, 'B{:02d}'.format(beamnum), fontsize=14, transform=ax1.transAxes)
+            ax2.text(0.85, 0.9, 'B{:02d}'.format(beamnum), fontsize=14, transform=ax2.transAxes)
+    fig1.suptitle('Normalized BP amplitude {}, {}, {} ({})'.format(taskid, ant, src, start_time), fontsize=30)
+    fig2.suptitle('Normalized BP phase {}, {}, {} ({})'.format(taskid, ant, src, start_time), fontsize=30)
+    fig1.savefig('{}_BP_amp_{}.png'.format(taskid, ant))
+    fig2.savefig('{}_BP_phase_{}.png'.format(taskid, ant))
+    plt.close(fig1)
+    plt.close(fig2)
+
+
+def bpbeam(taskid, src, ants='all', datapath=None, plots=True, store=None, processes=1):
+    """
+    Get the gains {beam: [taskid, starttime, src, gains_data]}, and
+    [plot] bandpass amplitude and phase per beam normalized by beam#00.
+    If a MetricStore is given, the stability metrics, the residual
+    delays ('bp_delay', ns) and the similarity of every beam to the
+    other beams ('beam_<similarity|outlier>_<amp|phase>') are
+    appended to it.
+    With processes > 1 the antennas are plotted in parallel, by workers
+    attached to the cube in shared memory.
+    """
+    SD = ScanData(taskid, src, base_dir=datapath, search_all_nodes=True)
+    # print SD.get_bpasstable(0)
+
+    cube = BandpassCube.from_scandata(SD)
+    BP0 = BPSols.from_cube(cube, 0)
+    start_time = BP0.t0.isoformat()[:10] + ' ' + BP0.t0.isoformat()[11:16]
 
     if ants == 'all':
         antlist = BP0.ants
@@ -66,46 +132,43 @@ def bpbeam(taskid, src, ants='all', datapath=None, plots=True):
         antlist = ants
 
     res = dict()
+    if store is not None:
+        store_delays(cube, taskid, src, store)
+        store_similarity(cube, taskid, src, store)
     # antdict = dict()
-    if plots:
-        figs_amp = [plt.figure(figsize=(xsize,ysize)) for _ in antlist]
-        figs_phase = [plt.figure(figsize=(xsize,ysize)) for _ in antlist]
-    for bp in bps:
-        beamnum = int(get_beam_num(bp))
-        BP = BPSols(bp)
+    for beamnum in cube.beams[cube.present].tolist():
+        BP = BPSols.from_cube(cube, beamnum)
         starttime = BP.time[0]
         bpdata = BP.get_bpass()
         res.update({beamnum:[taskid, starttime, src, bpdata]})
-        for aind, ant in enumerate(antlist):
-            if plots:
-                fig1 = figs_amp[aind]
-                fig2 = figs_phase[aind]
-                ax1 = fig1.add_subplot(ny, nx, beamnum+1)
-                ax2 = fig2.add_subplot(ny, nx, beamnum+1)
-                BP.plot_norm_amp(BP0, ax=ax1, ant=ant, imagepath='bp_norm_{:02d}'.format(beamnum))
-                BP.plot_norm_phase(BP0, ax=ax2, ant=ant, imagepath='bp_norm_{:02d}'.format(beamnum))
-                if beamnum == 0:
-                    ax1.legend()
-                    ax2.legend()
-                else:
-                    ax1.text(0.85, 0.9, 'B{:02d}'.format(beamnum), fontsize=14, transform=ax1.transAxes)
-                    ax2.text(0.85, 0.9, 'B{:02d}'.format(beamnum), fontsize=14, transform=ax2.transAxes)
+        if store is not None:
+            store.append(bandpass_metrics(BP, BP0), taskid, src, beamnum, starttime)
     if plots:
-        for ant, fig1, fig2 in zip(antlist, figs_amp, figs_phase):
-            fig1.suptitle('Normalized BP amplitude {}, {}, {} ({})'.format(taskid, ant, src, start_time), fontsize=30)
-            fig2.suptitle('Normalized BP phase {}, {}, {} ({})'.format(taskid, ant, src, start_time), fontsize=30)
-            fig1.savefig('{}_BP_amp_{}.png'.format(taskid, ant))
-            fig2.savefig('{}_BP_phase_{}.png'.format(taskid, ant))
+        items = [(taskid, src, ant, start_time) for ant in antlist]
+        if processes > 1:
+            shared = cube.share()
+            try:
+                pool_map(_plot_bp_ant, items, shared, processes=processes)
+            finally:
+                shared.release()
+        else:
+            for item in items:
+                _plot_bp_ant(cube, item)
 
     return res
 
 
-def gbeam(taskid, src, ants='all', datapath=None, plots=False):
+def gbeam(taskid, src, ants='all', datapath=None, plots=False, store=None):
     """
     Get the gains {beam: [taskid, starttime, src, gains_data]}, and
-    [plot] gains amplitude and phase per beam normalized by beam 00
+    [plot] gains amplitude and phase per beam normalized by beam 00.
+    If a MetricStore is given, the stability metrics and the band powers
+    of the gain fluctuations ('gain_<amp|phase>_power_<band>') are
+    appended to it.
     """
     SD = ScanData(taskid, src, base_dir=datapath, search_all_nodes=True)
+    if store is not None:
+        store_gain_spectra(GainCube.from_scandata(SD), taskid, src, store)
     G0 = GainSols(SD.get_gaintable(0))
     bps = SD.get_gaintable()
     start_time = G0.t0.isoformat()[:10] + ' ' + G0.t0.isoformat()[11:16]
@@ -121,16 +184,19 @@ def gbeam(taskid, src, ants='all', datapath=None, plots=False):
         antlist = ants
 
     if plots:
+        import matplotlib.pyplot as plt
         figs_amp = [plt.figure(figsize=(xsize,ysize)) for _ in antlist]
         figs_phase = [plt.figure(figsize=(xsize,ysize)) for _ in antlist]
 
     res = dict()
-    for bp in bps:
+    # all beams are read with one query
+    for bp, G in zip(bps, GainSols.from_tables(bps)):
         beamnum = int(get_beam_num(bp))
-        G = GainSols(bp)
         starttime = G.time[0]
         gdata = G.get_gains()
         res.update({beamnum:[taskid, starttime, src, gdata]})
+        if store is not None:
+            store.append(gain_metrics(G, G0), taskid, src, beamnum, starttime)
 
         for aind, ant in enumerate(antlist):
             if plots:
@@ -194,17 +260,26 @@ if __name__ == "__main__":
             '190701001',
             ]
 
+    # when throttled (see modules/throttle.py), stay out of the way of
+    # the production pipeline and do the newest tasks first
+    if throttle.enabled():
+        throttle.lower_priority()
+        tasks = throttle.newest_first(tasks)
+
     bpdata = []
     gdata = []
+    store = MetricStore('ccmetrics')
+    fluxcals = get_fluxcals(tasks)
     for task in tasks[:]:
-        fluxcal = get_fluxcal(task)
+        fluxcal = fluxcals[task]
         print task, fluxcal
 
         if fluxcal is not None:
-            bp = bpbeam(task, fluxcal, ants=['RT3'], plots=False)
-            gn = gbeam(task, fluxcal, ants=['RT3'], plots=False)
+            bp = bpbeam(task, fluxcal, ants=['RT3'], plots=False, store=store)
+            gn = gbeam(task, fluxcal, ants=['RT3'], plots=False, store=store)
             bpdata.append(bp)
             gdata.append(gn)
 
     with open('ccdata.pkl', 'wb') as inp:
         pkl.dump((bpdata, gdata), inp)
+    store.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the ATDB REST interface serving canned JSON
+
+The observations are paged like ATDB ({'count', 'next', 'results'}),
+a taskID query returns the matching observation (or an empty page) and
+unknown paths give 404. The first `failures` requests of every path are
+answered with the given status (e.g. 503 or 429), so retries can be
+tested. All requests are counted per path.
+
+Usage:
+    python test_scripts/atdb_standin.py [port]
+    python old_apercc.py 2019-06-01 2019-06-02 1370 --atdb_url http://127.0.0.1:8765/atdb/
+"""
+
+import sys
+import json
+import threading
+from collections import Counter
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+
+def calibrator_set(first_task, source='3C147', nbeam=40, date='2019-06-01',
+                   central_frequency=1370.):
+    """Observations of a set of calibrator scans, one per beam, 3 minutes each"""
+    return [{'taskID': first_task + beam, 'name': '{0}_{1}'.format(source, beam),
+             'starttime': '{0}T10:{1:02d}:00Z'.format(date, beam),
+             'endtime': '{0}T10:{1:02d}:00Z'.format(date, beam + 3),
+             'central_frequency': central_frequency, 'observing_mode': 'imaging'}
+            for beam in range(nbeam)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        with server.lock:
+            server.requests[self.path] += 1
+            failing = server.requests[self.path] <= server.failures
+        if failing:
+            return self._send(server.failure_status)
+        if parts.path != '/atdb/observations/':
+            return self._send(404, {'detail': 'Not found.'})
+        observations = server.observations
+        if 'taskID' in query:
+            observations = [obs for obs in observations
+                            if obs['taskID'] == int(query['taskID'][0])]
+        page = int(query.get('page', ['1'])[0])
+        start = (page - 1) * server.page_size
+        results = observations[start:start + server.page_size]
+        following = None
+        if start + server.page_size < len(observations):
+            query['page'] = [str(page + 1)]
+            following = 'http://{0}:{1}{2}?{3}'.format(
+                server.server_address[0], server.server_address[1], parts.path,
+                '&'.join('{0}={1}'.format(k, v[0]) for k, v in sorted(query.items())))
+        self._send(200, {'count': len(observations), 'next': following, 'results': results})
+
+
+class AtdbStandIn(ThreadingMixIn, HTTPServer):
+    """
+    ATDB stand-in on a local port, serving in a background thread
+
+    Args:
+        observations (list): observation records to serve
+        port (int): port to listen on, 0 for any free port
+        page_size (int): results per page
+        failures (int): number of failed responses of every path before it answers
+        failure_status (int): status of the failed responses
+    """
+
+    daemon_threads = True
+
+    def __init__(self, observations, port=0, page_size=100, failures=0, failure_status=503):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.observations = list(observations)
+        self.page_size = page_size
+        self.failures = failures
+        self.failure_status = failure_status
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/atdb/'.format(self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    server = AtdbStandIn(calibrator_set(190601001) + calibrator_set(190602001, date='2019-06-02'),
+                         port=port)
+    print("ATDB stand-in at {}".format(server.url))
+    server.serve_forever()
@@ -0,0 +1,14 @@
+# aperCC: pytest setup of the test scripts
+
+"""
+Make the modules importable and leave out the scripts that run the full
+workflow on the happili data (they run apercc when imported)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+collect_ignore = ['test_apercc_crosscal.py', 'test_apercc_existing_data.py',
+                  'test_apercc_prepare_preflag.py', 'test_apercc_prepare_preflag_crosscal.py']
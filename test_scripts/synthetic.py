@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Small synthetic casacore tables for the tests: solution tables and
+measurement sets with the subtables that tableio reads
+"""
+
+import os
+
+import numpy as np
+
+ANTS = ['RT2', 'RT3', 'RT4']
+
+
+def _subtables(path, subtables):
+    """Write subtables {name: (column descriptions, {column: values})} and link them"""
+    import casacore.tables as pt
+
+    for name, (columns, values) in subtables.items():
+        t = pt.table(os.path.join(path, name), pt.maketabdesc(columns),
+                     nrow=len(next(iter(values.values()))), ack=False)
+        for col, value in values.items():
+            t.putcol(col, value)
+        t.close()
+    t = pt.table(path, readonly=False, ack=False)
+    for name in subtables:
+        t.putkeyword(name, 'Table: ' + os.path.join(os.path.abspath(path), name))
+    t.close()
+
+
+def solution_table(path, data, flags, time=5.06e9, ant_col=None, column='CPARAM',
+                   ants=ANTS):
+    """
+    Write a solution table, e.g. a bandpass table
+
+    Args:
+        data, flags (numpy.ndarray): [row, chan, pol] solutions and flags
+        time (float or numpy.ndarray): TIME of all rows or of every row
+        ant_col (numpy.ndarray): [row] ANTENNA1, default one row per antenna in order
+    """
+    import casacore.tables as pt
+
+    nrow, nchan, npol = data.shape
+    desc = pt.maketabdesc([
+        pt.makescacoldesc('TIME', 0.),
+        pt.makescacoldesc('ANTENNA1', 0),
+        pt.makearrcoldesc(column, 0j if column == 'CPARAM' else 0.,
+                          shape=[nchan, npol],
+                          valuetype='complex' if column == 'CPARAM' else 'double'),
+        pt.makearrcoldesc('FLAG', False, shape=[nchan, npol])])
+    t = pt.table(path, desc, nrow=nrow, ack=False)
+    t.putcol('TIME', np.broadcast_to(np.asarray(time, dtype=float), (nrow,)).copy())
+    t.putcol('ANTENNA1', np.arange(nrow) if ant_col is None else np.asarray(ant_col))
+    t.putcol(column, data.astype(np.complex64 if column == 'CPARAM' else float))
+    t.putcol('FLAG', flags)
+    t.close()
+    _subtables(path, {
+        'ANTENNA': ([pt.makescacoldesc('NAME', '')], {'NAME': list(ants)}),
+        'SPECTRAL_WINDOW': ([pt.makearrcoldesc('CHAN_FREQ', 0., shape=[nchan])],
+                            {'CHAN_FREQ': (1.2e9 + 1e6 * np.arange(nchan))[None]})})
+
+
+def baselines(nant=len(ANTS), ntime=1):
+    """ANTENNA1, ANTENNA2 and time index of the rows, autocorrelations included,
+    so the last row of every time is the autocorrelation of the last antenna"""
+    pairs = [(i, j) for i in range(nant) for j in range(i, nant)]
+    a1 = np.tile([i for i, j in pairs], ntime)
+    a2 = np.tile([j for i, j in pairs], ntime)
+    return a1, a2, np.repeat(np.arange(ntime), len(pairs))
+
+
+def measurement_set(path, a1, a2, time, data, freq, corr_types, column='DATA', flags=None,
+                    ants=ANTS):
+    """
+    Write a measurement set
+
+    Args:
+        a1, a2, time (numpy.ndarray): [row] ANTENNA1, ANTENNA2 and TIME
+        data (numpy.ndarray): [row, chan, corr] visibilities
+        freq (numpy.ndarray): [chan] frequencies in GHz
+        corr_types (list): Stokes codes of the correlations
+        column (str): column of the visibilities
+        flags (numpy.ndarray): [row, chan, corr] flags, default none
+    """
+    import casacore.tables as pt
+
+    nrow, nchan, ncorr = data.shape
+    desc = pt.maketabdesc([
+        pt.makescacoldesc('TIME', 0.),
+        pt.makescacoldesc('ANTENNA1', 0),
+        pt.makescacoldesc('ANTENNA2', 0),
+        pt.makearrcoldesc(column, 0j, shape=[nchan, ncorr], valuetype='complex'),
+        pt.makearrcoldesc('FLAG', False, shape=[nchan, ncorr])])
+    t = pt.table(path, desc, nrow=nrow, ack=False)
+    if flags is None:
+        flags = np.zeros(data.shape, dtype=bool)
+    for col, value in [('TIME', time), ('ANTENNA1', a1), ('ANTENNA2', a2),
+                       (column, data.astype(np.complex64)), ('FLAG', flags)]:
+        t.putcol(col, value)
+    t.close()
+    _subtables(path, {
+        'ANTENNA': ([pt.makescacoldesc('NAME', '')], {'NAME': list(ants)}),
+        'SPECTRAL_WINDOW': ([pt.makearrcoldesc('CHAN_FREQ', 0., shape=[nchan])],
+                            {'CHAN_FREQ': np.asarray(freq)[None] * 1e9}),
+        'POLARIZATION': ([pt.makearrcoldesc('CORR_TYPE', 0, shape=[ncorr])],
+                         {'CORR_TYPE': np.array([corr_types])})})
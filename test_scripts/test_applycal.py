@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Tests of the interpolation and application of solutions with synthetic
+solutions and a small synthetic measurement set
+"""
+
+import numpy as np
+import pytest
+
+from modules.applycal import interp_bandpass, interp_gains, apply_solutions
+from synthetic import ANTS, baselines, measurement_set
+
+
+class FakeBandpass(object):
+    """The attributes of BPSols that are applied"""
+
+    def __init__(self, data, freq, ants=ANTS):
+        self.data = data
+        self.freq = np.asarray(freq, dtype=float)[None, :]
+        self.ants = ants
+
+
+class FakeGains(object):
+    """The attributes of GainSols that are applied"""
+
+    def __init__(self, gains, time, ants=ANTS):
+        self.amp = np.abs(gains)
+        self.phase = np.angle(gains, deg=True)
+        self.time = np.asarray(time, dtype=float)
+        self.ants = ants
+
+
+def _random_solutions(shape, seed):
+    rng = np.random.RandomState(seed)
+    return (1 + 0.2 * rng.uniform(size=shape)) * np.exp(1j * rng.uniform(-1, 1, size=shape))
+
+
+def test_interp_bandpass():
+    freq = np.linspace(1.2, 1.5, 5)
+    # linear in frequency, so the interpolation is exact
+    data = ((1 + freq) * (1 + 0.5j))[None, :, None] * np.ones((3, 1, 2))
+    data[1, 2, 0] = np.nan
+    bp = FakeBandpass(data, freq)
+    assert np.array_equal(interp_bandpass(bp, freq), data.astype(np.complex64), equal_nan=True)
+    target = np.array([1.1, 1.2, 1.275, 1.4125, 1.5, 1.6])
+    res = interp_bandpass(bp, target)
+    expected = ((1 + target) * (1 + 0.5j))[None, :, None] * np.ones((3, 1, 2))
+    inside = (target >= 1.2) & (target <= 1.5)
+    assert np.isnan(res[:, ~inside]).all()
+    assert np.allclose(res[0][inside], expected[0][inside])
+    # channels next to the flagged one are flagged, a channel at the frequency
+    # of the unflagged neighbour is not
+    assert np.isnan(res[1, 3, 0]) and np.isfinite(res[1, 3, 1])
+    assert np.isclose(res[1, 2, 0], expected[1, 2, 0])
+    # solutions in decreasing frequency
+    reverse = interp_bandpass(FakeBandpass(data[:, ::-1], freq[::-1]), target)
+    assert np.allclose(reverse, res, equal_nan=True)
+
+
+def test_interp_gains():
+    time = 5.06e9 + 60. * np.arange(4)
+    amp = np.array([1., 1.2, 1.4, 1.6])
+    phase = np.radians([170., -170., -150., -130.])
+    gains = np.ones((3, 4, 2), dtype=complex)
+    gains[0, :, 0] = amp * np.exp(1j * phase)
+    gains[2, 1, 1] = np.nan
+    sols = FakeGains(gains, time)
+    res = interp_gains(sols, time[:1] + 90., mode='auto')
+    # halfway between the 2nd and 3rd solution, across the phase wrap
+    assert np.isclose(np.abs(res[0, 0, 0]), 1.3)
+    assert np.isclose(np.angle(res[0, 0, 0], deg=True), -160.)
+    # the flagged solution is left out of the interpolation
+    assert np.isclose(interp_gains(sols, time[1:2], mode='linear')[2, 0, 1], 1.)
+    # other times get the vector mean
+    mean = interp_gains(sols, time + 86400.)
+    assert mean.shape == (3, 4, 2)
+    assert np.allclose(mean[0, :, 0], np.mean(gains[0, :, 0]))
+
+
+def test_apply_solutions(tmp_path):
+    pt = pytest.importorskip('casacore.tables')
+    nchan, times = 6, 5.06e9 + 60. * np.arange(3)
+    freq = np.linspace(1.2, 1.5, nchan)
+    corr_types = [9, 10, 11, 12]
+    p1, p2 = np.array([0, 0, 1, 1]), np.array([0, 1, 0, 1])
+    bandpass = _random_solutions((3, nchan, 2), 1)
+    bandpass[2, 4, 1] = np.nan
+    gains = _random_solutions((3, len(times), 2), 2)
+    a1, a2, tindex = baselines(ntime=len(times))
+    # visibilities of a 1 Jy point source seen through the solutions
+    data = bandpass[a1][:, :, p1] * np.conj(bandpass[a2][:, :, p2]) * \
+        (gains[a1, tindex][:, p1] * np.conj(gains[a2, tindex][:, p2]))[:, None, :]
+    data[np.isnan(data)] = 1.
+    ms = str(tmp_path / 'test.MS')
+    measurement_set(ms, a1, a2, times[tindex], data, freq, corr_types)
+
+    fraction = apply_solutions(ms, bp=FakeBandpass(bandpass, freq),
+                               gains=FakeGains(gains, times), max_bytes=4000)
+    t = pt.table(ms, ack=False)
+    corrected, flags = t.getcol('CORRECTED_DATA'), t.getcol('FLAG')
+    t.close()
+    # the visibilities with the flagged solution of antenna 2 receptor 1 are flagged
+    bad = ((a1 == 2)[:, None] & (p1 == 1)[None, :]) | ((a2 == 2)[:, None] & (p2 == 1)[None, :])
+    bad = np.repeat(bad[:, None, :], nchan, axis=1) & (np.arange(nchan) == 4)[None, :, None]
+    assert np.array_equal(flags, bad)
+    assert np.isclose(fraction, bad.mean())
+    assert np.allclose(corrected[~bad], 1., atol=1e-5)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Tests of the pooled ATDB client against a local stand-in
+"""
+
+import pytest
+
+from atdb_standin import AtdbStandIn, calibrator_set
+from modules.atdb import AtdbClient, AtdbError
+from modules.get_data import get_cal_scan_dict, get_task_metadata
+
+OBSERVATIONS = calibrator_set(190601001) + calibrator_set(190602001, source='3C196',
+                                                          date='2019-06-02')
+
+
+@pytest.fixture
+def standin():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(AtdbStandIn(OBSERVATIONS, **kwargs).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_paging(standin):
+    server = standin(page_size=30)
+    client = AtdbClient(url=server.url, backoff=0.)
+    assert [obs['taskID'] for obs in client.imaging()] == \
+        [obs['taskID'] for obs in OBSERVATIONS]
+    # 80 observations in pages of 30
+    assert sum(server.requests.values()) == 3
+    sets = get_cal_scan_dict(1370., client=client)
+    assert sorted(sets) == [190601001, 190602001]
+    assert sets[190602001][5] == [190602006, '3C196_5', 5]
+
+
+@pytest.mark.parametrize('status', [503, 429])
+def test_retry(standin, status):
+    server = standin(failures=2, failure_status=status)
+    client = AtdbClient(url=server.url, backoff=0.01)
+    assert client.observation(190601003)['name'] == '3C147_2'
+    assert list(server.requests.values()) == [3]
+    with pytest.raises(AtdbError):
+        AtdbClient(url=server.url, retries=1, backoff=0.01).observation(190601004)
+
+
+def test_not_found(standin):
+    server = standin()
+    client = AtdbClient(url=server.url, backoff=0.)
+    assert client.get('unknown/') is None
+    assert client.observation(190699001) is None
+    assert get_task_metadata([190601001, 190699001], client=client) == {
+        190601001: {'name': '3C147_0', 'beam': 0, 'starttime': '2019-06-01T10:00:00Z',
+                    'endtime': '2019-06-01T10:03:00Z', 'central_frequency': 1370.}}
+
+
+def test_cache(standin, tmp_path):
+    server = standin()
+    client = AtdbClient(url=server.url, backoff=0., cache_dir=str(tmp_path))
+    task_ids = [obs['taskID'] for obs in OBSERVATIONS[:10]]
+    first = client.observations(task_ids)
+    assert len(first) == 10
+    assert sum(server.requests.values()) == 10
+    # from memory, then from the files of an earlier run
+    assert client.observations(task_ids) == first
+    assert AtdbClient(url=server.url, cache_dir=str(tmp_path)).observations(task_ids) == first
+    assert sum(server.requests.values()) == 10
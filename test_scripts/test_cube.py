@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Tests of reading bandpass tables of many beams into one cube, with
+small synthetic casacore tables
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('casacore.tables')
+
+from modules.cube import BandpassCube  # noqa: E402
+from modules.Sols import BPSols  # noqa: E402
+from synthetic import ANTS, solution_table as bandpass_table  # noqa: E402
+
+def _solutions(beam, nchan=8, npol=2):
+    rng = np.random.RandomState(beam)
+    shape = (len(ANTS), nchan, npol)
+    data = (1 + 0.1 * rng.normal(size=shape)) * np.exp(1j * rng.normal(size=shape))
+    flags = rng.uniform(size=shape) < 0.1
+    return data, flags
+
+
+def test_cube_reads_all_beams(tmp_path):
+    tables = dict()
+    written = dict()
+    for beam in [0, 1, 3]:
+        tables[beam] = str(tmp_path / '{:02d}.Bscan'.format(beam))
+        written[beam] = _solutions(beam)
+        bandpass_table(tables[beam], *written[beam], time=5.06e9 + beam)
+    tables[2] = str(tmp_path / 'missing.Bscan')
+    cube = BandpassCube(tables)
+    assert cube.present.tolist() == [True, True, False, True]
+    assert cube.data.shape == (4, len(ANTS), 8, 2)
+    assert cube.ants == tuple(ANTS)
+    assert np.allclose(cube.freq, 1.2 + 1e-3 * np.arange(8))
+    for b, beam in enumerate(cube.beams):
+        if beam not in written:
+            assert np.isnan(cube.data[b]).all()
+            continue
+        data, flags = written[beam]
+        assert np.array_equal(np.isnan(cube.data[b]), flags)
+        assert np.allclose(cube.data[b][~flags], data[~flags], rtol=1e-6)
+        assert cube.time[b] == 5.06e9 + beam
+
+
+def test_cube_skips_tables_with_other_channels(tmp_path):
+    tables = {0: str(tmp_path / '00.Bscan'), 1: str(tmp_path / '01.Bscan'),
+              2: str(tmp_path / '02.Bscan')}
+    bandpass_table(tables[0], *_solutions(0))
+    # same number of rows, different number of channels
+    bandpass_table(tables[1], *_solutions(1, nchan=16))
+    bandpass_table(tables[2], *_solutions(2))
+    cube = BandpassCube(tables)
+    assert cube.present.tolist() == [True, False, True]
+    assert cube.data.shape == (3, len(ANTS), 8, 2)
+    assert np.isnan(cube.data[1]).all()
+
+
+def test_cube_sorts_rows_by_antenna(tmp_path):
+    tables = {0: str(tmp_path / '00.Bscan'), 1: str(tmp_path / '01.Bscan'),
+              2: str(tmp_path / '02.Bscan')}
+    written = dict((beam, _solutions(beam)) for beam in tables)
+    bandpass_table(tables[0], *written[0])
+    # rows in the order of antennas 2, 0, 1
+    order = np.array([2, 0, 1])
+    bandpass_table(tables[1], written[1][0][order], written[1][1][order], ant_col=order)
+    # two solution times cannot be put in the cube
+    bandpass_table(tables[2], np.concatenate([written[2][0]] * 2),
+                   np.concatenate([written[2][1]] * 2), time=5.06e9 + np.repeat([0., 60.], 3),
+                   ant_col=np.tile(np.arange(3), 2))
+    cube = BandpassCube(tables)
+    assert cube.present.tolist() == [True, True, False]
+    for beam in [0, 1]:
+        data, flags = written[beam]
+        assert np.array_equal(np.isnan(cube.data[beam]), flags)
+        assert np.allclose(cube.data[beam][~flags], data[~flags], rtol=1e-6)
+        bp = BPSols(tables[beam])
+        assert np.allclose(cube.data[beam], bp.data, equal_nan=True)
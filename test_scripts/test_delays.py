@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Tests of the delay estimates with synthetic bandpasses of known delay
+"""
+
+import numpy as np
+
+from modules.delays import estimate_delays, store_delays
+from modules.metricstore import MetricStore
+
+# 64 channels of 1 MHz, so delays up to 500 ns can be measured
+FREQ = 1.3 + 1e-3 * np.arange(64)  # GHz
+
+
+def _bandpass(delays, freq=FREQ, seed=11):
+    """[..., chan, pol] bandpass with the phase slope of the [..., pol] delays in ns"""
+    delays = np.asarray(delays, dtype=float)
+    rng = np.random.RandomState(seed)
+    phase = 2 * np.pi * freq[:, None] * delays[..., None, :] + rng.uniform(-np.pi, np.pi)
+    amp = 1. + 0.1 * rng.normal(size=phase.shape)
+    return amp * np.exp(1j * phase)
+
+
+def test_delay_sign_and_units():
+    delays = np.array([[3.7, -3.7], [0.4, 120.25], [-250., 0.]])
+    est, strength = estimate_delays(FREQ, _bandpass(delays))
+    assert est.shape == (3, 2)
+    np.testing.assert_allclose(est, delays, atol=0.1)
+    np.testing.assert_allclose(strength, 1., atol=0.05)
+    # the delays refer to increasing frequency, also for a reversed band
+    est, _ = estimate_delays(FREQ[::-1], _bandpass(delays, FREQ[::-1]))
+    np.testing.assert_allclose(est, delays, atol=0.1)
+
+
+def test_flagged_channels():
+    data = _bandpass([[12.3, -7.1]])
+    # flagged channels with arbitrary phases, as NaN or with flags
+    rng = np.random.RandomState(12)
+    data[0, 10:30, 0] = np.nan
+    flags = np.zeros(data.shape, dtype=bool)
+    flags[0, ::3, 1] = True
+    data[0, ::3, 1] = np.exp(2j * np.pi * rng.uniform(size=22))
+    est, strength = estimate_delays(FREQ, data, flags=flags)
+    np.testing.assert_allclose(est, [[12.3, -7.1]], atol=0.15)
+    assert np.all(strength > 0.5)
+
+    est, strength = estimate_delays(FREQ, np.full((2, 64, 2), np.nan, dtype=complex))
+    assert np.isnan(est).all() and np.isnan(strength).all()
+
+
+class FakeCube(object):
+    """The attributes of a BandpassCube that store_delays uses"""
+
+    def __init__(self, delays):
+        self.freq = FREQ
+        self.data = _bandpass(delays)
+        self.beams = np.array([0, 1, 2])
+        self.present = np.array([True, False, True])
+        self.data[~self.present] = np.nan
+        self.ants = ('RT2', 'RT3')
+        self.time = 5.06e9 + np.arange(3)
+
+
+def test_store_delays(tmp_path):
+    delays = np.array([[[1.5, -2.], [30., 4.]]] * 3)
+    store = MetricStore(str(tmp_path))
+    try:
+        res = store_delays(FakeCube(delays), 190601001, '3C147', store)
+        np.testing.assert_allclose(res[[0, 2]], delays[[0, 2]], atol=0.1)
+        stored = store.query('bp_delay', ant='RT3', corr='XX')
+        assert stored['beam'].tolist() == [0, 2]
+        np.testing.assert_allclose(stored['value'], 30., atol=0.1)
+        assert len(store.query('bp_delay')) == 8
+    finally:
+        store.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Tests of the batched bandpass fits on synthetic spectra
+"""
+
+import numpy as np
+import pytest
+
+from modules.fitting import fit_spectra, design_matrix, fit_bandpass, rms_difference
+
+
+def test_polynomial_fit_recovers_coefficients():
+    freq = np.linspace(1.22, 1.53, 384)
+    design = design_matrix(freq, 4)
+    coeffs = np.array([[1., 0.2, -0.1, 0.05], [0.5, 0., 0.3, 0.]])
+    data = np.dot(coeffs, design.T)
+    data[0, 100:120] = np.nan
+    fitted, rms, nvalid = fit_spectra(design, data)
+    assert np.allclose(fitted, coeffs)
+    assert np.allclose(rms, 0., atol=1e-10)
+    assert nvalid.tolist() == [364, 384]
+
+
+def test_spline_fit_with_flagged_gap():
+    freq = np.linspace(1.22, 1.53, 384)
+    amp = np.ones((3, 384, 2)) + 0.1 * freq[None, :, None]
+    phase = np.zeros((3, 384, 2))
+    # 300 of 384 channels flagged leave spline terms without data
+    amp[1, 40:340, 0] = np.nan
+    phase[1, 40:340, 0] = np.nan
+    fit = fit_bandpass(freq, amp, phase, nterms=12, basis='spline')
+    assert np.isnan(fit.amp_coeffs[1, 0]).all()
+    assert np.isnan(fit.amp_rms[1, 0])
+    # the other spectra of the batch are still fitted
+    assert np.isfinite(fit.amp_coeffs[[0, 2]]).all()
+    assert np.isfinite(fit.amp_coeffs[1, 1]).all()
+    assert np.allclose(fit.amp_rms[0], 0., atol=1e-8)
+
+
+def test_rms_difference():
+    freq = np.linspace(1.22, 1.53, 384)
+    amp = 1 + freq[None, :, None] * np.ones((1, 1, 2))
+    phase = np.zeros_like(amp)
+    fit = fit_bandpass(freq, amp, phase, nterms=4)
+    assert np.allclose(rms_difference(fit, fit_bandpass(freq, amp, phase, nterms=4)), 0.)
+    other = fit_bandpass(freq, 1.1 * amp, phase, nterms=4)
+    amp_rms = rms_difference(other, fit)[0]
+    assert np.allclose(amp_rms, np.sqrt(np.mean((0.1 * amp[0]) ** 2, axis=0)), rtol=1e-3)
+
+
+def test_rms_difference_needs_the_same_range():
+    freq = np.linspace(1.22, 1.53, 384)
+    sub = freq[(freq >= 1.30) & (freq <= 1.45)]
+    fit = fit_bandpass(freq, (1 + freq)[:, None] * np.ones(2), np.zeros((384, 2)), nterms=4)
+    ref = fit_bandpass(sub, (1 + sub)[:, None] * np.ones(2), np.zeros((len(sub), 2)), nterms=4)
+    with pytest.raises(ValueError):
+        rms_difference(fit, ref)
+
+
+def test_phase_difference_across_the_wrap():
+    freq = np.linspace(1.22, 1.53, 384)
+    amp = np.ones((1, 384, 2))
+    slope = 5. * (freq - freq[0]) / (freq[-1] - freq[0])
+    # 2 degrees apart, starting on either side of +-180 degrees
+    phase = (179. + slope)[None, :, None] * np.ones((1, 1, 2))
+    ref = fit_bandpass(freq, amp, np.angle(np.exp(1j * np.radians(phase)), deg=True))
+    fit = fit_bandpass(freq, amp, np.angle(np.exp(1j * np.radians(phase + 2.)), deg=True))
+    amp_rms, phase_rms = rms_difference(fit, ref)
+    assert np.allclose(amp_rms, 0., atol=1e-8)
+    assert np.allclose(phase_rms, 2., atol=1e-3)
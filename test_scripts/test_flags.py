@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Tests of the bit-packed flags against boolean arrays
+"""
+
+import pickle
+
+import numpy as np
+import pytest
+
+from modules.flags import PackedFlags, flag_trend
+
+
+def _flags(shape=(3, 4, 21, 2), seed=8):
+    # 21 channels do not fill the last byte
+    return np.random.RandomState(seed).uniform(size=shape) < 0.3
+
+
+@pytest.mark.parametrize('axis', [0, 1, 2, -1])
+def test_round_trip(axis):
+    flags = _flags()
+    packed = PackedFlags(flags, axis=axis)
+    np.testing.assert_array_equal(packed.unpack(), flags)
+    assert packed.shape == flags.shape and len(packed) == 3 and packed.size == flags.size
+    packed = pickle.loads(pickle.dumps(packed))
+    np.testing.assert_array_equal(packed.unpack(), flags)
+
+
+def test_index_and_nan():
+    flags = _flags()
+    packed = PackedFlags(flags, axis=2)
+    np.testing.assert_array_equal(packed[1].unpack(), flags[1])
+    assert packed.nbytes == 3 * 4 * 2 * 3
+    with pytest.raises(IndexError):
+        PackedFlags(flags, axis=0)[1]
+    data = np.where(flags, np.nan, 1.)
+    np.testing.assert_array_equal(PackedFlags.from_nan(data, axis=2).unpack(), flags)
+
+
+@pytest.mark.parametrize('axis', [0, 2, 3])
+@pytest.mark.parametrize('keep', [None, 0, 1, 2, -1, (0, 2), (1, 3), (0, 1, 3), (0, 1, 2, 3)])
+def test_counts_and_occupancy(axis, keep):
+    flags = _flags()
+    packed = PackedFlags(flags, axis=axis)
+    if keep is None:
+        assert packed.count() == flags.sum()
+        assert packed.occupancy() == pytest.approx(flags.mean())
+        return
+    summed = tuple(ax for ax in range(4) if ax not in np.atleast_1d(keep) % 4)
+    np.testing.assert_array_equal(packed.count(keep), flags.sum(axis=summed))
+    np.testing.assert_allclose(packed.occupancy(keep), flags.mean(axis=summed))
+
+
+@pytest.mark.parametrize('keep', [None, 0, 1, 2, (0, 2)])
+def test_flag_trend(keep):
+    shape = (4, 21, 2)
+    flags = dict((task_id, _flags(shape, seed=task_id)) for task_id in [3, 1, 2])
+    packed = dict((task_id, PackedFlags(f, axis=1)) for task_id, f in flags.items())
+    # a task with another number of channels does not fit the trend
+    packed[4] = PackedFlags(_flags((4, 10, 2)), axis=1)
+    task_ids, fractions = flag_trend(packed, keep=keep)
+    assert task_ids == [1, 2, 3, 4]
+    summed = None if keep is None else \
+        tuple(ax for ax in range(3) if ax not in np.atleast_1d(keep))
+    expected = [flags[task_id].mean(axis=summed) for task_id in [1, 2, 3]]
+    np.testing.assert_allclose(fractions[:3], expected)
+    assert np.isnan(fractions[3]).all()
+    assert fractions.shape == (4,) + np.shape(expected[0])
+
+
+def test_flag_trend_of_no_tasks():
+    task_ids, fractions = flag_trend({})
+    assert task_ids == [] and len(fractions) == 0
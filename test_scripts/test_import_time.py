@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Test script to check that importing the aperCC modules stays fast
+
+Every module is imported in a fresh interpreter. The script fails if an
+import takes longer than the limit or if it loads one of the heavy
+dependencies (casacore, matplotlib, measures, Apercal), which should
+only be imported by the functions that need them.
+
+Usage:
+    python test_scripts/test_import_time.py [max_seconds]
+    python -m pytest test_scripts/test_import_time.py
+"""
+
+import os
+import sys
+import subprocess
+
+MODULES = ['modules.scandata', 'modules.tableio', 'modules.Sols', 'modules.cube',
+           'modules.metrics', 'modules.metricstore', 'modules.apercc',
+           'modules.pipeline', 'modules.watch', 'modules.fitting',
+           'modules.delays', 'modules.regrid',
+           'modules.stats', 'modules.flags', 'modules.visstats',
+           'modules.applycal', 'modules.obsindex', 'modules.plan',
+           'modules.shared', 'modules.atdb', 'modules.spectra',
+           'modules.similarity', 'modules.soltable',
+           'modules.sidereal', 'modules.service']
+
+HEAVY = ['casacore', 'pyrap', 'matplotlib', 'ephem', 'scipy', 'apercal']
+
+CHECK = """
+import sys, time
+start = time.time()
+import {module}
+print(time.time() - start)
+print(','.join(sorted(set(m.split('.')[0] for m in sys.modules) & set({heavy!r}))))
+"""
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def check_imports(max_seconds=1.0):
+    """
+    Import every module in a fresh interpreter
+
+    Returns:
+        list: (module, seconds, heavy modules loaded, ok) per module
+    """
+    res = []
+    for module in MODULES:
+        out = subprocess.check_output(
+            [sys.executable, '-c', CHECK.format(module=module, heavy=HEAVY)],
+            cwd=repo_dir).decode().split('\n')
+        seconds, loaded = float(out[0]), out[1]
+        res.append((module, seconds, loaded, seconds <= max_seconds and not loaded))
+    return res
+
+
+def test_import_time():
+    failed = [(module, seconds, loaded)
+              for module, seconds, loaded, ok in check_imports() if not ok]
+    assert not failed, failed
+
+
+if __name__ == '__main__':
+    max_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    failed = False
+    for module, seconds, loaded, ok in check_imports(max_seconds):
+        failed |= not ok
+        print("{0:<22s} {1:6.3f}s {2:<6s} {3}".format(
+            module, seconds, 'ok' if ok else 'FAILED', loaded))
+    sys.exit(1 if failed else 0)
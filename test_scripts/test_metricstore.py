@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Tests of the date-partitioned metric store
+"""
+
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from modules.metricstore import MetricStore, datetime_to_mjd
+
+# Friday 2019-05-31 and Saturday 2019-06-01 are in the same week,
+# Monday 2019-06-03 in the next one
+FRIDAY = datetime_to_mjd(datetime(2019, 5, 31, 12))
+SATURDAY = datetime_to_mjd(datetime(2019, 6, 1, 12))
+MONDAY = datetime_to_mjd(datetime(2019, 6, 3, 12))
+
+
+def _records(value):
+    return [('gain_phase_scatter', 'RT2', 'XX', value), ('gain_phase_scatter', 'RT3', 'XX', 2 * value)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MetricStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def test_append_and_query_across_months(store):
+    assert store.append(_records(1.), 190531001, '3C147', 0, FRIDAY) == 2
+    assert store.append(_records(3.), 190601001, '3C147', 0, SATURDAY) == 2
+    assert store.append(_records(5.), 190603001, '3C196', 0, MONDAY) == 2
+
+    res = store.query('gain_phase_scatter', ant='RT2')
+    np.testing.assert_array_equal(res['value'], [1., 3., 5.])
+    np.testing.assert_array_equal(res['task_id'], ['190531001', '190601001', '190603001'])
+    res = store.query('gain_phase_scatter', ant='RT2', start='2019-05-31', end='2019-06-02')
+    np.testing.assert_array_equal(res['value'], [1., 3.])
+    res = store.query('gain_phase_scatter', source='3C196')
+    np.testing.assert_array_equal(np.sort(res['value']), [5., 10.])
+    assert len(store.query('gain_phase_scatter', start='2019-07-01')) == 0
+
+
+def test_samples_are_not_counted_twice(store):
+    assert store.append(_records(1.), 190531001, '3C147', 0, FRIDAY) == 2
+    assert store.append(_records(7.), 190531001, '3C147', 0, FRIDAY) == 0
+    assert store.query('gain_phase_scatter', ant='RT2')['value'].tolist() == [1.]
+    daily = store.aggregate('gain_phase_scatter', ant='RT2')
+    assert daily['n'].tolist() == [1]
+
+
+def test_daily_and_weekly_aggregates(store):
+    store.append(_records(1.), 190531001, '3C147', 0, FRIDAY)
+    store.append(_records(3.), 190531002, '3C147', 0, FRIDAY)
+    store.append(_records(5.), 190601001, '3C147', 0, SATURDAY)
+    store.append(_records(9.), 190603001, '3C147', 0, MONDAY)
+
+    daily = store.aggregate('gain_phase_scatter', 'daily', ant='RT2')
+    assert daily['period'].tolist() == ['2019-05-31', '2019-06-01', '2019-06-03']
+    np.testing.assert_allclose(daily['mean'], [2., 5., 9.])
+    np.testing.assert_allclose(daily['std'], [1., 0., 0.])
+
+    weekly = store.aggregate('gain_phase_scatter', 'weekly', ant='RT2')
+    assert weekly['period'].tolist() == ['2019-05-27', '2019-06-03']
+    assert weekly['n'].tolist() == [3, 1]
+    np.testing.assert_allclose(weekly['mean'], [3., 9.])
+    np.testing.assert_allclose(weekly['std'][0], np.std([1., 3., 5.]))
+    assert weekly['min'].tolist() == [1., 9.] and weekly['max'].tolist() == [5., 9.]
+
+    # a weekly query from the middle of a week includes that week
+    weekly = store.aggregate('gain_phase_scatter', 'weekly', ant='RT2', start='2019-06-01')
+    assert weekly['period'].tolist() == ['2019-05-27', '2019-06-03']
+
+
+def test_failed_aggregate_update_stores_nothing(store, tmp_path):
+    store.append(_records(1.), 190531001, '3C147', 0, FRIDAY)
+    # the weekly aggregates cannot be updated
+    conn = sqlite3.connect(str(tmp_path / 'aggregates.sqlite'))
+    conn.execute("ALTER TABLE weekly RENAME TO weekly_gone")
+    conn.commit()
+    with pytest.raises(sqlite3.OperationalError):
+        store.append(_records(3.), 190531002, '3C147', 0, FRIDAY)
+    assert store.query('gain_phase_scatter', ant='RT2')['value'].tolist() == [1.]
+    assert store.aggregate('gain_phase_scatter', 'daily', ant='RT2')['n'].tolist() == [1]
+
+    # the samples are aggregated when they are appended again
+    conn.execute("ALTER TABLE weekly_gone RENAME TO weekly")
+    conn.commit()
+    conn.close()
+    assert store.append(_records(3.), 190531002, '3C147', 0, FRIDAY) == 2
+    assert store.aggregate('gain_phase_scatter', 'daily', ant='RT2')['n'].tolist() == [2]
+    assert store.aggregate('gain_phase_scatter', 'weekly', ant='RT2')['n'].tolist() == [2]
+
+
+def test_rebuild_aggregates(store):
+    store.append(_records(1.), 190531001, '3C147', 0, FRIDAY)
+    store.append(_records(5.), 190601001, '3C147', 0, SATURDAY)
+    store.append(_records(9.), 190603001, '3C147', 0, MONDAY)
+    expected = [store.aggregate('gain_phase_scatter', period) for period in ['daily', 'weekly']]
+
+    # aggregates lost, e.g. by a crash of an older version between the commits
+    with store._aggregates as agg:
+        agg.execute("DELETE FROM weekly")
+        agg.execute("UPDATE daily SET n=n+1")
+    assert store.rebuild_aggregates() == 6
+    for period, exp in zip(['daily', 'weekly'], expected):
+        res = store.aggregate('gain_phase_scatter', period)
+        np.testing.assert_array_equal(res, exp)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Tests of the index of calibrator observations without table access
+"""
+
+import os
+
+import pytest
+
+from modules import obsindex
+from modules.obsindex import ObservationIndex
+
+SETUP = (384, 1220.0, 1530.0)
+
+
+def make_index(tmp_path):
+    index = ObservationIndex(roots=[str(tmp_path)])
+    for task_id, time in [(190601001, 100.), (190602001, 200.), (190603001, 300.)]:
+        for beam in [0, 1]:
+            table = str(tmp_path / str(task_id) / '{:02d}'.format(beam) / 'raw' / '3C147.Bscan')
+            index.add('3C147', beam, SETUP, time + beam, task_id, table)
+            index._versions[table] = 1.
+    return index
+
+
+def test_remove_keeps_the_index_consistent(tmp_path):
+    index = make_index(tmp_path)
+    table = index.task_observations(190602001)[0][3]
+    index.remove(table)
+    assert len(index) == 5
+    assert [obs[1] for obs in index.window('3C147', 0, SETUP, 0., 1e3)] == [190601001, 190603001]
+    assert list(index.task_observations(190602001)) == [1]
+    assert [obs[1] for obs in index.nearest('3C147', 0, SETUP, 210., n=1)] == [190603001]
+
+
+def test_refresh_drops_deleted_and_rereads_changed_tables(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    changed = index.task_observations(190601001)[1][3]
+    versions = {changed: 2.}
+    reread = []
+    monkeypatch.setattr(obsindex, 'table_version',
+                        lambda table: versions.get(table, 1. if '190603001' not in table else None))
+    monkeypatch.setattr(ObservationIndex, 'add_table',
+                        lambda self, table: reread.append(table) or True)
+    dropped, updated = index.refresh()
+    assert (dropped, updated) == (2, 1)
+    assert reread == [changed]
+    assert 190603001 not in [obs[1] for obs in index.window('3C147', 0, SETUP, 0., 1e3)]
+
+
+def test_save_and_load_keep_the_versions(tmp_path):
+    index = make_index(tmp_path)
+    index.save(str(tmp_path / 'index.pkl'))
+    loaded = ObservationIndex.load(str(tmp_path / 'index.pkl'))
+    assert loaded._versions == index._versions
+    assert loaded.comparable_tasks(190602001) == index.comparable_tasks(190602001)
+
+
+def test_failed_save_keeps_the_saved_index(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    filename = str(tmp_path / 'index.pkl')
+    index.save(filename)
+
+    def partial_dump(obj, f):
+        f.write(b'partial')
+        raise IOError("disk full")
+    monkeypatch.setattr(obsindex.pickle, 'dump', partial_dump)
+    with pytest.raises(IOError):
+        index.save(filename)
+    monkeypatch.undo()
+    assert ObservationIndex.load(filename)._versions == index._versions
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith('.apercc_index_')]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Tests of the pipelined driver with stand-in stages
+"""
+
+import os
+import sys
+import types
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from modules import pipeline
+
+
+def _cal_sets(centfreq, client=None):
+    return {190601001: [(190601001, '3C147_0', 0)], 190602001: [(190602001, '3C147_0', 0)]}
+
+
+def _dying_stage(name, steps, inq, outq, base_dir, settings, low_priority):
+    inq.get()
+    # as if the stage was killed for using too much memory
+    os._exit(9)
+
+
+def test_dead_stage_aborts_the_pipeline(monkeypatch):
+    monkeypatch.setattr(pipeline, 'get_cal_scan_dict', _cal_sets)
+    monkeypatch.setattr(pipeline, '_run_stage', _dying_stage)
+    monkeypatch.setattr(pipeline, 'STAGE_POLL', 0.2)
+    results = pipeline.run_pipeline('2019-06-01', '2019-06-02', 1370.)
+    assert results == []
+
+
+def test_failing_comparison_still_reports(monkeypatch, tmp_path):
+    def scan_data(*args, **kwargs):
+        raise OSError("no data")
+
+    def passthrough(name, steps, inq, outq, base_dir, settings, low_priority):
+        while True:
+            item = inq.get()
+            outq.put(item)
+            if item == pipeline.DONE:
+                break
+
+    monkeypatch.setattr(pipeline, 'get_cal_scan_dict', _cal_sets)
+    monkeypatch.setattr(pipeline, '_run_stage', passthrough)
+    monkeypatch.setattr(pipeline, 'ScanData', scan_data)
+    results = pipeline.run_pipeline('2019-06-01', '2019-06-02', 1370.,
+                                    base_dir=str(tmp_path))
+    assert [res['task_id'] for res in results] == [190601001, 190602001]
+
+
+def _stub_apercal(monkeypatch, calls):
+    """Stand-ins for the Apercal modules of the preflag and crosscal steps"""
+
+    class Step(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def go(self):
+            calls.append((type(self).__name__, self.beam))
+
+    class preflag(Step):
+        pass
+
+    class ccal(Step):
+        pass
+
+    lib = types.ModuleType('apercal.libs.lib')
+    lib.setup_logger = lambda *args, **kwargs: None
+    managefiles = types.ModuleType('apercal.subs.managefiles')
+    managefiles.director = lambda *args, **kwargs: None
+    modules = {'apercal.libs.lib': lib, 'apercal.subs.managefiles': managefiles}
+    for name, cls in [('preflag', preflag), ('ccal', ccal)]:
+        modules['apercal.modules.' + name] = types.ModuleType(name)
+        setattr(modules['apercal.modules.' + name], name, cls)
+    for name in ['apercal', 'apercal.libs', 'apercal.subs', 'apercal.modules']:
+        modules[name] = types.ModuleType(name)
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+
+def test_calibrate_stage_flags_and_calibrates_every_beam(monkeypatch, tmp_path):
+    calls = []
+    _stub_apercal(monkeypatch, calls)
+    monkeypatch.setenv('APERCC_THROUGHPUT', str(tmp_path / 'throughput.json'))
+    inq, outq = queue.Queue(), queue.Queue()
+    item = (190601001, [[190601001, '3C147_0', 0], [190601002, '3C147_1', 1]])
+    inq.put(item)
+    inq.put(pipeline.DONE)
+    pipeline._run_stage('calibrate', ['preflag', 'crosscal'], inq, outq, str(tmp_path),
+                        None, False)
+    assert calls == [('preflag', '00'), ('preflag', '01'), ('ccal', '00'), ('ccal', '01')]
+    assert outq.get() == item
+    assert outq.get() == pipeline.DONE
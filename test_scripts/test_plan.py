@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Tests of learning the step throughputs from finished runs
+"""
+
+import os
+
+from modules import plan
+from modules.plan import Throughput, learn, plan_task
+
+
+def _beam_input(root, task_id, beam, suffix, nbytes):
+    path = os.path.join(str(root), str(task_id), '{:02d}'.format(beam), 'raw',
+                        '3C147.' + suffix)
+    os.makedirs(path)
+    with open(os.path.join(path, 'table.f0'), 'wb') as f:
+        f.write(b'\0' * nbytes)
+
+
+def test_prepare_is_learned_from_the_fetched_data(tmp_path):
+    for beam in [0, 1]:
+        _beam_input(tmp_path, 190601001, beam, 'MS', 1000)
+    task_dir = os.path.join(str(tmp_path), '190601001')
+    throughput = Throughput(str(tmp_path / 'throughput.json'))
+    # before the run the data of prepare is estimated, even if part of it is there
+    plan = plan_task(190601001, '3C147', task_dir, ['prepare'], throughput=throughput)
+    assert plan['steps'][0]['estimated'] == 2
+    learn(190601001, '3C147', task_dir, {'prepare': 2.}, throughput=throughput)
+    assert Throughput(throughput.filename).steps['prepare'] == \
+        {'bytes': 2000, 'seconds': 2., 'runs': 1}
+
+
+def test_save_merges_runs_of_other_processes(tmp_path):
+    filename = str(tmp_path / 'throughput.json')
+    first, second = Throughput(filename), Throughput(filename)
+    first.record('preflag', 100, 1.)
+    first.record_sizes('ms', [10, 20])
+    first.save()
+    second.record('preflag', 300, 2.)
+    second.save()
+    merged = Throughput(filename)
+    assert merged.steps['preflag'] == {'bytes': 400, 'seconds': 3., 'runs': 2}
+    assert merged.sizes['ms'] == {'bytes': 30, 'count': 2}
+    # saving again does not add the same runs twice
+    second.save()
+    assert Throughput(filename).steps == merged.steps
+    assert sorted(os.listdir(str(tmp_path))) == ['throughput.json', 'throughput.json.lock']
+
+
+def test_learn_measures_only_the_inputs_of_the_steps_that_ran(tmp_path, monkeypatch):
+    for beam in [0, 1]:
+        _beam_input(tmp_path, 190601001, beam, 'MS', 1000)
+        _beam_input(tmp_path, 190601001, beam, 'Bscan', 10)
+    task_dir = os.path.join(str(tmp_path), '190601001')
+    throughput = Throughput(str(tmp_path / 'throughput.json'))
+    measured = []
+    path_size = plan.path_size
+    monkeypatch.setattr(plan, 'path_size', lambda path: measured.append(path) or path_size(path))
+    learn(190601001, '3C147', task_dir, {'preflag': 2., 'crosscal': 3.}, throughput=throughput)
+    # both steps read the measurement sets, which are measured once
+    assert sorted(os.path.basename(os.path.dirname(os.path.dirname(path)))
+                  for path in measured) == ['00', '01']
+    saved = Throughput(throughput.filename)
+    assert saved.sizes == {'ms': {'bytes': 2000, 'count': 2}}
+    assert saved.steps['crosscal'] == {'bytes': 2000, 'seconds': 3., 'runs': 1}
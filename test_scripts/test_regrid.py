@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+"""
+Tests of the frequency regridding on synthetic grids
+"""
+
+import numpy as np
+
+from modules import regrid as rg
+
+
+def dense_weights(src_freq, dst_freq):
+    """Brute-force overlap matrix of two increasing grids"""
+    src, dst = rg.channel_edges(src_freq), rg.channel_edges(dst_freq)
+    overlap = np.minimum(dst[1:, None], src[None, 1:]) - np.maximum(dst[:-1, None], src[None, :-1])
+    return np.clip(overlap, 0., None) / np.diff(dst)[:, None]
+
+
+def test_weights_match_brute_force():
+    src = np.linspace(1.2, 1.5, 384)
+    dst = np.linspace(1.25, 1.45, 101)
+    assert np.allclose(rg.weight_matrix(src, dst).toarray(), dense_weights(src, dst))
+    # decreasing grids keep their channel order
+    reverse = rg.weight_matrix(src[::-1], dst[::-1]).toarray()
+    assert np.allclose(reverse, dense_weights(src, dst)[::-1, ::-1])
+
+
+def test_regrid_conserves_mean_and_flags():
+    src = np.linspace(1.2, 1.5, 384)
+    dst = src[::4] + 0.5 * (src[1] - src[0])
+    data = np.ones((2, 384, 2)) * np.arange(1, 3)[:, None, None]
+    data[0, 100:140] = np.nan
+    res = rg.regrid(src, data, dst)
+    assert res.shape == (2, len(dst), 2)
+    assert np.allclose(res[1][np.isfinite(res[1])], 2.)
+    assert np.isnan(res[0, 30:33]).all()
+    assert np.allclose(res[0, :20], 1.)
+
+
+def test_regrid_outside_the_source_is_nan():
+    res = rg.regrid(np.linspace(1.2, 1.3, 64), np.ones((64, 2)), np.linspace(1.4, 1.5, 10))
+    assert np.isnan(res).all()
+
+
+def test_weight_cache_is_bounded():
+    for n in range(rg.WEIGHT_CACHE_SIZE + 5):
+        rg.weight_matrix(np.linspace(1.2, 1.5, 64 + n), np.linspace(1.25, 1.45, 10))
+    assert len(rg._weight_cache) == rg.WEIGHT_CACHE_SIZE
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Tests of the analysis service on a Unix socket with synthetic bandpass tables
+"""
+
+import os
+import stat
+import shutil
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from modules.service import AnalysisService, ServiceClient, ServiceError, ping
+from synthetic import ANTS, solution_table
+
+TASK = 190601001
+
+
+def _bandpass(path, seed=4):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    rng = np.random.RandomState(seed)
+    data = (1. + 0.1 * rng.normal(size=(len(ANTS), 16, 2))) * np.exp(0.1j)
+    solution_table(path, data, np.zeros(data.shape, dtype=bool))
+
+
+@pytest.fixture
+def task_dir(tmp_path):
+    for beam in range(2):
+        raw = tmp_path / str(TASK) / '{:02d}'.format(beam) / 'raw'
+        raw.mkdir(parents=True)
+        _bandpass(str(raw / '3C147.Bscan'))
+    return tmp_path
+
+
+@pytest.fixture
+def service(task_dir, monkeypatch):
+    socket_path = str(task_dir / 'apercc.sock')
+    service = AnalysisService(socket_path=socket_path, base_dir=str(task_dir))
+    # the permissions of the socket before the service sets them
+    service.bound_modes = []
+    chmod = os.chmod
+
+    def recording_chmod(path, mode):
+        service.bound_modes.append(stat.S_IMODE(os.stat(path).st_mode))
+        chmod(path, mode)
+    monkeypatch.setattr(os, 'chmod', recording_chmod)
+    thread = threading.Thread(target=service.serve_forever)
+    thread.start()
+    for _ in range(500):
+        if ping(socket_path):
+            break
+        time.sleep(0.01)
+    yield service
+    if thread.is_alive():
+        with ServiceClient(socket_path) as client:
+            client.request('shutdown')
+    thread.join(10.)
+
+
+def test_service_requests(service, task_dir):
+    assert service.bound_modes == [0o600]
+    assert stat.S_IMODE(os.stat(service.socket_path).st_mode) == 0o600
+    umask = os.umask(0o022)
+    os.umask(umask)
+    assert umask != 0o177
+    with ServiceClient(service.socket_path) as client:
+        assert client.request('ping')['pid'] == os.getpid()
+        with pytest.raises(ServiceError, match='Unknown command'):
+            client.request('no_such_command')
+
+        first = client.request('bandpass_metrics', task_id=TASK, source='3C147')
+        assert sorted(first) == ['00', '01']
+        again = client.request('bandpass_metrics', task_id=TASK, source='3C147')
+        assert again == first
+        info = client.request('cache_info')
+        assert info['hits'] == {'index': 1, 'solutions': 1}
+        assert info['misses'] == {'index': 1, 'solutions': 1}
+        assert info['tasks'] == ['{} 3C147'.format(TASK)]
+
+        # a new table of beam 01 is read again
+        table = str(task_dir / str(TASK) / '01' / 'raw' / '3C147.Bscan')
+        _bandpass(table, seed=5)
+        later = time.time() + 10.
+        os.utime(os.path.join(table, 'table.dat'), (later, later))
+        changed = client.request('bandpass_metrics', task_id=TASK, source='3C147')
+        assert client.request('cache_info')['misses']['solutions'] == 2
+        assert changed['00'] == first['00'] and changed['01'] != first['01']
+
+        assert client.request('shutdown') is True
+    for _ in range(500):
+        if not os.path.exists(service.socket_path):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(service.socket_path)
+    assert not ping(service.socket_path)
+
+
+def test_index_is_bounded(tmp_path):
+    service = AnalysisService(socket_path=str(tmp_path / 's'), base_dir=str(tmp_path),
+                              max_tasks=2)
+    for task_id in [190601001, 190602001, 190603001]:
+        service._scandata(task_id, '3C147')
+    assert sorted(key[0] for key in service._index) == [190602001, 190603001]
+    service._scandata(190602001, '3C147')
+    assert service._hits['index'] == 1
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+Tests of publishing solution cubes in shared memory for process pools
+"""
+
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from modules import shared, throttle
+from modules.cube import BandpassCube
+from modules.shared import share_array, pool_map
+from synthetic import ANTS, solution_table
+
+shared_memory = pytest.importorskip('multiprocessing.shared_memory')
+
+
+@pytest.fixture
+def cube(tmp_path):
+    rng = np.random.RandomState(13)
+    tables = dict()
+    for beam in range(3):
+        data = rng.normal(size=(len(ANTS), 8, 2)) + 1j * rng.normal(size=(len(ANTS), 8, 2))
+        flags = rng.uniform(size=data.shape) < 0.2
+        tables[beam] = str(tmp_path / 'beam{}.Bscan'.format(beam))
+        solution_table(tables[beam], data, flags)
+    return BandpassCube(tables)
+
+
+def _beam_sum(cube, b):
+    """Worker: sum of the unflagged solutions of a beam of the attached cube"""
+    return complex(np.nansum(cube.data[b])), cube.flags[b].count()
+
+
+def _worker_limits(attached, item):
+    """Worker: the read limits and the attached array"""
+    return throttle.settings()['max_open_tables'], attached[item].tolist()
+
+
+def test_share_array():
+    array = np.arange(24.).reshape(2, 3, 4)
+    desc = share_array(array, labels=('beam', 'ant', 'chan'))
+    try:
+        view = desc.attach()
+        np.testing.assert_array_equal(view, array)
+        assert desc.labels == ('beam', 'ant', 'chan') and desc.nbytes == array.nbytes
+        assert not view.flags.writeable
+        # another attachment sees changes of the segment
+        desc.attach(writeable=True)[0, 0, 0] = -1.
+        assert view[0, 0, 0] == -1.
+        # a process that attaches by name maps the same segment
+        other = shared_memory.SharedMemory(name=desc.name)
+        np.testing.assert_array_equal(np.ndarray(array.shape, array.dtype, other.buf)[1], array[1])
+        other.close()
+    finally:
+        desc.release()
+
+
+def test_release_unlinks_the_segment():
+    desc = share_array(np.ones(10))
+    name = desc.name
+    desc.release()
+    assert name not in shared._owned
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+    # releasing twice is harmless
+    desc.release()
+
+
+def test_shared_cube_attach(cube):
+    shared_cube = cube.share()
+    try:
+        attached = shared_cube.attach()
+        np.testing.assert_array_equal(attached.data, cube.data)
+        np.testing.assert_array_equal(attached.flags.unpack(), cube.flags.unpack())
+        np.testing.assert_array_equal(attached.amp, cube.amp)
+        assert list(attached.ants) == list(cube.ants)
+        assert attached.beams.tolist() == [0, 1, 2]
+    finally:
+        shared_cube.release()
+
+
+def test_pool_map_with_processes(cube):
+    shared_cube = cube.share()
+    try:
+        expected = [_beam_sum(cube, b) for b in range(3)]
+        assert pool_map(_beam_sum, range(3), shared_cube, processes=2) == expected
+        assert pool_map(_beam_sum, range(3), shared_cube, processes=1) == expected
+    finally:
+        shared_cube.release()
+
+
+def test_pool_map_workers_get_the_read_limits(monkeypatch):
+    # new processes do not inherit the limits of the parent, unlike forked ones
+    monkeypatch.setattr(shared, 'multiprocessing', multiprocessing.get_context('spawn'))
+    arrays = shared.share_arrays({'x': np.arange(3.), 'y': np.ones(2)})
+    throttle.configure(max_open_tables=3)
+    try:
+        res = pool_map(_worker_limits, ['x', 'y'], arrays, processes=2)
+    finally:
+        throttle.configure()
+        shared.release_arrays(arrays)
+    assert res == [(3, [0., 1., 2.]), (3, [1., 1.])]
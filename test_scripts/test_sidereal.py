@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Tests of the sidereal times and of the resampling onto hour angles
+"""
+
+import numpy as np
+import pytest
+
+from modules import sidereal
+from modules.Sols import GainSols
+from modules.sidereal import (gmst, lst, hour_angle, unwrap_hours, solution_coordinate,
+                              resample, resample_phase, SECONDS_PER_DAY, WSRT_LONGITUDE)
+
+
+def test_gmst_reference_values():
+    # J2000.0, and 1987 April 10 at 0h and 19h21m UT (Meeus, examples 12.a and 12.b)
+    mjd = np.array([51544.5, 46895., 46895. + 19.35 / 24.])
+    expected = [18.697374558, 13. + 10. / 60. + 46.3668 / 3600., 8. + 34. / 60. + 57.0896 / 3600.]
+    np.testing.assert_allclose(gmst(mjd * SECONDS_PER_DAY), expected, atol=1e-6)
+    assert np.isnan(gmst([np.nan])).all()
+
+
+def test_lst_matches_casacore():
+    measures = pytest.importorskip('casacore.measures')
+    dm = measures.measures()
+    dm.do_frame(dm.position('wgs84', '{}deg'.format(WSRT_LONGITUDE), '52.915deg', '16m'))
+    for mjd in [58650.3, 58700.91, 59000.]:
+        epoch = dm.epoch('utc', '{}s'.format(mjd * SECONDS_PER_DAY))
+        dm.do_frame(epoch)
+        ref = dm.measure(epoch, 'LMST')['m0']['value'] % 1. * 24.
+        diff = (lst(mjd * SECONDS_PER_DAY) - ref + 12.) % 24. - 12.
+        assert abs(diff) * 3600. < 0.6
+
+
+def test_hour_angle_and_unwrap():
+    time = 58650.3 * SECONDS_PER_DAY + 600. * np.arange(20)
+    ra = np.radians(15. * lst(time[0]))  # transit at the first sample
+    ha = hour_angle(time, ra)
+    assert abs(ha[0]) < 1e-9
+    assert np.all((ha >= -12.) & (ha < 12.))
+
+    hours = np.array([[22., 23., 0.5, 1.5, np.nan], [1., 0., 23., 22.5, 22.]])
+    np.testing.assert_allclose(unwrap_hours(hours), [[22., 23., 24.5, 25.5, np.nan],
+                                                     [1., 0., -1., -1.5, -2.]])
+    # the LST of a series across 0h keeps increasing
+    time = 58650. * SECONDS_PER_DAY + 60. * np.arange(24 * 60)
+    coord = solution_coordinate(time, 'lst')
+    assert np.all(np.diff(coord) > 0)
+    np.testing.assert_allclose(np.diff(coord), 1.00273790935 / 60., rtol=1e-6)
+
+
+def test_resample_across_a_phase_wrap():
+    x = np.array([[0., 1., 2., 3., np.nan], [0.5, 1.5, 2.5, 3.5, 4.5]])
+    phase = np.array([[170., 178., -174., -166., np.nan], [0., 10., 20., 30., 40.]])
+    grid = np.array([0.5, 1.5, 2.5, 4.])
+    res = resample_phase(x, phase[:, :, None], grid, axis=1)[..., 0]
+    np.testing.assert_allclose(res[0, :3], [174., -178., -170.], atol=0.05)
+    assert np.isnan(res[0, 3])  # after the last sample
+    np.testing.assert_allclose(res[1], [0., 10., 20., 35.])
+    # plain interpolation goes the long way round
+    assert resample(x, phase[:, :, None], grid, axis=1)[0, 1, 0] == pytest.approx(2.)
+
+
+def test_resample_max_gap():
+    x = np.array([0., 1., 5., 6.])
+    y = np.array([[0., 1., 5., 6.], [0., 2., 10., 12.]]).T  # [time, series]
+    grid = np.array([0.5, 3., 5.5, 6.])
+    res = resample(x, y, grid, axis=0, max_gap=2.)
+    np.testing.assert_allclose(res[[0, 2, 3]], [[0.5, 1.], [5.5, 11.], [6., 12.]])
+    assert np.isnan(res[1]).all()
+    np.testing.assert_allclose(resample(x, y, grid, axis=0)[1], [3., 6.])
+    # a flagged sample blanks the intervals next to it
+    y[2, 0] = np.nan
+    res = resample(x, y, grid, axis=0)
+    assert np.isnan(res[1:3, 0]).all() and np.isfinite(res[:, 1]).all()
+
+
+def _gains(time, ra):
+    """GainSols of a source at ra whose gains only depend on the hour angle"""
+    g = GainSols.__new__(GainSols)
+    g.gaintable = ra
+    g.time = time
+    g.ants = ['RT2', 'RT3']
+    ha = hour_angle(time, ra)
+    g.amp = np.repeat((1. + 0.1 * np.sin(ha))[None, :, None], 2, axis=0).repeat(2, axis=2)
+    g.phase = np.repeat((60. * ha)[None, :, None], 2, axis=0).repeat(2, axis=2)
+    return g
+
+
+def test_normalize_on_hour_angle(monkeypatch):
+    # the gain table of the _gains stand-ins is the right ascension
+    monkeypatch.setattr(sidereal, 'table_ra', lambda table: table)
+    ra = np.radians(85.65)
+    time = 58650.3 * SECONDS_PER_DAY + 30. * np.arange(240)
+    g1 = _gains(time, ra)
+    # the next day, starting 10 minutes later in hour angle
+    g2 = _gains(time + SECONDS_PER_DAY - 236. + 600., ra)
+
+    x, amp, phase = g1.normalize(g2, align='hourangle')
+    np.testing.assert_allclose(x, unwrap_hours(hour_angle(time, ra)))
+    covered = np.isfinite(amp[0, :, 0])
+    assert not covered[:19].any() and covered[21:].all()
+    np.testing.assert_allclose(amp[:, covered], 1., atol=1e-5)
+    np.testing.assert_allclose(phase[:, covered], 0., atol=1e-3)
+
+    # on the time since the start the gains differ by 10 minutes of hour angle
+    t, amp, phase = g1.normalize(g2, align='start')
+    assert np.abs(phase).max() > 9.
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Tests of the beam similarity with a synthetic bandpass cube
+"""
+
+import numpy as np
+
+from modules import metrics
+from modules.similarity import BeamSimilarity, correlation_matrix, cluster
+
+
+class FakeCube(object):
+    """The attributes of a BandpassCube that the comparisons use"""
+
+    def __init__(self, nbeam=5, nant=3, nchan=32, npol=2):
+        rng = np.random.RandomState(3)
+        self.beams = np.arange(nbeam)
+        self.present = np.ones(nbeam, dtype=bool)
+        self.ants = tuple('RT{}'.format(a) for a in range(nant))
+        self.time = 5.06e9 + np.arange(nbeam)
+        self.freq = np.linspace(1.2, 1.5, nchan)
+        self.amp = 1 + 0.05 * rng.normal(size=(nbeam, nant, nchan, npol))
+        self.phase = 5 * rng.normal(size=(nbeam, nant, nchan, npol))
+
+
+class FakeScanData(object):
+    task_id = 190601001
+    source_name = '3C147'
+
+
+def test_records_do_not_store_group_labels():
+    sim = BeamSimilarity(FakeCube(), kind='amp')
+    metrics_stored = set(rec[0] for b in range(len(sim.beams)) for rec in sim.records(b))
+    assert metrics_stored == {'beam_similarity_amp', 'beam_outlier_amp'}
+    assert sim.groups.shape == (3, 5)
+
+
+def test_beam_similarity_uses_the_given_cube(monkeypatch):
+    def read_again(scandata):
+        raise AssertionError("the cube was read again")
+    monkeypatch.setattr(metrics.BandpassCube, 'from_scandata', staticmethod(read_again))
+    sims = metrics.beam_similarity(FakeScanData(), cube=FakeCube())
+    assert [sim.kind for sim in sims] == ['amp', 'phase']
+
+
+def test_correlation_matrix_matches_corrcoef():
+    rng = np.random.RandomState(1)
+    x = rng.normal(size=(2, 4, 40))
+    x[:, 1] += x[:, 0]
+    x[..., [3, 17, 18]] = np.nan
+    corr = correlation_matrix(x)
+    assert corr.shape == (2, 4, 4)
+    valid = np.isfinite(x[0, 0])
+    for k in range(2):
+        np.testing.assert_allclose(corr[k], np.corrcoef(x[k][:, valid]), atol=1e-12)
+
+    # pairs with fewer than 3 common unflagged channels are not compared
+    x[0, 2, 2:] = np.nan
+    corr = correlation_matrix(x[0])
+    assert np.isnan(corr[2]).all() and np.isnan(corr[:, 2]).all()
+    np.testing.assert_allclose(corr[[0, 1, 3]][:, [0, 1, 3]],
+                               np.corrcoef(x[0][[0, 1, 3]][:, valid]), atol=1e-12)
+
+
+def test_cluster_groups_beam_families():
+    rng = np.random.RandomState(2)
+    families = rng.normal(size=(2, 64))
+    # beams 0, 2, 5 and 6 share one residual spectrum, 1 and 4 another,
+    # beam 3 is on its own and beam 7 is flagged
+    family = [0, 1, 0, None, 1, 0, 0, None]
+    x = np.array([families[f] if f is not None else rng.normal(size=64) for f in family])
+    x += 0.2 * rng.normal(size=x.shape)
+    x[7] = np.nan
+    labels = cluster(correlation_matrix(x), min_corr=0.5)
+    np.testing.assert_array_equal(labels, [0, 1, 0, -1, 1, 0, 0, -1])
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+Tests of sorting the rows of solution tables
+"""
+
+import numpy as np
+import pytest
+
+from modules.soltable import sort_solutions
+
+
+def _rows(times, nant=3, nchan=4, npol=2):
+    time_col = np.repeat(times, nant)
+    ant_col = np.tile(np.arange(nant)[::-1], len(times))
+    param = (np.arange(len(time_col) * nchan * npol) + 1j).reshape(len(time_col), nchan, npol)
+    flags = np.zeros(param.shape, dtype=bool)
+    flags[0, 1, 0] = True
+    return time_col, ant_col, param, flags
+
+
+def test_solutions_per_time():
+    time_col, ant_col, param, flags = _rows([20., 10.])
+    times, values, sorted_flags = sort_solutions(time_col, ant_col, param, flags, 3, 'time')
+    assert times.tolist() == [10., 20.]
+    assert values.shape == (3, 2, 2)
+    # antenna 2 at time 20 is the first row
+    assert values[2, 1, 0] == param[0, 0, 0]
+    assert values[0, 0, 1] == param[5, 0, 1]
+
+
+def test_solutions_per_channel():
+    time_col, ant_col, param, flags = _rows([10.])
+    times, values, sorted_flags = sort_solutions(time_col, ant_col, param, flags, 3, 'chan')
+    assert times.tolist() == [10.]
+    assert np.array_equal(values[::-1][~sorted_flags[::-1]], param[~flags])
+    assert np.isnan(values[2, 1, 0]) and sorted_flags[2, 1, 0]
+
+
+def test_several_times_per_channel_need_a_choice():
+    time_col, ant_col, param, flags = _rows([10., 20.])
+    with pytest.raises(ValueError):
+        sort_solutions(time_col, ant_col, param, flags, 3, 'chan')
+    times, values, _ = sort_solutions(time_col, ant_col, param, flags, 3, 'chan', time_index=-1)
+    assert times.tolist() == [20.]
+    assert np.array_equal(values[::-1], param[3:])
+
+
+def test_tables_with_different_shapes(tmp_path):
+    pytest.importorskip('casacore.tables')
+    from modules.soltable import read_beams
+    from synthetic import solution_table
+
+    tables = dict()
+    for beam, nchan in [(0, 8), (1, 16), (2, 8)]:
+        tables[beam] = str(tmp_path / '{:02d}.Bscan'.format(beam))
+        data = np.full((3, nchan, 2), beam + 1j)
+        solution_table(tables[beam], data, np.zeros(data.shape, dtype=bool))
+    sols = read_beams(tables)
+    assert sorted(sols) == [0, 1, 2]
+    assert [sols[beam].values.shape[1] for beam in [0, 1, 2]] == [8, 16, 8]
+    assert [sols[beam].values[0, 0, 0] for beam in [0, 1, 2]] == [1j, 1 + 1j, 2 + 1j]
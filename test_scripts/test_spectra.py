@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Tests of the gain power spectra against scipy and Parseval's theorem
+"""
+
+import numpy as np
+import pytest
+
+from modules.spectra import GainSpectra, lomb_scargle, detrend
+
+signal = pytest.importorskip('scipy.signal')
+
+
+class FakeGainCube(object):
+    """The attributes of a GainCube that the spectra use, sampled every 10 s"""
+
+    def __init__(self, nbeam=2, nant=2, ntime=720, npol=2, seed=9):
+        rng = np.random.RandomState(seed)
+        self.beams = np.arange(nbeam)
+        self.present = np.ones(nbeam, dtype=bool)
+        self.ants = tuple('RT{}'.format(a) for a in range(nant))
+        self.time = 5.06e9 + 1000. * np.arange(nbeam)[:, None] + 10. * np.arange(ntime)
+        shape = (nbeam, nant, ntime, npol)
+        self.amp = 1. + 0.01 * rng.normal(size=shape)
+        self.phase = 170. + 2. * rng.normal(size=shape)
+
+
+def test_lomb_scargle_matches_scipy():
+    rng = np.random.RandomState(10)
+    t = np.sort(rng.uniform(0., 1800., size=(3, 150)), axis=-1)
+    y = rng.normal(size=t.shape)
+    y[1, 40:60] = np.nan
+    freq = np.linspace(1e-3, 0.04, 80)
+    power = lomb_scargle(t, y, freq)
+    assert power.shape == (3, 80)
+    for k in range(3):
+        # flagged samples are left out
+        valid = np.isfinite(y[k])
+        np.testing.assert_allclose(power[k], signal.lombscargle(t[k, valid], y[k, valid],
+                                                                2 * np.pi * freq), rtol=1e-8)
+
+    # evenly sampled up to the Nyquist frequency
+    t = 10. * np.arange(100)
+    freq = np.arange(1, 51) / 1000.
+    np.testing.assert_allclose(lomb_scargle(t, y[0, :100], freq),
+                               signal.lombscargle(t, y[0, :100], 2 * np.pi * freq),
+                               rtol=1e-8, atol=1e-12)
+
+def test_band_powers_sum_to_the_variance():
+    cube = FakeGainCube()
+    spectra = GainSpectra(cube, order=0)
+    assert spectra.amp_power.shape == (2, 2, 2, 2)
+    amp_var = np.var(cube.amp, axis=2)
+    np.testing.assert_allclose(spectra.amp_power.sum(axis=2), amp_var, rtol=0.01)
+    # phases across the wrap at 180 degrees keep their scatter of 2 degrees
+    phase_var = np.var(cube.phase, axis=2)
+    np.testing.assert_allclose(spectra.phase_power.sum(axis=2), phase_var, rtol=0.01)
+    assert np.all(spectra.amp >= 0) and np.all(spectra.phase >= 0)
+    # white noise sampled every 10 s has 2/3 of its power above 1/60 Hz
+    assert spectra.band_names == ['fast', 'slow']
+    np.testing.assert_allclose(spectra.amp_power[:, :, 0] / spectra.amp_power.sum(axis=2),
+                               2. / 3., atol=0.1)
+
+
+def test_flagged_gap():
+    cube = FakeGainCube()
+    t = cube.time[0] - cube.time[0, 0]
+    # a slow oscillation of 5 minutes in the amplitude of one antenna
+    cube.amp[0, 1, :, 0] = 1. + 0.1 * np.sin(2 * np.pi * t / 300.)
+    cube.amp[0, 1, 200:400] = np.nan
+    spectra = GainSpectra(cube, order=1)
+    fast, slow = spectra.amp_power[0, 1, :, 0]
+    assert slow == pytest.approx(0.1 ** 2 / 2, rel=0.1)
+    assert fast < 0.01 * slow
+    assert np.isfinite(spectra.amp_power[0, 1, :, 1]).all()
+
+    # the flagged samples are left out of the periodogram
+    valid = np.isfinite(cube.amp[0, 1, :, 0])
+    y = detrend(t[valid], cube.amp[0, 1, valid, 0])
+    np.testing.assert_allclose(
+        spectra.amp[0, 1, :, 0] / (2 * 10.),
+        signal.lombscargle(t[valid], y, 2 * np.pi * spectra.freq), rtol=1e-6)
+    records = spectra.records(0)
+    assert ('gain_amp_power_slow', 'RT1', 'XX', float(slow)) in records
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Tests of the robust statistics against numpy
+"""
+
+import warnings
+
+import numpy as np
+
+from modules.stats import (wrap_phase, nanmedian, mad, circular_mean, circular_std,
+                           robust_zscore, rank_outliers, MAD_SCALE)
+
+
+def _data(shape=(6, 5, 40), seed=5):
+    rng = np.random.RandomState(seed)
+    x = rng.normal(size=shape)
+    x[rng.uniform(size=shape) < 0.2] = np.nan
+    x[0, 0] = np.nan  # a spectrum without any valid value
+    x[1, 1, :5] = np.inf
+    x[1, 2, :3] = -np.inf
+    return x
+
+
+def _finite(x):
+    return np.where(np.isfinite(x), x, np.nan)
+
+
+def test_wrap_phase():
+    np.testing.assert_allclose(wrap_phase([-540., -180., 179., 180., 190., 725.]),
+                               [-180., -180., 179., -180., -170., 5.])
+
+
+def test_nanmedian_matches_numpy():
+    x = _data()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for axis in [0, 1, 2, -1]:
+            np.testing.assert_allclose(nanmedian(x, axis=axis),
+                                       np.nanmedian(_finite(x), axis=axis))
+    np.testing.assert_allclose(nanmedian(x), np.nanmedian(_finite(x)))
+    # infinities do not shift the median
+    assert nanmedian([1., 2., 3., np.inf, np.inf, -np.inf]) == 2.
+    assert np.isnan(nanmedian([np.nan, np.inf]))
+
+
+def test_mad_matches_numpy():
+    x = _finite(_data())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(x, axis=2, keepdims=True)
+        expected = MAD_SCALE * np.nanmedian(np.abs(x - med), axis=2)
+    np.testing.assert_allclose(mad(_data(), axis=2), expected)
+
+
+def test_circular_statistics():
+    rng = np.random.RandomState(6)
+    phase = 170. + 10. * rng.normal(size=(4, 500))
+    phase[:, ::7] = np.nan
+    rad = np.radians(phase[:, np.isfinite(phase[0])])
+    # the mean is taken across the wrap at 180 degrees
+    mean = np.degrees(np.angle(np.exp(1j * rad).mean(axis=1)))
+    np.testing.assert_allclose(circular_mean(wrap_phase(phase), axis=1), mean)
+    np.testing.assert_allclose(wrap_phase(circular_mean(wrap_phase(phase), axis=1) - 170.),
+                               0., atol=1.5)
+    std = np.degrees(np.sqrt(-2. * np.log(np.abs(np.exp(1j * rad).mean(axis=1)))))
+    np.testing.assert_allclose(circular_std(wrap_phase(phase), axis=1), std)
+    np.testing.assert_allclose(std, 10., rtol=0.15)
+
+
+def test_robust_zscore():
+    x = _finite(_data())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(x, axis=2, keepdims=True)
+        scale = MAD_SCALE * np.nanmedian(np.abs(x - med), axis=2, keepdims=True)
+    np.testing.assert_allclose(robust_zscore(x, axis=2), (x - med) / scale)
+    # identical values do not give infinite scores
+    assert np.all(robust_zscore(np.ones(10), floor=0.1) == 0.)
+
+
+def test_rank_outliers():
+    rng = np.random.RandomState(7)
+    amp = 1. + 0.01 * rng.normal(size=(8, 4, 64, 2))
+    phase = rng.normal(size=amp.shape)
+    amp[5] *= 1.2  # high amplitude
+    phase[2, :, :, 0] += 40.  # phase offset in one polarisation
+    amp[6, :, :40] = np.nan  # mostly flagged
+    outliers = rank_outliers(amp, phase, axis=0, labels=list(range(8)), name='beam')
+    assert sorted(o['label'] for o in outliers) == [2, 5, 6]
+    assert [o['score'] for o in outliers] == sorted([o['score'] for o in outliers], reverse=True)
+    statistics = dict((o['label'], o['statistic']) for o in outliers)
+    assert statistics[5] == 'amp_median'
+    assert statistics[6] == 'flagged'
+    assert statistics[2] in ('phase_mean', 'phase_std')
+    assert all(o['axis'] == 'beam' for o in outliers)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Tests of the table access: concatenated queries, profiling, the pool of
+open tables and the fingerprint cache of subtables
+"""
+
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from modules import tableio
+from modules.tableio import (concat_query, concat_getcol, open_table, fingerprint,
+                             get_antennas, TablePool)
+from synthetic import ANTS, solution_table
+
+
+def _table(path, nrow, value=1., ants=ANTS):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    data = np.full((nrow, 4, 2), value, dtype=complex) + np.arange(nrow)[:, None, None]
+    solution_table(path, data, np.zeros(data.shape, dtype=bool),
+                   ant_col=np.arange(nrow) % len(ants), ants=ants)
+    return path
+
+
+def _touch(path):
+    """Move the modification time of a table forward, as a later write would"""
+    later = time.time() + 10.
+    os.utime(os.path.join(path, 'table.dat'), (later, later))
+
+
+@pytest.fixture
+def tables(tmp_path):
+    return [_table(str(tmp_path / 'beam{}.Bscan'.format(b)), nrow, value=10. * b)
+            for b, nrow in enumerate([3, 5, 2])]
+
+
+def test_concatenated_row_ranges(tables):
+    t, row_ranges = concat_query(tables, ['ANTENNA1', 'CPARAM'])
+    assert row_ranges == [(0, 3), (3, 8), (8, 10)]
+    assert t.nrows() == 10
+    cols = concat_getcol(tables, ['ANTENNA1', 'CPARAM'])
+    for b, path in enumerate(tables):
+        np.testing.assert_array_equal(cols['CPARAM'][b], open_table(path).getcol('CPARAM'))
+        np.testing.assert_array_equal(cols['ANTENNA1'][b], open_table(path).getcol('ANTENNA1'))
+    assert cols['CPARAM'][2][0, 0, 0] == 20.
+
+
+def test_profiling(tables):
+    tableio.enable_profiling()
+    try:
+        open_table(tables[0]).getcol('CPARAM')
+        concat_getcol(tables, ['CPARAM'])
+        summary = tableio.profile_summary()
+    finally:
+        tableio.disable_profiling()
+    assert not tableio.profiling_enabled()
+    hottest = dict((tot['table'], tot) for tot in summary['hottest_tables'])
+    # the opened table with its read, three opens of concat_query and the query itself
+    assert hottest[tables[0]]['queries'] == 2
+    assert hottest[tables[0]]['bytes'] == 3 * 4 * 2 * 8
+    concat = '[{0}, ... (3 tables)]'.format(tables[0])
+    assert hottest[concat]['rows'] == 10 and hottest[concat]['bytes'] == 10 * 4 * 2 * 8
+    assert summary['queries'] == 5
+    assert summary['bytes'] == 13 * 4 * 2 * 8
+    assert tableio.table_path('SELECT TIME FROM /a/b.MS::ANTENNA WHERE x') == '/a/b.MS'
+
+
+def test_pool_reopens_changed_tables(tables):
+    pool = TablePool()
+    try:
+        t = pool.get(tables[0])
+        assert pool.get(tables[0]) is t
+        _table(tables[0], 6)
+        _touch(tables[0])
+        t = pool.get(tables[0])
+        assert t.nrows() == 6
+        assert pool.get(tables[0]) is t
+    finally:
+        pool.close()
+
+
+def test_pool_closes_the_least_recently_used(tables):
+    pool = TablePool(maxsize=2)
+    try:
+        first = pool.get(tables[0])
+        pool.get(tables[1])
+        assert pool.get(tables[0]) is first
+        pool.get(tables[2])
+        assert list(pool._tables) == [tables[0], tables[2]]
+        assert pool.get(tables[0]) is first
+        pool.discard(tables[0])
+        assert list(pool._tables) == [tables[2]]
+    finally:
+        pool.close()
+
+
+def test_fingerprints(tmp_path, monkeypatch):
+    a = _table(str(tmp_path / 'a.Bscan'), 3)
+    b = _table(str(tmp_path / 'b.Bscan'), 3)
+    c = _table(str(tmp_path / 'c.Bscan'), 3, ants=['RT5', 'RT6', 'RT7'])
+    ant_a, ant_b, ant_c = [os.path.join(path, 'ANTENNA') for path in [a, b, c]]
+    assert fingerprint(ant_a) == fingerprint(ant_b) != fingerprint(ant_c)
+    # tables with the same ANTENNA subtable share the antenna names
+    assert get_antennas(a) is get_antennas(b)
+    assert get_antennas(c) == ('RT5', 'RT6', 'RT7')
+
+    # a changed subtable gets a new fingerprint
+    _table(b, 3, ants=['RT5', 'RT6', 'RT7'])
+    _touch(ant_b)
+    assert fingerprint(ant_b) == fingerprint(ant_c)
+    assert get_antennas(b) == ('RT5', 'RT6', 'RT7')
+
+    # only the most recently used fingerprints are kept
+    monkeypatch.setattr(tableio, 'FINGERPRINTS_SIZE', 2)
+    monkeypatch.setattr(tableio, '_fingerprints', OrderedDict())
+    for path in [ant_a, ant_b, ant_c, ant_b]:
+        fingerprint(path)
+    assert list(tableio._fingerprints) == [ant_c, ant_b]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Tests of the read limits shared by several processes
+"""
+
+import time
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from modules import throttle
+
+
+def _read(args):
+    nbytes, rounds = args
+    for _ in range(rounds):
+        throttle.account(nbytes)
+    return throttle.settings()['max_open_tables']
+
+
+def _hold_slot(args):
+    start, hold = args
+    with throttle.table_slot():
+        begin = time.time() - start
+        time.sleep(hold)
+    return begin
+
+
+def test_bandwidth_is_shared_by_pool_workers():
+    settings = throttle.shared_settings(read_bandwidth=1e6, max_open_tables=2)
+    pool = multiprocessing.Pool(4, initializer=throttle.init_worker, initargs=(settings,))
+    try:
+        start = time.time()
+        # 4 workers reading 0.25 MB five times: 5 MB, of which 1 MB is the burst
+        limits = pool.map(_read, [(0.25e6, 5)] * 4)
+        elapsed = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    assert limits == [2] * 4
+    # per process limits would let this finish at once
+    assert elapsed > 3.5
+
+
+def test_read_slots_are_shared_by_pool_workers():
+    settings = throttle.shared_settings(max_open_tables=1)
+    pool = multiprocessing.Pool(3, initializer=throttle.init_worker, initargs=(settings,))
+    try:
+        begins = sorted(pool.map(_hold_slot, [(time.time(), 0.3)] * 3, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+    assert begins[1] - begins[0] > 0.25
+    assert begins[2] - begins[1] > 0.25
+
+
+def test_limited_reads_keep_the_handles_open(tmp_path):
+    pytest.importorskip('casacore.tables')
+    from modules.visstats import VisStats
+    from synthetic import baselines, measurement_set
+
+    a1, a2, tindex = baselines()
+    ms = str(tmp_path / '3C147.MS')
+    measurement_set(ms, a1, a2, 5.06e9 + tindex, np.ones((len(a1), 4, 2)),
+                    np.linspace(1.3, 1.4, 4), [9, 12], column='CORRECTED_DATA')
+    # the measurement set and its subtables are more tables than read slots
+    throttle.configure(max_open_tables=1)
+    try:
+        stats = VisStats(ms, nbins=2)
+    finally:
+        throttle.configure()
+    assert len(stats.baselines) == 3
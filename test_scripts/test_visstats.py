@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Tests of the visibility statistics with a synthetic measurement set
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('casacore.tables')
+
+from modules.visstats import VisStats, model_flux  # noqa: E402
+from synthetic import ANTS, baselines, measurement_set  # noqa: E402
+
+NCHAN, NCORR = 8, 4
+
+
+def _calibrator_ms(path, ntime=2):
+    freq = np.linspace(1.25, 1.55, NCHAN)
+    a1, a2, tindex = baselines(ntime=ntime)
+    # every baseline has its own amplitude ratio and phase
+    ratio = 1. + 0.1 * a1 + 0.01 * a2
+    phase = 20. * a1 - 15. * a2
+    vis = (ratio * np.exp(1j * np.radians(phase)))[:, None, None] * \
+        model_flux('3C147', freq)[None, :, None] * np.ones((1, 1, NCORR))
+    flags = np.zeros(vis.shape, dtype=bool)
+    flags[1, :2, 0] = True
+    measurement_set(path, a1, a2, 5.06e9 + 30. * tindex, vis, freq, [9, 10, 11, 12],
+                    column='CORRECTED_DATA', flags=flags)
+    return a1, a2, ratio, phase
+
+
+@pytest.mark.parametrize('rows_per_chunk', [None, 11])
+def test_vis_stats_against_the_model(tmp_path, rows_per_chunk):
+    ms = str(tmp_path / '3C147.MS')
+    a1, a2, ratio, phase = _calibrator_ms(ms)
+    # 12 rows in chunks of 11 leave the last autocorrelation alone in the last chunk
+    max_bytes = rows_per_chunk * NCHAN * NCORR * 64 if rows_per_chunk else 1 << 20
+    stats = VisStats(ms, nbins=4, max_bytes=max_bytes)
+    cross = [(int(i), int(j)) for i, j in zip(a1[:6], a2[:6]) if i != j]
+    assert stats.baselines == [(ANTS[i], ANTS[j]) for i, j in cross]
+    assert stats.amp_mean.shape == (3, 4, 2)
+    for b, (i, j) in enumerate(cross):
+        row = np.where((a1 == i) & (a2 == j))[0][0]
+        assert np.allclose(stats.amp_mean[b], ratio[row], rtol=1e-5)
+        assert np.allclose(stats.phase_mean[b], phase[row], atol=1e-3)
+        assert np.allclose(stats.amp_std[b], 0., atol=1e-3)
+    # the two flagged channels of the first time are the first bin of baseline RT2-RT3 XX
+    assert stats.n[0, 0].tolist() == [2, 4]
+    assert np.isclose(stats.flagged[0, 0, 0], 0.5)
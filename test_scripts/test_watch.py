@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""
+Tests of the solution watcher with stand-in tables
+"""
+
+import os
+
+import numpy as np
+
+from modules import watch
+from modules.watch import SolutionWatcher, RunningStats
+
+
+def test_running_stats():
+    stats = RunningStats()
+    samples = np.random.RandomState(1).normal(size=(20, 3, 2))
+    samples[3, 0, 0] = np.nan
+    for x in samples:
+        stats.update(x)
+    assert np.allclose(stats.mean, np.nanmean(samples, axis=0))
+    assert np.allclose(stats.std, np.nanstd(samples, axis=0, ddof=1))
+    assert stats.n[0, 0] == 19
+
+
+def _table(root, task_id, beam):
+    table = os.path.join(str(root), str(task_id), '{:02d}'.format(beam), 'raw', '3C147.Bscan')
+    os.makedirs(table)
+    with open(os.path.join(table, 'table.dat'), 'w') as f:
+        f.write('x')
+    return table
+
+
+def test_vanished_table_does_not_stop_the_watcher(tmp_path, monkeypatch):
+    watcher = SolutionWatcher(roots=[str(tmp_path)], state_file='')
+    table = _table(tmp_path, 190601001, 0)
+    found = watcher.find_tables()
+    monkeypatch.setattr(watcher, 'find_tables', lambda: found)
+    os.remove(os.path.join(table, 'table.dat'))
+    os.rmdir(table)
+    assert watcher.poll() == []
+    assert watcher.pending == {}
+
+
+def test_statistics_survive_a_restart(tmp_path, monkeypatch):
+    summaries = iter([{'bpass_amp_median': np.full((2, 2), 1. + 0.01 * i)} for i in range(3)])
+    monkeypatch.setattr(watch, 'BPSols', lambda table: type('Sol', (), {'amp': np.ones((2, 4, 2))}))
+    monkeypatch.setattr(watch, 'solution_summary', lambda sol, kind: next(summaries))
+    state = str(tmp_path / 'state.pkl')
+    root = tmp_path / 'data'
+    watcher = SolutionWatcher(roots=[str(root)], state_file=state)
+    for task_id in [190601001, 190602001]:
+        _table(root, task_id, 0)
+        watcher.poll()
+        watcher.poll()
+    restarted = SolutionWatcher(roots=[str(root)], state_file=state)
+    stats = restarted.stats[('3C147', 0, 'bpass_amp_median')]
+    assert stats.n.tolist() == [[2, 2], [2, 2]]
+    assert restarted.seen == watcher.seen
+    # a table written while the watcher was not running is still processed
+    _table(root, 190603001, 0)
+    restarted.poll()
+    restarted.poll()
+    assert stats.n[0, 0] == 3